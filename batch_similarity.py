@@ -0,0 +1,297 @@
+"""Batched visual edit distance for many string pairs at once.
+
+levenshtein_many() returns the same distances as strSimilarity.levenshtein()
+for a list of (s, t) pairs, and howConfusableAre_many() the same scores as
+strSimilarity.howConfusableAre().  Pairs are bucketed by (len(s), len(t)).
+For each bucket the substitution, digraph, transposition and repetition
+costs are computed up front as (pairs, len(s), len(t)) arrays, and the cost
+matrix d is then filled one anti-diagonal at a time for the whole bucket.
+The Python loop runs len(s)+len(t) times per bucket instead of
+len(s)*len(t) times per pair.
+"""
+import numpy as np
+
+import charSimilarity
+import strSimilarity
+
+# Largest cost matrix (pairs * rows * columns) filled in one go.  Buckets
+# bigger than this are split into chunks.
+MAX_CELLS_PER_CHUNK = 2000000
+
+
+# The compiled single character table of charSimilarity as a NumPy matrix
+_scsim = np.frombuffer(charSimilarity.scsimArray, dtype=np.float64).reshape(
+    charSimilarity.scsimSize, charSimilarity.scsimSize)
+
+
+def _digraph_entries():
+    """Split the compiled digraph table by the shape of its strings.
+
+    Returns (dg_ch, dg_dg): a list of (digraph, character, similarity) and
+    a list of (digraph, digraph, similarity), each holding both orders of
+    every pair in the table.
+    """
+    size = charSimilarity.dcsimSize
+    dg_ch = []
+    dg_dg = []
+    for str1, k1 in charSimilarity.dcsimIndex.items():
+        for str2, k2 in charSimilarity.dcsimIndex.items():
+            similarity = charSimilarity.dcsimArray[k1*size + k2]
+            if k1 == k2 or similarity == 0:
+                continue # same as the default
+            if len(str1) == 2 and len(str2) == 2:
+                dg_dg.append((str1, str2, similarity))
+            elif len(str1) == 2:
+                dg_ch.append((str1, str2, similarity))
+    return dg_ch, dg_dg
+
+
+def _character_similarity(S, T):
+    """Single character similarity of every s[i] and t[j] in a bucket."""
+    size = charSimilarity.scsimSize
+    S = S[:, :, None]
+    T = T[:, None, :]
+    sim = _scsim[np.minimum(S, size-1), np.minimum(T, size-1)]
+    sim = np.where((S < size) & (T < size), sim, S == T)
+    unicode_pairs = ((S >= size) | (T >= size)) & (S != T) & \
+        (S < _BYTE_CODES) & (T < _BYTE_CODES)
+    if unicode_pairs.any():
+        (S, T) = np.broadcast_arrays(S, T)
+        sim[unicode_pairs] = _unicode_similarity(S[unicode_pairs],
+                                                 T[unicode_pairs])
+    return sim
+
+
+# When both strings of a pair are str, their bytes past ASCII are given
+# codes from _BYTE_CODES up, so that they are only similar to themselves,
+# as in charSimilarity.fastCharacterSimilarity()
+_BYTE_CODES = 0x110000
+
+
+def _pair_codes(s, t):
+    """Character codes of the strings of a pair."""
+    codes = ([ord(ch) for ch in s], [ord(ch) for ch in t])
+    if isinstance(s, str) and isinstance(t, str):
+        codes = tuple([code if code < 128 else _BYTE_CODES + code
+                       for code in st_codes] for st_codes in codes)
+    return codes
+
+
+def _unicode_similarity(codes1, codes2):
+    """Similarity of pairs of different character codes, from the table of
+    unicode_confusables, by binary search of its sorted packed pairs."""
+    table = charSimilarity.unicodeConfusablesTable()
+    keys = np.frombuffer(table.keys, dtype=np.int64)
+    similarities = np.frombuffer(table.similarities, dtype=np.float64)
+    bits = charSimilarity.unicodeCodeBits
+    codes1 = codes1.astype(np.int64)
+    codes2 = codes2.astype(np.int64)
+    wanted = (np.minimum(codes1, codes2) << bits) | np.maximum(codes1, codes2)
+    k = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+    return np.where(keys[k] == wanted, similarities[k], 0.0)
+
+
+def _run_lengths(codes):
+    """Length of the run of identical characters ending at each position."""
+    runs = np.ones(codes.shape, dtype=np.int32)
+    for k in range(1, codes.shape[1]):
+        same = codes[:, k] == codes[:, k-1]
+        runs[:, k] = np.where(same, runs[:, k-1] + 1, 1)
+    return runs
+
+
+def _digraph_mask(codes, digraph):
+    """Positions k >= 1 where codes[:, k-1:k+1] spells digraph."""
+    return (codes[:, :-1] == ord(digraph[0])) & \
+        (codes[:, 1:] == ord(digraph[1]))
+
+
+def _digraph_cost(similarity):
+    """Cost of a 2 for 1, 1 for 2 or 2 for 2 substitution."""
+    cost = 1 - similarity
+    if cost == 1:
+        cost = 2 # substitute TWO characters
+    return cost
+
+
+def _bucket_costs(S, T, entries):
+    """Operation costs for a bucket of pairs of character codes.
+
+    S is (pairs, m) and T is (pairs, n).  Every returned array is
+    (pairs, m, n) and holds, for each cell (i, j) of the cost matrix, the
+    cost of the operation that ends there; operations that do not apply
+    at a cell cost infinity.  These are the rules of
+    strSimilarity.levenshteinCell(), for whole arrays; a change to a cost
+    rule goes in both.
+    """
+    dg_ch, dg_dg = entries
+    B, m = S.shape
+    n = T.shape[1]
+    inf = np.inf
+
+    # substitute s[i] by t[j] - 0 cost if identical
+    subs = 1 - _character_similarity(S, T)
+
+    # substitute s[i-1:i+1] by t[j]
+    subs21 = np.full((B, m, n), inf)
+    subs21[:, 1:, :] = 2
+    for (digraph, ch, similarity) in dg_ch:
+        hit = _digraph_mask(S, digraph)[:, :, None] & \
+            (T == ord(ch))[:, None, :]
+        subs21[:, 1:, :][hit] = _digraph_cost(similarity)
+
+    # substitute s[i] by t[j-1:j+1]
+    subs12 = np.full((B, m, n), inf)
+    subs12[:, :, 1:] = 2
+    for (digraph, ch, similarity) in dg_ch:
+        hit = (S == ord(ch))[:, :, None] & \
+            _digraph_mask(T, digraph)[:, None, :]
+        subs12[:, :, 1:][hit] = _digraph_cost(similarity)
+
+    # substitute s[i-1:i+1] by t[j-1:j+1], and transpose s[i-1] and s[i]
+    subs22 = np.full((B, m, n), inf)
+    transp = np.full((B, m, n), inf)
+    if m > 1 and n > 1:
+        same = (S[:, :-1, None] == T[:, None, :-1]) & \
+            (S[:, 1:, None] == T[:, None, 1:])
+        subs22[:, 1:, 1:] = np.where(same, 0, 2)
+        for (digraph1, digraph2, similarity) in dg_dg:
+            hit = _digraph_mask(S, digraph1)[:, :, None] & \
+                _digraph_mask(T, digraph2)[:, None, :]
+            subs22[:, 1:, 1:][hit] = _digraph_cost(similarity)
+
+        swapped = (S[:, :-1, None] == T[:, None, 1:]) & \
+            (S[:, 1:, None] == T[:, None, :-1])
+        transp[:, 1:, 1:] = np.where(swapped, subs[:, 1:, 1:], inf)
+
+    # insert or delete after a repetition; see strSimilarity.repetitionInsert
+    runs_s = _run_lengths(S)
+    runs_t = _run_lengths(T)
+    rep_ins = np.full((B, m, n), inf)
+    if m > 1 and n > 2:
+        ok = (runs_s[:, 1:, None] >= 2) & (runs_t[:, None, 2:] >= 3) & \
+            (S[:, 1:, None] == T[:, None, 2:])
+        back = np.minimum(runs_s[:, 1:, None], runs_t[:, None, 1:-1])
+        rep_ins[:, 1:, 2:] = np.where(ok, np.maximum(0, 1.7 - 0.4*back), inf)
+    rep_del = np.full((B, m, n), inf)
+    if m > 2 and n > 1:
+        ok = (runs_t[:, None, 1:] >= 2) & (runs_s[:, 2:, None] >= 3) & \
+            (S[:, 2:, None] == T[:, None, 1:])
+        back = np.minimum(runs_t[:, None, 1:], runs_s[:, 1:-1, None])
+        rep_del[:, 2:, 1:] = np.where(ok, np.maximum(0, 1.7 - 0.4*back), inf)
+
+    return subs, subs21, subs12, subs22, transp, rep_ins, rep_del
+
+
+def _levenshtein_bucket(S, T, entries):
+    """Distances for a bucket of pairs of character codes."""
+    B, m = S.shape
+    n = T.shape[1]
+    if m == 0 or n == 0:
+        return np.full(B, float(max(m, n)))
+
+    subs, subs21, subs12, subs22, transp, rep_ins, rep_del = \
+        _bucket_costs(S, T, entries)
+    ins = np.minimum(1, rep_ins)
+    dels = np.minimum(1, rep_del)
+    subs22 = np.minimum(subs22, transp)
+
+    # CAUTION: HARDCODED INSERTION COST FOR EACH LOCATION
+    # Digraph operations in the first row or column read row or column -1
+    # (that is, the last one) before it is filled.  They cost infinity
+    # there, so starting from zeros keeps those sums infinite, not NaN.
+    d = np.zeros((B, m+1, n+1))
+    d[:, 0, :] = np.arange(n+1)
+    d[:, :, 0] = np.arange(m+1)
+
+    # Cell (I, J) depends on cells up to two rows and two columns back,
+    # all of which lie on earlier anti-diagonals I+J.
+    for k in range(2, m+n+1):
+        I = np.arange(max(1, k-n), min(m, k-1)+1)
+        J = k - I
+        i = I - 1
+        j = J - 1
+        best = d[:, I-1, J] + dels[:, i, j]
+        best = np.minimum(best, d[:, I, J-1] + ins[:, i, j])
+        best = np.minimum(best, d[:, I-1, J-1] + subs[:, i, j])
+        best = np.minimum(best, d[:, I-2, J-1] + subs21[:, i, j])
+        best = np.minimum(best, d[:, I-1, J-2] + subs12[:, i, j])
+        best = np.minimum(best, d[:, I-2, J-2] + subs22[:, i, j])
+        d[:, I, J] = best
+    return d[:, m, n]
+
+
+def levenshtein_many(pairs):
+    """Find the Levenshtein (edit) distance of many pairs of strings.
+
+    Returns a float64 array with one distance per (s, t) pair, equal to
+    strSimilarity.levenshtein(s, t).
+    """
+    pairs = [(s.lower(), t.lower()) for (s, t) in pairs]
+    dist = np.empty(len(pairs), dtype=np.float64)
+
+    entries = _digraph_entries()
+
+    buckets = {}
+    for k, (s, t) in enumerate(pairs):
+        buckets.setdefault((len(s), len(t)), []).append(k)
+
+    for (m, n), members in buckets.items():
+        chunk = max(1, MAX_CELLS_PER_CHUNK // ((m+1)*(n+1)))
+        for start in range(0, len(members), chunk):
+            rows = members[start:start+chunk]
+            codes = [_pair_codes(*pairs[k]) for k in rows]
+            S = np.array([s for (s, t) in codes],
+                         dtype=np.int32).reshape(len(rows), m)
+            T = np.array([t for (s, t) in codes],
+                         dtype=np.int32).reshape(len(rows), n)
+            dist[rows] = _levenshtein_bucket(S, T, entries)
+    return dist
+
+
+def howConfusableAre_many(pairs):
+    """Rate the visible similarity of many pairs of strings.
+
+    Returns a float64 array with one score per (str1, str2) pair, equal to
+    strSimilarity.howConfusableAre(str1, str2)."""
+    pairs = list(pairs)
+    levDist = levenshtein_many(pairs)
+    len1 = np.array([len(str1) for (str1, str2) in pairs], dtype=np.float64)
+    len2 = np.array([len(str2) for (str1, str2) in pairs], dtype=np.float64)
+    maxlen = np.maximum(len1, len2)
+    lendiff = np.abs(len1 - len2)
+
+    score = np.ones(len(pairs), dtype=np.float64) # null strings are identical
+    nonnull = maxlen > 0
+    maxlen = maxlen[nonnull]
+    lendiff = lendiff[nonnull]
+    levDist = levDist[nonnull]
+    score[nonnull] = \
+        (maxlen - levDist)/(maxlen + 3*levDist + lendiff*levDist)
+    assert(np.all((0 <= score) & (score <= 1)))
+    return score
+
+
+def levenshtein_many_selftest():
+    """Check the batched functions against the scalar ones."""
+    print('    running self test for levenshtein_many() ...')
+    pairs = [(str1, str2) for (str1, str2, _) in
+             strSimilarity.levenshteinTestCases +
+             strSimilarity.howConfusableAreTestCases]
+    pairs += strSimilarity.fuzzedPairs(100)
+    pairs += [(str2, str1) for (str1, str2) in pairs]
+
+    distances = levenshtein_many(pairs)
+    scores = howConfusableAre_many(pairs)
+    for (str1, str2), distance, score in zip(pairs, distances, scores):
+        expected = strSimilarity.levenshtein(str1, str2)
+        if not strSimilarity.fEqual(distance, expected):
+            print('levenshtein_many failed built-in test for %r and %r.'
+                  % (str1, str2))
+            print('    It returned %r instead of %r.' % (distance, expected))
+        expected = strSimilarity.howConfusableAre(str1, str2)
+        if not strSimilarity.fEqual(score, expected):
+            print('howConfusableAre_many failed built-in test for %r and %r.'
+                  % (str1, str2))
+            print('    It returned %r instead of %r.' % (score, expected))
+    print('    self test for levenshtein_many() done.')
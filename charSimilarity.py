@@ -43,6 +43,9 @@ versionMod=' *modified "Thu May 15 14:13:04 2008" *by "Paul E. Black"'
 #
 #----------------------------------------------------------------------------
 
+import array
+from bisect import bisect_left
+
 # Even though similarity is symmetric, the tables only have one of the pairs.
 # That is, the tables don't have both X Y and Y X.
 
@@ -139,6 +142,119 @@ for (str1, str2) in dcsimtab.keys():
         dcsimtab[(str1.lower(), str2.lower())] = dcsimtab[(str1, str2)]
 
 
+#------------------------------------------------------------------------------
+# compile the similarity tables
+#
+# characterSimilarity() and digraphSimilarity() check their arguments and
+# look each pair up in both orders on every call.  The edit distance inner
+# loop calls them for every cell, so it uses the compiled tables below
+# through fastCharacterSimilarity() and fastDigraphSimilarity() instead.
+# Only lower case entries are compiled; upper case ones can never match.
+#------------------------------------------------------------------------------
+
+# scsimArray is a symmetric scsimSize x scsimSize matrix, stored row by
+# row, of the similarity of characters by character code.  Characters with
+# larger codes are only similar to themselves.
+scsimSize = 128
+for (ch1, ch2) in scsimtab.keys():
+    if not ch1.isupper() and not ch2.isupper():
+        scsimSize = max(scsimSize, ord(ch1)+1, ord(ch2)+1)
+
+def compileSimilarityTable(table, index, size):
+    """Return a size x size array of table similarities, stored row by row.
+
+    index maps the strings in the table to row and column numbers.  The
+    entries are written in the same order characterSimilarity() and
+    digraphSimilarity() look them up, so the result agrees with them even
+    if the table has both orders of a pair."""
+    matrix = array.array('d', [0.0]) * (size*size)
+    for k in xrange(size):
+        matrix[k*size + k] = 1.0
+    entries = [(str1, str2, similarity)
+               for ((str1, str2), similarity) in table.items()
+               if str1 in index and str2 in index]
+    for (str1, str2, similarity) in entries:
+        matrix[index[str2]*size + index[str1]] = similarity
+    for (str1, str2, similarity) in entries:
+        matrix[index[str1]*size + index[str2]] = similarity
+    return matrix
+
+scsimArray = compileSimilarityTable(scsimtab,
+    dict((ch, ord(ch)) for key in scsimtab for ch in key if not ch.isupper()),
+    scsimSize)
+
+# dcsimIndex numbers every lower case string in the digraph table, and
+# dcsimArray is the symmetric dcsimSize x dcsimSize matrix, stored row by
+# row, of their similarities.  Strings that are not in dcsimIndex are only
+# similar to themselves.
+dcsimIndex = {}
+for (str1, str2) in sorted(dcsimtab.keys()):
+    for st in (str1, str2):
+        if st == st.lower() and st not in dcsimIndex:
+            dcsimIndex[st] = len(dcsimIndex)
+dcsimSize = len(dcsimIndex)
+dcsimArray = compileSimilarityTable(dcsimtab, dcsimIndex, dcsimSize)
+
+# Unicode characters past scsimSize are looked up in the table of
+# unicode_confusables, read from its data file the first time one is
+# compared with a different character.  fastCharacterSimilarity() searches
+# its arrays itself, saving two calls per lookup.
+unicodeConfusables = None
+unicodeKeys = unicodeSimilarities = None
+unicodeCodeBits = 21
+
+def unicodeConfusablesTable():
+    """Return the unicode_confusables.ConfusablesTable, loading it once."""
+    global unicodeConfusables, unicodeKeys, unicodeSimilarities
+    if unicodeConfusables is None:
+        import unicode_confusables
+        table = unicode_confusables.loadConfusables()
+        assert(unicode_confusables.CODE_BITS == unicodeCodeBits)
+        (unicodeKeys, unicodeSimilarities) = (table.keys, table.similarities)
+        unicodeConfusables = table
+    return unicodeConfusables
+
+def unicodeSimilarity(c1, c2):
+    """Rate the similarity of two different character codes."""
+    return unicodeConfusablesTable().similarity(c1, c2)
+
+def fastCharacterSimilarity(ch1, ch2):
+    """Rate the similarity of two lower case characters.
+
+    Same as characterSimilarity(), without argument checks."""
+    c1 = ord(ch1)
+    c2 = ord(ch2)
+    if c1 < scsimSize and c2 < scsimSize:
+        return scsimArray[c1*scsimSize + c2]
+    if c1 == c2:
+        return 1.0
+    if type(ch1) is str and type(ch2) is str:
+        return 0.0 # bytes of some encoding, not characters
+    if unicodeKeys is None:
+        unicodeConfusablesTable()
+    if c1 < c2:
+        key = (c1 << unicodeCodeBits) | c2
+    else:
+        key = (c2 << unicodeCodeBits) | c1
+    k = bisect_left(unicodeKeys, key)
+    if k < len(unicodeKeys) and unicodeKeys[k] == key:
+        return unicodeSimilarities[k]
+    return 0.0
+
+def fastDigraphSimilarity(dg1, dg2):
+    """Rate the similarity of lower case digraphs and characters.
+
+    Same as digraphSimilarity(), without argument checks or lower casing."""
+    k1 = dcsimIndex.get(dg1)
+    if k1 is not None:
+        k2 = dcsimIndex.get(dg2)
+        if k2 is not None:
+            return dcsimArray[k1*dcsimSize + k2]
+    if dg1 == dg2:
+        return 1.0
+    return 0.0
+
+
 #------------------------------------------------------------------------------
 # how similar are two characters
 #------------------------------------------------------------------------------
@@ -163,6 +279,10 @@ def characterSimilarity(ch1, ch2):
 	# character pair not in table, use default
 	if ch1 == ch2:
 	    similarity = 1
+	elif max(ord(ch1), ord(ch2)) >= scsimSize and \
+			(isinstance(ch1, unicode) or isinstance(ch2, unicode)):
+	    # Unicode lookalikes, like Cyrillic a for a
+	    similarity = unicodeSimilarity(ord(ch1), ord(ch2))
 	else:
 	    similarity = 0
 
@@ -177,6 +297,14 @@ def characterSimilarity_chkSym(str1, str2):
 				str1, 'and', str2 + '.'
 	print '    It returned', resultScore, 'one way, and', \
 				reverseScore, 'the other.'
+    # the compiled table must agree both ways
+    for (ch1, ch2) in [(str1, str2), (str2, str1)]:
+	compiledScore = fastCharacterSimilarity(ch1, ch2)
+	if compiledScore != characterSimilarity(ch1, ch2):
+	    print 'fastCharacterSimilarity failed built-in test for', \
+				ch1, 'and', ch2 + '.'
+	    print '    It returned', compiledScore, 'instead of', \
+				str(characterSimilarity(ch1, ch2)) + '.'
     return resultScore
 
 def characterSimilarity_chkPair(str1, str2, expectedScore):
@@ -204,6 +332,13 @@ def characterSimilarity_selftest():
 	    print 'inconsistency in single char similarity table (scsimtab):'
 	    print ' ('+ch1+', '+ch2+') present, but not ('\
 				+ch1.lower()+', '+ch2.lower()+')'
+    # the compiled table must be symmetric
+    for code1 in xrange(scsimSize):
+	for code2 in xrange(code1):
+	    if scsimArray[code1*scsimSize + code2] != \
+				scsimArray[code2*scsimSize + code1]:
+		print 'inconsistency in compiled single char table (scsimArray):'
+		print ' codes', code1, 'and', code2, 'are not symmetric'
 
     #--------------------------------------------------------------------------
     # some pairs of characters
@@ -221,6 +356,12 @@ def characterSimilarity_selftest():
     characterSimilarity_chkPair('u', 'v', .1)
     characterSimilarity_chkPair('v', 'x', .1)
     characterSimilarity_chkPair('v', 'y', .2)
+    # Unicode lookalikes (Cyrillic a, fullwidth a, Greek omicron)
+    characterSimilarity_chkPair(u'\u0430', 'a', 1)
+    characterSimilarity_chkPair(u'\uff41', u'\u0430', .9)
+    characterSimilarity_chkPair(u'\u03bf', '0', .9)
+    characterSimilarity_chkPair(u'\u0430', 'b', 0)
+    characterSimilarity_chkPair('\xe9', 'e', 0) # a byte, not a character
 
     #--------------------------------------------------------------------------
     print '    try all pairs of single characters'
@@ -282,6 +423,14 @@ def digraphSimilarity_chkSym(str1, str2):
 				str1, 'and', str2 + '.'
 	print '    It returned', resultScore, 'one way, and', \
 				reverseScore, 'the other.'
+    # the compiled table must agree both ways
+    for (dg1, dg2) in [(str1, str2), (str2, str1)]:
+	compiledScore = fastDigraphSimilarity(dg1.lower(), dg2.lower())
+	if compiledScore != digraphSimilarity(dg1, dg2):
+	    print 'fastDigraphSimilarity failed built-in test for', \
+				dg1, 'and', dg2 + '.'
+	    print '    It returned', compiledScore, 'instead of', \
+				str(digraphSimilarity(dg1, dg2)) + '.'
     return resultScore
 
 def digraphSimilarity_chkPair(str1, str2, expectedScore):
@@ -309,6 +458,11 @@ def digraphSimilarity_selftest():
 	    print 'inconsistency in digraph similarity table (dcsimtab):'
 	    print ' ('+str1+', '+str2+') present, but not ('\
 				+str1.lower()+', '+str2.lower()+')'
+	# every lower case string in the table must be compiled
+	for st in (str1, str2):
+	    if st == st.lower() and st not in dcsimIndex:
+		print 'inconsistency in compiled digraph table (dcsimIndex):'
+		print ' '+st+' is in dcsimtab, but not in dcsimIndex'
 
     #--------------------------------------------------------------------------
     # some pairs
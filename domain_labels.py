@@ -0,0 +1,165 @@
+"""Split domain names into labels, and score their registrable labels.
+
+A spoofed domain mostly copies the public suffix of the name it imitates
+(com, co.uk) and changes the label registered under it: paypa1.com,
+rnicrosoft.co.uk.  splitDomain() splits a name into its subdomain labels,
+that registrable label and its public suffix, and howConfusableAreDomains()
+scores a pair of names both as a whole, with
+strSimilarity.howConfusableAre(), and by their registrable labels alone,
+which a long shared subdomain or suffix cannot inflate.  When the two
+public suffixes are the same, the whole names are scored without them:
+paypal.com and example.com would otherwise score higher than paypal and
+example for the .com they share.
+
+The public suffixes are a small offline list of the multi-label ones in
+common use; any other name is taken to end in a one-label suffix, its
+top-level domain.  It is not the full Public Suffix List, so private
+suffixes like blogspot.com count as registrable labels.
+"""
+import strSimilarity
+
+# multi-label public suffixes; one-label ones are every top-level domain
+PUBLIC_SUFFIXES = frozenset("""
+    ac.uk co.uk gov.uk ltd.uk me.uk net.uk nhs.uk org.uk plc.uk sch.uk
+    com.au edu.au gov.au net.au org.au asn.au id.au
+    co.nz govt.nz net.nz org.nz ac.nz
+    co.jp ne.jp or.jp ac.jp go.jp
+    co.kr or.kr ac.kr go.kr
+    com.br net.br org.br gov.br
+    com.cn net.cn org.cn gov.cn edu.cn
+    com.hk org.hk net.hk edu.hk gov.hk
+    com.tw org.tw net.tw edu.tw gov.tw
+    com.sg org.sg net.sg edu.sg gov.sg
+    co.in net.in org.in gen.in firm.in ind.in ac.in gov.in
+    co.id or.id ac.id go.id web.id
+    co.il org.il ac.il gov.il
+    co.za org.za gov.za ac.za
+    com.mx org.mx gob.mx net.mx
+    com.ar gob.ar net.ar org.ar
+    com.tr org.tr net.tr gov.tr edu.tr
+    com.ru org.ru net.ru
+    com.ua org.ua net.ua gov.ua
+    com.pl net.pl org.pl
+    co.th ac.th go.th in.th or.th
+    com.my org.my net.my gov.my edu.my
+    com.ph org.ph net.ph gov.ph edu.ph
+    com.vn net.vn org.vn gov.vn edu.vn
+    com.pk org.pk net.pk gov.pk edu.pk
+    com.eg org.eg gov.eg edu.eg
+    com.sa org.sa net.sa gov.sa edu.sa
+    co.ke or.ke ac.ke go.ke
+    com.ng org.ng gov.ng edu.ng
+    com.co net.co org.co
+    com.pe org.pe gob.pe
+    com.ve org.ve
+    """.split())
+
+# labels in the longest suffix of PUBLIC_SUFFIXES
+_maxSuffixLabels = max(len(suffix.split('.')) for suffix in PUBLIC_SUFFIXES)
+
+
+def splitDomain(name):
+    """Return (subdomain labels, registrable label, public suffix) of name.
+
+    The labels keep their case, and a trailing dot is dropped.  A name of
+    one label is its registrable label, with no suffix, and a name that is
+    all public suffix, like co.uk, has an empty registrable label."""
+    labels = name.rstrip('.').split('.')
+    if len(labels) == 1:
+        return ((), labels[0], '')
+    lower = [label.lower() for label in labels]
+    size = 1
+    for n in range(min(_maxSuffixLabels, len(labels)), 1, -1):
+        if '.'.join(lower[-n:]) in PUBLIC_SUFFIXES:
+            size = n
+            break
+    suffix = '.'.join(labels[-size:])
+    if size == len(labels):
+        return ((), '', suffix)
+    return (tuple(labels[:-size-1]), labels[-size-1], suffix)
+
+
+def registrableLabel(name):
+    """The label of name registered under its public suffix."""
+    return splitDomain(name)[1]
+
+
+def withoutSuffix(name):
+    """name without its public suffix and the dot before it."""
+    (subdomains, label, _) = splitDomain(name)
+    return '.'.join(subdomains + (label,))
+
+
+def howConfusableAreDomains(name1, name2, min_score=None):
+    """Return (score, labelScore, sameSuffix) for two domain names.
+
+    sameSuffix is True if their public suffixes are the same apart from
+    case.  score is howConfusableAre(name1, name2, min_score), of the
+    names without their suffixes if sameSuffix, and labelScore
+    howConfusableAre() of their registrable labels, with the same
+    min_score."""
+    (_, label1, suffix1) = splitDomain(name1)
+    (_, label2, suffix2) = splitDomain(name2)
+    sameSuffix = suffix1.lower() == suffix2.lower()
+    if sameSuffix:
+        (name1, name2) = (withoutSuffix(name1), withoutSuffix(name2))
+    score = strSimilarity.howConfusableAre(name1, name2, min_score=min_score)
+    labelScore = strSimilarity.howConfusableAre(label1, label2,
+                                                min_score=min_score)
+    return (score, labelScore, sameSuffix)
+
+
+# (name, expected splitDomain(name)) for domainLabels_selftest()
+splitDomainTestCases = [
+    ('', ((), '', '')),
+    ('localhost', ((), 'localhost', '')),
+    ('paypal.com', ((), 'paypal', 'com')),
+    ('paypal.com.', ((), 'paypal', 'com')),
+    ('www.PayPal.com', (('www',), 'PayPal', 'com')),
+    ('a.b.bbc.co.uk', (('a', 'b'), 'bbc', 'co.uk')),
+    ('bbc.CO.UK', ((), 'bbc', 'CO.UK')),
+    ('co.uk', ((), '', 'co.uk')),
+    ('uk', ((), 'uk', '')),
+    ('login.microsoftonline.com.au', (('login',), 'microsoftonline',
+                                      'com.au')),
+    ('example.au', ((), 'example', 'au')),
+]
+
+
+# (name1, name2, min_score, expected howConfusableAreDomains(name1, name2,
+# min_score)) for domainLabels_selftest()
+domainScoreTestCases = [
+    ('paypal.com', 'paypa1.com', None, (1.0, 1.0, True)),
+    ('secure-login.paypal.com', 'secure-login.paypa1.com', None,
+     (1.0, 1.0, True)),
+    ('rnicrosoft.co.uk', 'microsoft.co.uk', .9, (1.0, 1.0, True)),
+    # different suffixes are scored too
+    ('microsoft.com', 'microsoft.co.uk', None, (.4, 1.0, False)),
+    ('microsoft.com', 'microsoft.co.uk', .5, (0.0, 1.0, False)),
+    ('svchost', 'svch0st.exe', None, (.1738, .9452, False)),
+    # the shared suffix is left out of score, whatever its case
+    ('Google.COM', 'g00gle.com', None, (.8788, .8788, True)),
+    ('paypal.com', 'example.com', None, (.0741, .0741, True)),
+    ('paypal.com', 'example.com', .5, (0.0, 0.0, True)),
+    ('www.paypal.com', 'paypal.com', None, (.1579, 1.0, True)),
+    ('co.uk', 'co.uk', None, (1, 1, True)),
+]
+
+
+def domainLabels_selftest():
+    """Check splitDomain() and howConfusableAreDomains()."""
+    print('    running self test for domain labels ...')
+    for (name, expected) in splitDomainTestCases:
+        result = splitDomain(name)
+        if result != expected:
+            print('splitDomain failed built-in test for %r.' % (name,))
+            print('    It returned %r instead of %r.' % (result, expected))
+    for (name1, name2, min_score, expected) in domainScoreTestCases:
+        result = howConfusableAreDomains(name1, name2, min_score)
+        if result[2] != expected[2] or \
+                not strSimilarity.closeEnough(result[0], expected[0]) or \
+                not strSimilarity.closeEnough(result[1], expected[1]):
+            print('howConfusableAreDomains failed built-in test for %r and '
+                  '%r with min_score %r.' % (name1, name2, min_score))
+            print('    It returned %r instead of %r.' % (result, expected))
+    print('    self test for domain labels done.')
@@ -0,0 +1,346 @@
+"""Nearest neighbour search over embeddings of watchlist names.
+
+An index is a directory holding the embeddings of the watchlist names, as
+returned by encoder.Encoder.embed(), in a memory-mapped float32 or float16
+matrix, with their names and squared norms.  search() finds the k nearest
+names of each query exactly, a block of the matrix at a time, with NumPy
+matrix products.  If the index was built with nlist > 0, the embeddings are
+also clustered with k-means into nlist inverted lists (IVF), stored one
+after the other in the matrix, and search_ivf() only compares each query
+with the names in its nprobe nearest lists.  That is approximate;
+measure() gives recall@k against exact search and queries per second.
+
+Distances are the siamese model's, sqrt(squared distance + offset), where
+offset is encoder.Encoder.offset.  The offset does not change the order.
+"""
+from __future__ import with_statement
+
+import argparse
+import cPickle as pickle
+import json
+import os
+import time
+
+import numpy as np
+
+META_FILE = 'meta.json'
+NAMES_FILE = 'names.pkl'
+IDS_FILE = 'ids.npy'
+NORMS_FILE = 'norms.npy'
+CENTROIDS_FILE = 'centroids.npy'
+LISTS_FILE = 'lists.npy'
+VECTOR_FILES = {'float32': 'vectors.f32', 'float16': 'vectors.f16'}
+
+# Rows of the matrix compared with a block of queries at once, and the
+# size of that block of queries.  Together they bound the size of the
+# distance block to BLOCK_ROWS * QUERY_BLOCK floats.
+BLOCK_ROWS = 32768
+QUERY_BLOCK = 256
+
+
+def _top_k(dist, ids, k):
+    """The k smallest dist in each row, with their ids, unsorted."""
+    if dist.shape[1] > k:
+        part = np.argpartition(dist, k-1, axis=1)[:, :k]
+        rows = np.arange(len(dist))[:, None]
+        return dist[rows, part], ids[rows, part]
+    return dist, ids
+
+
+def _sorted(dist, ids):
+    """Sort each row by distance."""
+    order = np.argsort(dist, axis=1, kind='mergesort')
+    rows = np.arange(len(dist))[:, None]
+    return dist[rows, order], ids[rows, order]
+
+
+def _nearest(X, centroids):
+    """Index of the nearest centroid for each row of X."""
+    norms = np.sum(np.square(centroids), axis=1)
+    nearest = np.empty(len(X), dtype=np.int64)
+    for start in range(0, len(X), BLOCK_ROWS):
+        block = np.asarray(X[start:start+BLOCK_ROWS], dtype=np.float32)
+        dist = norms - 2*block.dot(centroids.T)
+        nearest[start:start+len(block)] = np.argmin(dist, axis=1)
+    return nearest
+
+
+def kmeans(X, nlist, iterations=20, sample=None, seed=0):
+    """Return nlist centroids of the rows of X, from Lloyd's algorithm.
+
+    The centroids are fitted on up to sample random rows of X (all of
+    them if sample is None).  Empty clusters restart at a random row.
+    """
+    rng = np.random.RandomState(seed)
+    if sample is not None and sample < len(X):
+        X = X[np.sort(rng.choice(len(X), sample, replace=False))]
+    X = np.asarray(X, dtype=np.float32)
+    centroids = X[rng.choice(len(X), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        nearest = _nearest(X, centroids)
+        counts = np.bincount(nearest, minlength=nlist)
+        for dim in range(X.shape[1]):
+            sums = np.bincount(nearest, weights=X[:, dim], minlength=nlist)
+            centroids[counts > 0, dim] = sums[counts > 0] / counts[counts > 0]
+        empty = np.flatnonzero(counts == 0)
+        centroids[empty] = X[rng.choice(len(X), len(empty))]
+    return centroids
+
+
+def build_index(directory, names, embeddings, dtype='float32', offset=0.0,
+                nlist=0, iterations=20, sample=100000, seed=0):
+    """Write an index of names and their embeddings to directory.
+
+    dtype is 'float32' or 'float16', the type of the stored matrix.  With
+    nlist > 0, the embeddings are clustered for search_ivf().
+    """
+    if dtype not in VECTOR_FILES:
+        raise ValueError('Unknown index dtype: %s' % (dtype,))
+    names = list(names)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if len(names) != len(embeddings):
+        raise ValueError('%d names but %d embeddings'
+                         % (len(names), len(embeddings)))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # store the embeddings one inverted list after the other
+    ids = np.arange(len(names))
+    if nlist:
+        centroids = kmeans(embeddings, nlist, iterations, sample, seed)
+        nearest = _nearest(embeddings, centroids)
+        ids = np.argsort(nearest, kind='mergesort')
+        lists = np.concatenate(
+            [[0], np.cumsum(np.bincount(nearest, minlength=nlist))])
+        np.save(os.path.join(directory, CENTROIDS_FILE), centroids)
+        np.save(os.path.join(directory, LISTS_FILE), lists)
+
+    vectors = embeddings[ids].astype(dtype)
+    with open(os.path.join(directory, VECTOR_FILES[dtype]), 'wb') as f:
+        f.write(vectors.tobytes())
+    norms = np.sum(np.square(vectors.astype(np.float32)), axis=1)
+    np.save(os.path.join(directory, NORMS_FILE), norms)
+    np.save(os.path.join(directory, IDS_FILE), ids)
+    with open(os.path.join(directory, NAMES_FILE), 'wb') as f:
+        pickle.dump(names, f, pickle.HIGHEST_PROTOCOL)
+    with open(os.path.join(directory, META_FILE), 'w') as f:
+        json.dump({'count': len(names), 'dim': embeddings.shape[1],
+                   'dtype': dtype, 'offset': offset, 'nlist': nlist}, f)
+    return EmbeddingIndex(directory)
+
+
+class EmbeddingIndex(object):
+    """A memory-mapped index written by build_index()."""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        self.directory = directory
+        self.count = meta['count']
+        self.dim = meta['dim']
+        self.dtype = meta['dtype']
+        self.offset = meta['offset']
+        self.nlist = meta['nlist']
+        self.vectors = np.memmap(
+            os.path.join(directory, VECTOR_FILES[self.dtype]),
+            dtype=self.dtype, mode='r', shape=(self.count, self.dim))
+        self.norms = np.load(os.path.join(directory, NORMS_FILE))
+        self.ids = np.load(os.path.join(directory, IDS_FILE))
+        self.centroids = None
+        self.lists = None
+        if self.nlist:
+            self.centroids = np.load(os.path.join(directory, CENTROIDS_FILE))
+            self.lists = np.load(os.path.join(directory, LISTS_FILE))
+        self._names = None
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def names(self):
+        """The watchlist names, in the order they were given."""
+        if self._names is None:
+            with open(os.path.join(self.directory, NAMES_FILE), 'rb') as f:
+                self._names = pickle.load(f)
+        return self._names
+
+    def _finish(self, dist, positions, k):
+        """Sort, pad to k, and turn positions and squared distances into
+        name indices and distances."""
+        dist, positions = _sorted(dist, positions)
+        missing = k - dist.shape[1]
+        if missing > 0:
+            dist = np.hstack([dist, np.full((len(dist), missing), np.inf,
+                                            dtype=np.float32)])
+            positions = np.hstack([positions, np.full(
+                (len(dist), missing), -1, dtype=np.int64)])
+        indices = np.where(positions >= 0, self.ids[positions], -1)
+        distances = np.sqrt(np.maximum(dist, 0) + self.offset)
+        return indices, distances.astype(np.float32)
+
+    def search(self, queries, k=10):
+        """Exact k nearest names of each query.
+
+        Returns (indices, distances), two (queries, k) arrays, nearest
+        first.  indices are positions in names; if there are fewer than k
+        names, the rest are -1 with an infinite distance.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        for qstart in range(0, len(queries), QUERY_BLOCK):
+            qblock = queries[qstart:qstart+QUERY_BLOCK]
+            qnorms = np.sum(np.square(qblock), axis=1)[:, None]
+            best = np.zeros((len(qblock), 0), dtype=np.float32)
+            best_pos = np.zeros((len(qblock), 0), dtype=np.int64)
+            for start in range(0, self.count, BLOCK_ROWS):
+                block = np.asarray(self.vectors[start:start+BLOCK_ROWS],
+                                   dtype=np.float32)
+                dist = qnorms - 2*qblock.dot(block.T) + \
+                    self.norms[start:start+len(block)]
+                pos = np.broadcast_to(
+                    np.arange(start, start+len(block)), dist.shape)
+                best, best_pos = _top_k(np.hstack([best, dist]),
+                                        np.hstack([best_pos, pos]), k)
+            (indices[qstart:qstart+len(qblock)],
+             distances[qstart:qstart+len(qblock)]) = \
+                self._finish(best, best_pos, k)
+        return indices, distances
+
+    def search_ivf(self, queries, k=10, nprobe=8):
+        """Approximate k nearest names, from the nprobe nearest lists.
+
+        Returns (indices, distances) like search()."""
+        if not self.nlist:
+            raise ValueError('Index was built without inverted lists')
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        nprobe = min(nprobe, self.nlist)
+        cnorms = np.sum(np.square(self.centroids), axis=1)
+        probes = np.argpartition(cnorms - 2*queries.dot(self.centroids.T),
+                                 nprobe-1, axis=1)[:, :nprobe]
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        for q, query in enumerate(queries):
+            # each list is a contiguous run of rows of the matrix
+            runs = [(self.lists[l], self.lists[l+1]) for l in np.sort(probes[q])]
+            positions = np.concatenate([np.arange(a, b) for (a, b) in runs])
+            block = np.concatenate([self.vectors[a:b] for (a, b) in runs])
+            block = block.astype(np.float32, copy=False)
+            dist = np.dot(query, query) - 2*block.dot(query) + \
+                self.norms[positions]
+            best, best_pos = _top_k(dist[None, :], positions[None, :], k)
+            indices[q:q+1], distances[q:q+1] = self._finish(best, best_pos, k)
+        return indices, distances
+
+
+def measure(index, queries, k=10, nprobes=(1, 4, 16, 64)):
+    """Measure recall@k of search_ivf() against search(), and their speed.
+
+    Returns a list of dicts, one for exact search and one for each nprobe,
+    with the fraction of the exact k nearest names found ('recall') and
+    the queries per second ('qps').
+    """
+    start = time.time()
+    (exact, _) = index.search(queries, k)
+    results = [{'mode': 'exact', 'nprobe': None, 'recall': 1.0,
+                'qps': len(queries) / (time.time() - start)}]
+    if index.nlist:
+        for nprobe in nprobes:
+            start = time.time()
+            (found, _) = index.search_ivf(queries, k, nprobe)
+            seconds = time.time() - start
+            hits = sum(len(set(a) & set(b)) for (a, b) in zip(exact, found))
+            results.append({'mode': 'ivf', 'nprobe': nprobe,
+                            'recall': float(hits) / exact.size,
+                            'qps': len(queries) / seconds})
+    return results
+
+
+def embedding_index_selftest():
+    """Check both searches against a brute-force sort."""
+    import shutil
+    import tempfile
+
+    print('    running self test for EmbeddingIndex ...')
+    rng = np.random.RandomState(0)
+    embeddings = rng.randn(1000, 32).astype(np.float32)
+    names = ['name%d' % (n,) for n in range(len(embeddings))]
+    queries = rng.randn(20, 32).astype(np.float32)
+    expected = np.argsort(
+        np.sum(np.square(embeddings[None] - queries[:, None]), axis=2),
+        axis=1, kind='mergesort')
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for (dtype, nlist) in [('float32', 0), ('float32', 16), ('float16', 16)]:
+            directory = os.path.join(tmp_dir, '%s_%d' % (dtype, nlist))
+            index = build_index(directory, names, embeddings, dtype,
+                                offset=1e-4, nlist=nlist)
+            index = EmbeddingIndex(directory)
+            (found, dist) = index.search(queries, 5)
+            if dtype == 'float32' and not np.array_equal(found,
+                                                         expected[:, :5]):
+                print('EmbeddingIndex.search failed built-in test.')
+            if dtype == 'float16' and np.mean(found == expected[:, :5]) < .9:
+                print('EmbeddingIndex.search failed built-in test for '
+                      'float16.')
+            if np.any(np.diff(dist, axis=1) < 0):
+                print('EmbeddingIndex.search did not sort its results.')
+            if nlist:
+                (found_ivf, _) = index.search_ivf(queries, 5, nlist)
+                if not np.array_equal(found_ivf, found):
+                    print('EmbeddingIndex.search_ivf failed built-in test '
+                          'when probing every list.')
+        (found, dist) = index.search(queries[:1], 2000)
+        if found[0, 1000] != -1 or not np.isinf(dist[0, -1]):
+            print('EmbeddingIndex.search did not pad missing results.')
+    finally:
+        shutil.rmtree(tmp_dir)
+    print('    self test for EmbeddingIndex done.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build an embedding index and measure recall and speed.')
+    parser.add_argument('directory', help='where to write the index')
+    parser.add_argument('--embeddings', help='.npy file of watchlist '
+                        'embeddings (default: random clustered vectors)')
+    parser.add_argument('--queries', help='.npy file of query embeddings '
+                        '(default: perturbed watchlist embeddings)')
+    parser.add_argument('--count', type=int, default=1000000,
+                        help='number of random embeddings')
+    parser.add_argument('--nqueries', type=int, default=1000)
+    parser.add_argument('--dtype', choices=sorted(VECTOR_FILES),
+                        default='float32')
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    if args.embeddings:
+        embeddings = np.load(args.embeddings, mmap_mode='r')
+    else:
+        centers = rng.randn(args.count // 100 + 1, 32).astype(np.float32)
+        embeddings = centers[rng.randint(len(centers), size=args.count)] + \
+            0.3*rng.randn(args.count, 32).astype(np.float32)
+    if args.queries:
+        queries = np.load(args.queries)
+    else:
+        picks = rng.randint(len(embeddings), size=args.nqueries)
+        queries = embeddings[np.sort(picks)] + \
+            0.1*rng.randn(args.nqueries, embeddings.shape[1])
+
+    start = time.time()
+    index = build_index(args.directory, range(len(embeddings)), embeddings,
+                        args.dtype, nlist=args.nlist)
+    print('built index of %d embeddings in %.1f seconds'
+          % (len(index), time.time() - start))
+    print('mode   nprobe  recall@%d      qps' % (args.k,))
+    for result in measure(index, queries, args.k):
+        print('%-5s  %6s  %8.4f  %7.0f' % (
+            result['mode'], result['nprobe'] or '-', result['recall'],
+            result['qps']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Embed strings with the tower of a trained siamese model.
+
+The siamese model runs the same CNN tower on both images of a pair and
+returns the euclidean distance of the two embeddings, so scoring a pair
+with model.predict runs the tower twice, and scoring one name against N
+others runs it 2N times.  An Encoder runs the tower once per unique string,
+in large batches, and distance() computes what the model would have
+returned from the embeddings.
+"""
+from __future__ import with_statement
+
+import numpy as np
+
+
+class Encoder(object):
+    """The tower of a siamese model, with images from a RenderCache.
+
+    tower is the Keras tower or a numpy_tower.NumpyTower, and offset the
+    constant the model's distance adds to the squared distance."""
+
+    def __init__(self, tower, offset, cache, batch_size=1024):
+        self.tower = tower
+        self.offset = offset
+        self.cache = cache
+        self.batch_size = batch_size
+        self.embedding_size = self.tower.output_shape[-1]
+
+    @classmethod
+    def from_model(cls, model, cache, batch_size=1024):
+        """Encoder for a Keras siamese model built by build_model."""
+        # euclidean_distance adds a small random constant to every squared
+        # difference, drawn when the model is built or loaded; it is what
+        # the model returns for two identical images
+        blank = np.zeros((1,) + model.input_shape[0][1:], dtype=np.float32)
+        offset = float(model.predict([blank, blank])[0, 0])**2
+        # the model's layers are input a, input b, the tower and the distance
+        return cls(model.layers[2], offset, cache, batch_size)
+
+    @classmethod
+    def load(cls, model_file, weight_file, cache, batch_size=1024):
+        """Load a model saved by run_siamese.py and return its Encoder."""
+        from keras.models import model_from_json
+
+        with open(model_file) as f:
+            model = model_from_json(f.read())
+        model.load_weights(weight_file)
+        return cls.from_model(model, cache, batch_size)
+
+    @classmethod
+    def load_npz(cls, npz_file, cache, batch_size=1024):
+        """Encoder running a tower exported by numpy_tower.export_weights,
+        without importing Keras."""
+        import numpy_tower
+
+        tower = numpy_tower.NumpyTower(npz_file)
+        return cls(tower, tower.offset, cache, batch_size)
+
+    def embed(self, strings):
+        """Return a (strings, embedding size) float32 array of embeddings.
+
+        Each unique (lower cased) string goes through the tower once.
+        """
+        (unique, inverse) = np.unique([st.lower() for st in strings],
+                                      return_inverse=True)
+        rows = self.cache.rows(list(unique))
+        embeddings = np.empty((len(unique), self.embedding_size),
+                              dtype=np.float32)
+        imgs = np.empty((min(self.batch_size, len(unique)),) +
+                        self.cache.shape + (1,), dtype=np.float32)
+        for start in range(0, len(unique), self.batch_size):
+            batch = rows[start:start+self.batch_size]
+            self.cache.take(batch, imgs[:len(batch)])
+            embeddings[start:start+len(batch)] = self.tower.predict(
+                imgs[:len(batch)], batch_size=len(batch))
+        return embeddings[inverse]
+
+    def embed_uncached(self, strings):
+        """Like embed(), but rendering the strings without adding them to
+        the cache, for streams of names that would grow it without end."""
+        (unique, inverse) = np.unique([st.lower() for st in strings],
+                                      return_inverse=True)
+        embeddings = np.empty((len(unique), self.embedding_size),
+                              dtype=np.float32)
+        for start in range(0, len(unique), self.batch_size):
+            imgs = self.cache.render(list(unique[start:start+self.batch_size]))
+            embeddings[start:start+len(imgs)] = self.tower.predict(
+                imgs[:, :, :, None], batch_size=len(imgs))
+        return embeddings[inverse]
+
+    def distance(self, emb_a, emb_b):
+        """The siamese model's output for embeddings emb_a and emb_b.
+
+        Works row by row on two (n, embedding size) arrays, or for one
+        embedding against each row of an array."""
+        diff = np.asarray(emb_a, dtype=np.float32) - emb_b
+        return np.sqrt(np.sum(np.square(diff), axis=-1) + self.offset)
+
+    def score_pairs(self, pairs):
+        """Return the siamese model's distance for each (str1, str2) pair."""
+        pairs = list(pairs)
+        embeddings = self.embed([st for pair in pairs for st in pair])
+        return self.distance(embeddings[0::2], embeddings[1::2])
+
+
+def encoder_selftest(model_file, weight_file, font_location):
+    """Check Encoder distances against the siamese model's predictions."""
+    import shutil
+    import tempfile
+
+    from keras.models import model_from_json
+
+    import render_cache
+
+    print('    running self test for Encoder ...')
+    pairs = [('google', 'goog1e'), ('paypal', 'paypa1'), ('Google', 'google'),
+             ('svchost.exe', 'svch0st.exe'), ('lsass.exe', 'example'),
+             ('google', 'google')]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cache = render_cache.RenderCache(tmp_dir, font_location, 10,
+                                         (150, 12), (0, 0))
+        with open(model_file) as f:
+            model = model_from_json(f.read())
+        model.load_weights(weight_file)
+        encoder = Encoder.from_model(model, cache, batch_size=4)
+        distances = encoder.score_pairs(pairs)
+        X1 = cache.images([str1 for (str1, str2) in pairs])
+        X2 = cache.images([str2 for (str1, str2) in pairs])
+        expected = model.predict([X1, X2])[:, 0]
+        if not np.allclose(distances, expected, rtol=1e-4, atol=1e-5):
+            print('Encoder failed built-in test.')
+            print('    It returned %r instead of %r.' % (distances, expected))
+    finally:
+        shutil.rmtree(tmp_dir)
+    print('    self test for Encoder done.')
@@ -0,0 +1,232 @@
+"""Render string images from pre-rendered glyph bitmaps.
+
+A GlyphAtlas draws every character it meets once with PIL, on its own, and
+keeps the bitmap.  A string image is then put together with NumPy, by
+taking the maximum of the glyph bitmaps at their pen positions, which is how
+FreeType's glyphs are combined in a text mask before PIL thresholds it.
+
+Pen positions come from the font through PIL: the advance of each
+character, and for each pair of adjacent characters the offset PIL uses
+when drawing the pair, which includes kerning.  PIL clips the text to a mask
+whose width ignores kerning, so glyphs that hang over the end of a string,
+such as a final f, are clipped the same way here.  pixel_diff_report()
+compares the result with drawing the whole string with PIL.
+"""
+from __future__ import with_statement
+
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageFont
+
+# character used to measure the advance of characters without any ink
+REFERENCE_CHAR = '|'
+
+
+class GlyphAtlas(object):
+    """Glyph bitmaps and pen offsets of one font at one size."""
+
+    def __init__(self, font_location, font_size, image_size, text_location):
+        self.font = ImageFont.truetype(font_location, font_size)
+        self.font_size = font_size
+        self.image_size = tuple(image_size)
+        self.text_location = tuple(text_location)
+        # Glyphs are drawn pad pixels into a canvas, so that ones reaching
+        # left of their pen position are not cut off.
+        self.pad = 2*font_size
+        self.canvas_width = self.pad + 4*font_size
+        self._glyphs = {} # character -> (ink, ink column, left, width, advance)
+        self._offsets = {} # (character, character) -> pen offset
+        self.unmatched = [] # pairs whose offset could not be measured
+
+    def _draw(self, text):
+        """Draw text at the pad on a canvas, the way generate_imgs does."""
+        img = Image.new('F', (self.canvas_width, self.image_size[1]))
+        dimg = ImageDraw.Draw(img)
+        dimg.text((self.pad, self.text_location[1]), text, font=self.font)
+        return np.asarray(img, dtype=np.float32)
+
+    def _glyph(self, ch):
+        """Return (ink, ink column, left, width, advance) for ch.
+
+        ink holds the columns of the glyph bitmap that have ink (None if
+        there are none), starting ink column pixels right of the pen
+        position.  PIL's text mask for ch alone starts left pixels right of
+        the pen and is width wide; advance is how far ch moves the pen.
+        """
+        if ch not in self._glyphs:
+            ((width, _), (left, _)) = self.font.font.getsize(ch)
+            advance = self.font.font.getsize(ch + ch)[0][0] - width
+            # trailing spaces keep PIL from clipping overhanging glyphs
+            bitmap = self._draw(ch + '  ')
+            columns = np.flatnonzero(bitmap.any(axis=0))
+            if len(columns):
+                ink = bitmap[:, columns[0]:columns[-1]+1].copy()
+                column = columns[0] - self.pad
+            else:
+                ink = None
+                column = 0
+            self._glyphs[ch] = (ink, column, left, width, advance)
+        return self._glyphs[ch]
+
+    def _compose(self, out, st, offsets, x0):
+        """Draw st into the 2-D array out with its pen starting at x0."""
+        pen = nominal = 0
+        clip_left = clip_right = x0
+        for k, ch in enumerate(st):
+            (ink, column, left, width, advance) = self._glyph(ch)
+            if k == 0:
+                clip_left = x0 + left
+            else:
+                pen += offsets[k-1]
+                nominal += self._glyph(st[k-1])[4]
+            # the mask PIL clips to is as wide as if there were no kerning
+            clip_right = max(clip_right, x0 + nominal + left + width)
+            if ink is None:
+                continue
+            start = x0 + pen + column
+            lo = max(start, 0)
+            hi = min(start + ink.shape[1], out.shape[1])
+            if lo < hi:
+                np.maximum(out[:, lo:hi], ink[:, lo-start:hi-start],
+                           out=out[:, lo:hi])
+        out[:, :max(clip_left, 0)] = 0
+        out[:, max(clip_right, 0):] = 0
+
+    def _match(self, text, offsets, advance):
+        """Pen offset that makes the atlas draw text like PIL does.
+
+        offsets(candidate) gives the pen offsets of text for a candidate.
+        Candidates closest to advance, where kerning is small, go first.
+        """
+        target = self._draw(text)
+        canvas = np.zeros(target.shape, dtype=np.float32)
+        candidates = range(-self.font_size, 3*self.font_size)
+        for candidate in sorted(candidates, key=lambda c: abs(c - advance)):
+            canvas[:] = 0
+            self._compose(canvas, text, offsets(candidate), self.pad)
+            if np.array_equal(canvas, target):
+                return candidate
+        return None
+
+    def _offset(self, ch1, ch2):
+        """How far the pen moves from ch1 to a following ch2."""
+        if (ch1, ch2) not in self._offsets:
+            advance = self._glyph(ch1)[4]
+            if self._glyph(ch2)[0] is not None:
+                offset = self._match(ch1 + ch2, lambda offset: [offset],
+                                     advance)
+            else:
+                # ch2 has no ink to find; find it from where a reference
+                # character after it lands instead
+                after = self._offset(ch2, REFERENCE_CHAR)
+                offset = self._match(ch1 + ch2 + REFERENCE_CHAR,
+                                     lambda offset: [offset, after], advance)
+            if offset is None:
+                self.unmatched.append((ch1, ch2))
+                offset = advance
+            self._offsets[(ch1, ch2)] = offset
+        return self._offsets[(ch1, ch2)]
+
+    def render(self, strings, out=None):
+        """Render strings into a (strings, height, width, 1) float32 array.
+
+        The images are the lower cased strings drawn like generate_imgs
+        does, in tf ordering.  If out is given, they are written into it.
+        """
+        (width, height) = self.image_size
+        if out is None:
+            out = np.zeros((len(strings), height, width, 1), dtype=np.float32)
+        else:
+            out[:len(strings)] = 0
+        for n, st in enumerate(strings):
+            st = st.lower()
+            offsets = [self._offset(st[k-1], st[k]) for k in range(1, len(st))]
+            self._compose(out[n, :, :, 0], st, offsets, self.text_location[0])
+        return out
+
+
+def pixel_diff_report(strings, font_location, font_size, image_size,
+                      text_location):
+    """Compare GlyphAtlas with drawing each string with PIL.
+
+    Returns a dict with the number of strings, how many of them and how
+    many pixels differ, the largest pixel difference, the strings that
+    differ, and the seconds each renderer took (the atlas from empty).
+    """
+    import render_cache
+
+    start = time.time()
+    expected = render_cache.render_strings(
+        strings, font_location, font_size, image_size, text_location)
+    pil_seconds = time.time() - start
+
+    start = time.time()
+    atlas = GlyphAtlas(font_location, font_size, image_size, text_location)
+    imgs = atlas.render(strings)[:, :, :, 0]
+    atlas_seconds = time.time() - start
+
+    diff = np.abs(imgs - expected)
+    differs = diff.reshape(len(strings), -1).any(axis=1)
+    return {'strings': len(strings),
+            'differing_strings': int(differs.sum()),
+            'differing_pixels': int((diff > 0).sum()),
+            'max_difference': float(diff.max()) if len(strings) else 0.0,
+            'differences': [strings[k] for k in np.flatnonzero(differs)],
+            'unmatched_pairs': atlas.unmatched,
+            'pil_seconds': pil_seconds,
+            'atlas_seconds': atlas_seconds}
+
+
+def glyph_atlas_selftest(font_location):
+    """Check GlyphAtlas against PIL on the strSimilarity test strings."""
+    import strSimilarity
+
+    print('    running self test for GlyphAtlas ...')
+    strings = sorted(set(st for (str1, str2, _) in
+                         strSimilarity.levenshteinTestCases +
+                         strSimilarity.howConfusableAreTestCases
+                         for st in (str1, str2)))
+    strings += ['if', 'of', 'jo', 'To', 'a b', ' x ', 'f', 'w'*40]
+    for (image_size, text_location) in [((150, 12), (0, 0)),
+                                        ((60, 16), (3, 2))]:
+        report = pixel_diff_report(strings, font_location, 10, image_size,
+                                   text_location)
+        if report['differing_strings']:
+            print('GlyphAtlas failed built-in test for image size %r and '
+                  'text location %r.' % (image_size, text_location))
+            print('    These strings differ from PIL: %r'
+                  % (report['differences'],))
+    print('    self test for GlyphAtlas done.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare glyph atlas rendering with PIL on a corpus.')
+    parser.add_argument('corpus', help='file with one string per line')
+    parser.add_argument('--font', default='Arial.ttf')
+    parser.add_argument('--font-size', type=int, default=10)
+    parser.add_argument('--image-size', type=int, nargs=2, default=[150, 12])
+    parser.add_argument('--text-location', type=int, nargs=2, default=[0, 0])
+    args = parser.parse_args()
+
+    with open(args.corpus) as f:
+        strings = [line.rstrip('\r\n') for line in f]
+    report = pixel_diff_report(strings, args.font, args.font_size,
+                               args.image_size, args.text_location)
+    print('strings:           %d' % (report['strings'],))
+    print('differing strings: %d' % (report['differing_strings'],))
+    print('differing pixels:  %d' % (report['differing_pixels'],))
+    print('max difference:    %g' % (report['max_difference'],))
+    print('unmatched pairs:   %d' % (len(report['unmatched_pairs']),))
+    print('PIL seconds:       %.3f' % (report['pil_seconds'],))
+    print('atlas seconds:     %.3f' % (report['atlas_seconds'],))
+    for st in report['differences'][:20]:
+        print('    differs: %r' % (st,))
+
+
+if __name__ == '__main__':
+    main()
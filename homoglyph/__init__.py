@@ -0,0 +1,21 @@
+"""Detect spoofed names with a siamese CNN and visual edit distance.
+
+The code run_siamese.py runs is split into modules, so that a program
+that only scores pairs does not import Keras, sklearn or matplotlib:
+
+    scoring      score name pairs by edit distance, visual edit distance or
+                 an exported tower; imports NumPy, and the rest when used
+    scan         scan streams of names for spoofs of a watchlist, writing
+                 JSON-lines alerts; imports the scorers when used
+    service      answer single names over HTTP or a unix socket, scoring
+                 the requests of all connections in micro-batches
+    rendering    render names into the images the model takes
+    training     build and train the siamese model (imports Keras)
+    evaluation   ROC curves of the model and the baselines (imports sklearn)
+    plotting     the ROC curve figure (imports matplotlib)
+
+Importing homoglyph imports none of them.  import_time measures how long a
+fresh interpreter takes to import a module, and which heavy dependencies it
+pulls in.  The modules import the NIST modules and the helper modules at the
+top of the repository, so run them from there.
+"""
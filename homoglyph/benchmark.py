@@ -0,0 +1,451 @@
+"""Benchmarks of the scoring and rendering hot paths.
+
+Each case times one function on a synthetic corpus: domain-like names
+('paypal-login.com') or process-like names ('svchost.exe'), in buckets of
+string length from 3 to 64, with half of the pairs spoofs made with the
+substitutions of the similarity tables and half unrelated names.  The
+corpora only depend on the seed, so runs with the same seed time the same
+inputs.
+
+Every case runs in a fresh interpreter, so that its peak memory is its own,
+for up to --seconds after one untimed warm up call, split in ROUNDS rounds
+over the same inputs.  It reports the pairs (or characters, digraphs or
+strings) per second of the fastest round, percentiles of the latency of
+each call, and the peak resident memory.  Calls that score a batch report
+the latency of the batch.  The results are written as JSON, and compared
+with a baseline from an earlier run:
+
+    python -m homoglyph.benchmark -o bench.json --baseline benchmarks/baseline.json
+
+exits with status 1 when a case got slower, or uses more memory, by more
+than --tolerance.  Write a new baseline with -o when a change is expected.
+Rendering cases need a font (--font) and are skipped without one; siamese
+scoring uses a NumPy tower with random weights, which is as fast as a
+trained one.
+"""
+from __future__ import with_statement
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+LENGTHS = ((3, 8), (9, 16), (17, 32), (33, 64))
+CORPORA = ('domain', 'process')
+RENDER_BACKENDS = ('pil', 'atlas', 'warm')
+
+# items in each corpus; a case stops earlier when its time is up
+CORPUS_SIZE = 2000
+BATCH = 256 # strings or pairs per call of the batched cases
+ROUNDS = 3 # timed rounds of each case; the fastest one counts
+
+_TLDS = ['com', 'net', 'org', 'io', 'info', 'co.uk', 'de', 'ru']
+_EXTENSIONS = ['.exe', '.exe', '.dll', '.sys', '.scr', '']
+_CONSONANTS = 'bcdfghjklmnprstvwz'
+_VOWELS = 'aeiouy'
+
+
+def _word(rng, length):
+    """A pronounceable lower case word of length letters."""
+    letters = [rng.choice(_VOWELS if k % 2 else _CONSONANTS)
+               for k in range(length)]
+    if length > 3 and rng.random() < 0.3:
+        letters[rng.randrange(length)] = rng.choice('0123456789')
+    return ''.join(letters)
+
+
+def _name(rng, kind, length):
+    """A domain-like or process-like name of exactly length characters."""
+    if kind == 'domain':
+        tld = rng.choice([tld for tld in _TLDS if len(tld) + 2 <= length] or
+                         [''])
+        suffix = '.' + tld if tld else ''
+        separator = '.-'
+    else:
+        extension = rng.choice(_EXTENSIONS)
+        suffix = extension if len(extension) + 1 <= length else ''
+        separator = '_-'
+    parts = []
+    left = length - len(suffix)
+    while left > 0:
+        size = min(left, rng.randint(3, 10))
+        if left - size == 1:
+            size += 1 # no room for a separator and a word
+        parts.append(_word(rng, size))
+        left -= size
+        if left > 1:
+            parts.append(rng.choice(separator))
+            left -= 1
+    return ''.join(parts)[:length - len(suffix)] + suffix
+
+
+def _spoof_tables():
+    """(from, to) substitutions of lower case characters and digraphs that
+    look alike, from the similarity tables."""
+    import charSimilarity
+
+    table = []
+    for ((a, b), similarity) in (charSimilarity.scsimtab.items() +
+                                 charSimilarity.dcsimtab.items()):
+        if similarity >= 0.5 and a == a.lower() and b == b.lower():
+            table.extend([(a, b), (b, a)])
+    return sorted(set(table))
+
+
+def _spoof(rng, name, table):
+    """name with one or two look-alike substitutions, or an edit."""
+    for _ in range(rng.randint(1, 2)):
+        candidates = [(a, b) for (a, b) in table if a in name]
+        if candidates and rng.random() < 0.8:
+            (a, b) = rng.choice(candidates)
+            starts = [k for k in range(len(name)) if name.startswith(a, k)]
+            k = rng.choice(starts)
+            name = name[:k] + b + name[k+len(a):]
+        else:
+            k = rng.randrange(len(name))
+            name = name[:k] + rng.choice(_CONSONANTS) + name[k+1:]
+    return name
+
+
+def corpus(kind, lengths, size=CORPUS_SIZE, seed=0):
+    """size (name1, name2) pairs of a kind of name with name1 of lengths,
+    half of them spoofs of each other and half unrelated."""
+    rng = random.Random('%s %s %r %d' % (kind, lengths, size, seed))
+    table = _spoof_tables()
+    names = [_name(rng, kind, rng.randint(*lengths)) for _ in range(size)]
+    pairs = []
+    for (k, name) in enumerate(names):
+        if k % 2:
+            pairs.append((name, _spoof(rng, name, table)))
+        else:
+            pairs.append((name, names[rng.randrange(size)]))
+    return pairs
+
+
+def cases():
+    """Names of all benchmark cases."""
+    names = ['characterSimilarity', 'digraphSimilarity']
+    for function in ('levenshtein', 'howConfusableAre'):
+        for kind in CORPORA:
+            for lengths in LENGTHS:
+                names.append('%s/%s/%d-%d' % ((function, kind) + lengths))
+    for kind in CORPORA:
+        for backend in RENDER_BACKENDS:
+            names.append('generate_imgs/%s/%s' % (backend, kind))
+        names.append('siamese/%s' % (kind,))
+    return names
+
+
+def _timer_overhead():
+    """Seconds time.time() itself adds to a measured latency."""
+    samples = []
+    for _ in range(1000):
+        start = time.time()
+        samples.append(time.time() - start)
+    return min(samples)
+
+
+def _time_calls(function, inputs, seconds, items=1, rounds=ROUNDS,
+                restart=True):
+    """Call function(*args) for args of inputs, in rounds that each end
+    after seconds / rounds.  Each round starts over from the first inputs,
+    or with restart=False goes on from where the last one stopped, for
+    calls that are faster the second time.
+
+    Returns (items per second of the fastest round, items done, latencies
+    of all calls).  The first call is a warm up and is not counted.  Taking
+    the fastest round, like timeit, leaves out most of the time other
+    processes took the CPU."""
+    function(*inputs[0])
+    overhead = _timer_overhead()
+    latencies = []
+    best = 0.0
+    remaining = iter(inputs[1:])
+    for _ in range(rounds):
+        done = 0
+        started = time.time()
+        deadline = started + seconds / rounds
+        for args in (inputs[1:] if restart else remaining):
+            start = time.time()
+            function(*args)
+            end = time.time()
+            latencies.append(max(end - start - overhead, 0.0))
+            done += items
+            if end > deadline:
+                break
+        if done:
+            best = max(best, done / (time.time() - started))
+    return (best, len(latencies) * items, np.array(latencies))
+
+
+def run_case(name, seconds=2.0, seed=0, font_location=None):
+    """Run one case in this process and return its results as a dict."""
+    parts = name.split('/')
+    function = parts[0]
+    result = {'case': name, 'function': function, 'seed': seed}
+    batch = 1
+    if function in ('characterSimilarity', 'digraphSimilarity'):
+        import charSimilarity
+
+        rng = random.Random('%s %d' % (function, seed))
+        if function == 'characterSimilarity':
+            symbols = [ch for (pair, _) in charSimilarity.scsimtab.items()
+                       for ch in pair if ch == ch.lower()]
+            symbols += list('abcdefghijklmnopqrstuvwxyz0123456789.-_')
+            call = charSimilarity.characterSimilarity
+        else:
+            symbols = [dg for (pair, _) in charSimilarity.dcsimtab.items()
+                       for dg in pair if dg == dg.lower()]
+            symbols += [a + b for a in 'acilmnrtuvw' for b in 'lmnrtv']
+            call = charSimilarity.digraphSimilarity
+        inputs = [(rng.choice(symbols), rng.choice(symbols))
+                  for _ in range(20 * CORPUS_SIZE)]
+        if function == 'digraphSimilarity':
+            # at least one of each pair must be a digraph
+            digraphs = [dg for dg in symbols if len(dg) == 2]
+            inputs = [(a, b) if len(a) == 2 or len(b) == 2 else
+                      (rng.choice(digraphs), b) for (a, b) in inputs]
+        result['corpus'] = 'symbols'
+    elif function in ('levenshtein', 'howConfusableAre'):
+        import strSimilarity
+
+        (kind, lengths) = (parts[1], tuple(map(int, parts[2].split('-'))))
+        inputs = corpus(kind, lengths, seed=seed)
+        call = getattr(strSimilarity, function)
+        result.update(corpus=kind, lengths=list(lengths))
+    elif function in ('generate_imgs', 'siamese'):
+        import shutil
+        import tempfile
+
+        from homoglyph import rendering
+
+        if not font_location or not os.path.isfile(font_location):
+            result['skipped'] = 'no font file %r' % (font_location,)
+            return result
+        kind = parts[-1]
+        pairs = corpus(kind, (3, 64), seed=seed)
+        result.update(corpus=kind, lengths=[3, 64])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            batch = BATCH
+            backend = None
+            if function == 'generate_imgs':
+                backend = parts[1]
+                result['backend'] = backend
+                cache = rendering.open_cache(
+                    tmp_dir, font_location,
+                    backend='pil' if backend == 'warm' else backend)
+                strings = sorted(set(st for pair in pairs for st in pair))
+                if backend == 'warm':
+                    cache.rows(strings)
+                inputs = [(cache, strings[start:start+batch])
+                          for start in range(0, len(strings), batch)]
+                call = rendering.generate_imgs
+            else:
+                import encoder
+                import numpy_tower
+
+                npz_file = os.path.join(tmp_dir, 'tower.npz')
+                numpy_tower.random_tower(npz_file)
+                cache = rendering.open_cache(tmp_dir, font_location)
+                cache.rows([st for pair in pairs for st in pair])
+                siamese_encoder = encoder.Encoder.load_npz(npz_file, cache)
+                inputs = [(pairs[start:start+batch],)
+                          for start in range(0, len(pairs), batch)]
+                call = siamese_encoder.score_pairs
+            result['setup_rss_mb'] = _peak_rss_mb()
+            # rendering is cached, so only new strings are cold
+            (rate, items, latencies) = _time_calls(
+                call, inputs, seconds, batch,
+                restart=function == 'siamese' or backend == 'warm')
+        finally:
+            shutil.rmtree(tmp_dir)
+    else:
+        raise ValueError('Unknown benchmark case: %s' % (name,))
+
+    if batch == 1:
+        result['setup_rss_mb'] = _peak_rss_mb()
+        (rate, items, latencies) = _time_calls(call, inputs, seconds)
+    result.update(items=items, calls=len(latencies), batch=batch,
+                  seconds=seconds, items_per_second=rate,
+                  latency_us=dict(('p%d' % q, np.percentile(latencies, q) * 1e6)
+                                  for q in (50, 90, 99)),
+                  peak_rss_mb=_peak_rss_mb())
+    result['latency_us']['max'] = latencies.max() * 1e6
+    return result
+
+
+def _peak_rss_mb():
+    """Peak resident memory of this process so far, in MB (Linux units)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def environment():
+    """Where the benchmarks ran, to tell when results are comparable."""
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpus': os.sysconf('SC_NPROCESSORS_ONLN')}
+
+
+def run(names=None, seconds=2.0, seed=0, font_location=None):
+    """Run cases, each in a fresh interpreter, and return the results."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + filter(None, [env.get('PYTHONPATH')]))
+    results = {}
+    for name in names or cases():
+        command = [sys.executable, '-m', 'homoglyph.benchmark',
+                   '--run-case', name, '--seconds', repr(seconds),
+                   '--seed', str(seed)]
+        if font_location:
+            command += ['--font', os.path.abspath(font_location)]
+        output = subprocess.check_output(command, env=env)
+        results[name] = json.loads(output.splitlines()[-1])
+    return {'environment': environment(), 'seconds': seconds, 'seed': seed,
+            'results': results}
+
+
+def compare(current, baseline, tolerance=0.25):
+    """Compare two run() results, case by case.
+
+    Returns a list of (case, baseline items/s, current items/s, baseline
+    peak MB, current peak MB, regressed) for the cases both ran.  A case
+    regressed if its throughput fell, or its peak memory grew, by more
+    than tolerance."""
+    rows = []
+    for name in sorted(current['results']):
+        now = current['results'][name]
+        then = baseline['results'].get(name)
+        if then is None or 'skipped' in now or 'skipped' in then:
+            continue
+        regressed = (now['items_per_second'] <
+                     then['items_per_second'] * (1 - tolerance) or
+                     now['peak_rss_mb'] > then['peak_rss_mb'] * (1 + tolerance))
+        rows.append((name, then['items_per_second'], now['items_per_second'],
+                     then['peak_rss_mb'], now['peak_rss_mb'], regressed))
+    return rows
+
+
+def _best(a, b):
+    """The faster of two results of a case, with the lower peak memory."""
+    best = dict(max(a, b, key=lambda result: result['items_per_second']))
+    best['peak_rss_mb'] = min(a['peak_rss_mb'], b['peak_rss_mb'])
+    return best
+
+
+def benchmark_selftest():
+    """Check the corpora and that compare() catches a regression."""
+    print('    running self test for benchmarks ...')
+    for kind in CORPORA:
+        for lengths in LENGTHS:
+            pairs = corpus(kind, lengths, size=200)
+            if pairs != corpus(kind, lengths, size=200):
+                print('Benchmark corpus %s %r is not repeatable.'
+                      % (kind, lengths))
+            if not all(lengths[0] <= len(a) <= lengths[1] and a == a.lower()
+                       for (a, b) in pairs):
+                print('Benchmark corpus %s %r has names of other lengths.'
+                      % (kind, lengths))
+    result = run_case('levenshtein/domain/3-8', seconds=0.05)
+    if not result['items'] or result['latency_us']['p50'] <= 0:
+        print('Benchmark case returned %r.' % (result,))
+    slower = dict(result, items_per_second=result['items_per_second'] / 2)
+    rows = compare({'results': {'a': slower}}, {'results': {'a': result}})
+    if [row[-1] for row in rows] != [True]:
+        print('Benchmark comparison did not flag a regression.')
+    print('    self test for benchmarks done.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the scoring and rendering hot paths.')
+    parser.add_argument('cases', nargs='*',
+                        help='cases, or prefixes of them, to run (default: '
+                        'all); see --list')
+    parser.add_argument('--list', action='store_true',
+                        help='list the cases and exit')
+    parser.add_argument('-o', '--output', help='write the results to this '
+                        'JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slow down or memory growth that counts as a '
+                        'regression (default: 0.25)')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='times to run a case that regressed again '
+                        'before reporting it (default: 2)')
+    parser.add_argument('--seconds', type=float, default=2.0,
+                        help='time limit of each case (default: 2)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--font', default='Arial.ttf')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        result = run_case(args.run_case, args.seconds, args.seed, args.font)
+        sys.stdout.write(json.dumps(result) + '\n')
+        return
+    if args.list:
+        print('\n'.join(cases()))
+        return
+
+    names = [name for name in cases()
+             if not args.cases or any(name.startswith(prefix)
+                                      for prefix in args.cases)]
+    report = run(names, args.seconds, args.seed, args.font)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # run the cases that look slower again, to tell noise from change
+        for _ in range(args.retries):
+            again = [row[0] for row in compare(report, baseline,
+                                               args.tolerance) if row[-1]]
+            if not again:
+                break
+            retry = run(again, args.seconds, args.seed, args.font)
+            for name in again:
+                report['results'][name] = _best(report['results'][name],
+                                                retry['results'][name])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    print('%-36s %12s %10s %10s %10s %9s' % ('case', 'items/s', 'p50 us',
+                                             'p99 us', 'batch', 'peak MB'))
+    for name in names:
+        result = report['results'][name]
+        if 'skipped' in result:
+            print('%-36s skipped: %s' % (name, result['skipped']))
+            continue
+        print('%-36s %12.1f %10.1f %10.1f %10d %9.1f' % (
+            name, result['items_per_second'], result['latency_us']['p50'],
+            result['latency_us']['p99'], result['batch'],
+            result['peak_rss_mb']))
+
+    if baseline is not None:
+        if baseline.get('environment') != report['environment']:
+            print('warning: the baseline ran in another environment: %r'
+                  % (baseline.get('environment'),))
+        rows = compare(report, baseline, args.tolerance)
+        print('\n%-36s %12s %12s %7s %9s' % ('case', 'baseline/s', 'now/s',
+                                             'ratio', 'peak MB'))
+        for (name, then, now, then_mb, now_mb, regressed) in rows:
+            print('%-36s %12.1f %12.1f %7.2f %4.0f>%-4.0f %s' % (
+                name, then, now, now / then, then_mb, now_mb,
+                'REGRESSION' if regressed else ''))
+        if any(row[-1] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""Pair datasets in sharded, memory-mapped columns instead of one pickle.
+
+The datasets in data/ are pickled dicts from split name ('train',
+'validate', 'test') to a list of (name1, name2, label) tuples, which have to
+be loaded whole before a single pair can be used.  write_dataset() stores
+each split as shards of up to shard_rows pairs, and each shard as columns:
+
+    <split>-<shard>.strings       the shard's distinct names, concatenated
+    <split>-<shard>.offsets.npy   int64 start of each name, plus the end
+    <split>-<shard>.name1.npy     int32 name number of each pair's name1
+    <split>-<shard>.name2.npy     int32 name number of each pair's name2
+    <split>-<shard>.labels.npy    int8 label of each pair
+
+with meta.json listing the splits and the rows in each of their shards.
+A split is its shards' rows in order, so row numbers are the split indices.
+PairDataset opens a shard, as memory maps, the first time one of its rows is
+needed, so opening a dataset reads meta.json and nothing else however big
+it is, and sample() or pairs() only read the pages of the rows they ask for.
+
+Names are returned as str.  unicode names are stored encoded as UTF-8.
+
+    python -m homoglyph.dataset data/process_spoof.pkl data/process_spoof
+"""
+from __future__ import with_statement
+
+import argparse
+import bisect
+import json
+import os
+
+import numpy as np
+
+META_FILE = 'meta.json'
+COLUMNS = ('offsets', 'name1', 'name2', 'labels')
+
+# pairs per shard; a shard's columns are written from memory
+SHARD_ROWS = 1 << 20
+
+
+def _shard_prefix(directory, split, shard):
+    return os.path.join(directory, '%s-%05d' % (split, shard))
+
+
+def _write_shard(prefix, rows):
+    """Write the columns of one shard of (name1, name2, label) rows."""
+    ids = {} # name -> number in this shard
+    names = []
+    columns = (np.empty(len(rows), dtype=np.int32),
+               np.empty(len(rows), dtype=np.int32))
+    labels = np.empty(len(rows), dtype=np.int8)
+    for (k, row) in enumerate(rows):
+        for (column, name) in zip(columns, row[:2]):
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            if name not in ids:
+                ids[name] = len(names)
+                names.append(name)
+            column[k] = ids[name]
+        labels[k] = row[2]
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in names], out=offsets[1:])
+    with open(prefix + '.strings', 'wb') as f:
+        f.write(''.join(names))
+    for (name, array) in zip(COLUMNS, (offsets,) + columns + (labels,)):
+        np.save(prefix + '.%s.npy' % name, array)
+
+
+def write_dataset(directory, splits, shard_rows=SHARD_ROWS):
+    """Write splits, a dict from split name to an iterable of (name1, name2,
+    label) tuples, as a dataset in directory.
+
+    The iterables are read one shard at a time, so they can be generators
+    over datasets that do not fit in memory."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    meta = {'version': 1, 'splits': {}}
+    for split in sorted(splits):
+        shards = []
+        rows = []
+        for row in splits[split]:
+            rows.append(row)
+            if len(rows) == shard_rows:
+                _write_shard(_shard_prefix(directory, split, len(shards)), rows)
+                shards.append(len(rows))
+                rows = []
+        if rows or not shards:
+            _write_shard(_shard_prefix(directory, split, len(shards)), rows)
+            shards.append(len(rows))
+        meta['splits'][split] = shards
+    # written last, so a dataset with a meta.json is complete
+    with open(os.path.join(directory, META_FILE + '.tmp'), 'w') as f:
+        json.dump(meta, f, indent=1, sort_keys=True)
+    os.rename(os.path.join(directory, META_FILE + '.tmp'),
+              os.path.join(directory, META_FILE))
+
+
+def convert_pickle(pickle_file, directory, shard_rows=SHARD_ROWS):
+    """Convert a pickled dataset from data/ to a dataset in directory."""
+    import cPickle as pickle
+
+    with open(pickle_file, 'rb') as f:
+        data = pickle.load(f)
+    write_dataset(directory, data, shard_rows)
+
+
+class _Shard(object):
+    """Memory-mapped columns of one shard."""
+
+    def __init__(self, prefix):
+        self.offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+        self.name1 = np.load(prefix + '.name1.npy', mmap_mode='r')
+        self.name2 = np.load(prefix + '.name2.npy', mmap_mode='r')
+        self.labels = np.load(prefix + '.labels.npy', mmap_mode='r')
+        self.strings = None
+        if self.offsets[-1]:
+            self.strings = np.memmap(prefix + '.strings', dtype=np.uint8,
+                                     mode='r')
+
+    def name(self, k):
+        return self.strings[self.offsets[k]:self.offsets[k+1]].tostring() \
+            if self.offsets[k+1] > self.offsets[k] else ''
+
+    def rows(self, local):
+        """(name1, name2, label) tuples of rows local of the shard."""
+        name1 = self.name1[local]
+        name2 = self.name2[local]
+        labels = self.labels[local]
+        return [(self.name(int(a)), self.name(int(b)), int(label))
+                for (a, b, label) in zip(name1, name2, labels)]
+
+
+class PairSplit(object):
+    """The pairs of one split of a PairDataset, by row number."""
+
+    def __init__(self, directory, name, shard_rows):
+        self.directory = directory
+        self.name = name
+        self._shard_rows = shard_rows
+        self._starts = [0] # first row of each shard, then the total
+        for rows in shard_rows:
+            self._starts.append(self._starts[-1] + rows)
+        self._shards = {} # shard number -> _Shard, opened when first used
+
+    def __len__(self):
+        return self._starts[-1]
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = _Shard(_shard_prefix(self.directory,
+                                                       self.name, shard))
+        return self._shards[shard]
+
+    def pairs(self, rows=None):
+        """(name1, name2, label) tuples of rows, in the order given, or of
+        every row if rows is None."""
+        if rows is None:
+            return [pair for pair in self]
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) and (rows.min() < 0 or rows.max() >= len(self)):
+            raise IndexError('row out of range for split %s' % (self.name,))
+        order = np.argsort(rows, kind='mergesort')
+        result = [None] * len(rows)
+        # visit each shard once, and its rows in file order
+        shard_of = np.searchsorted(self._starts, rows[order], side='right') - 1
+        for shard in np.unique(shard_of):
+            members = order[shard_of == shard]
+            local = rows[members] - self._starts[shard]
+            for (k, pair) in zip(members, self._shard(shard).rows(local)):
+                result[k] = pair
+        return result
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError('row out of range for split %s' % (self.name,))
+        shard = bisect.bisect_right(self._starts, row) - 1
+        return self._shard(shard).rows([row - self._starts[shard]])[0]
+
+    def sample_rows(self, n, seed=None):
+        """n different row numbers chosen at random, in random order."""
+        if n > len(self):
+            raise ValueError('sample larger than split %s' % (self.name,))
+        rng = np.random.RandomState(seed)
+        if 2*n > len(self):
+            return rng.permutation(len(self))[:n]
+        # a random subset without a permutation of the whole split
+        chosen = set()
+        while len(chosen) < n:
+            chosen.update(rng.randint(len(self), size=n - len(chosen)))
+        rows = np.array(sorted(chosen), dtype=np.int64)
+        return rows[rng.permutation(n)]
+
+    def sample(self, n, seed=None):
+        """n different pairs chosen at random, like random.sample."""
+        return self.pairs(self.sample_rows(n, seed))
+
+    def labels(self):
+        """int8 array of every label of the split."""
+        return np.concatenate([self._shard(shard).labels
+                               for shard in range(len(self._shard_rows))])
+
+    def iter_batches(self, batch_rows=65536):
+        """Yield lists of up to batch_rows pairs, in row order.  Only one
+        batch of pairs is held in memory at a time."""
+        for shard in range(len(self._shard_rows)):
+            for start in range(0, self._shard_rows[shard], batch_rows):
+                stop = min(start + batch_rows, self._shard_rows[shard])
+                yield self._shard(shard).rows(np.arange(start, stop))
+
+    def __iter__(self):
+        for batch in self.iter_batches():
+            for pair in batch:
+                yield pair
+
+
+class PairDataset(object):
+    """A dataset written by write_dataset(), split by split."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        if meta['version'] != 1:
+            raise ValueError('Unknown dataset version in %s: %r'
+                             % (directory, meta['version']))
+        self._splits = dict((str(name), PairSplit(directory, str(name), rows))
+                            for (name, rows) in meta['splits'].items())
+
+    @property
+    def splits(self):
+        return sorted(self._splits)
+
+    def __getitem__(self, split):
+        return self._splits[split]
+
+    def __contains__(self, split):
+        return split in self._splits
+
+
+def dataset_selftest():
+    """Check that a written dataset reads back the pairs it was given."""
+    import random
+    import shutil
+    import tempfile
+
+    print('    running self test for PairDataset ...')
+    rng = random.Random(0)
+    names = ['google', 'goog1e', 'paypal', 'paypa1', '', 'svch0st.exe',
+             u'g\xf6\xf6gle'.encode('utf-8'), 'a' * 300]
+    data = {'train': [(rng.choice(names), rng.choice(names),
+                       rng.randint(0, 1)) for _ in range(1000)],
+            'validate': [(rng.choice(names), rng.choice(names), 1)],
+            'test': []}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        write_dataset(tmp_dir, data, shard_rows=128)
+        dataset = PairDataset(tmp_dir)
+        if dataset.splits != sorted(data):
+            print('PairDataset has splits %r.' % (dataset.splits,))
+        for split in data:
+            if list(dataset[split]) != data[split]:
+                print('PairDataset failed built-in test for split %s.'
+                      % (split,))
+        train = dataset['train']
+        rows = [999, 0, 128, 127, 500, 128]
+        if train.pairs(rows) != [data['train'][k] for k in rows] or \
+                train[-1] != data['train'][-1]:
+            print('PairDataset returned the wrong rows.')
+        for n in (300, 900):
+            rows = train.sample_rows(n, seed=1)
+            if len(set(rows)) != n or \
+                    train.sample(n, seed=1) != train.pairs(rows):
+                print('PairDataset sample is not a repeatable subset.')
+        if list(train.labels()) != [x[2] for x in data['train']]:
+            print('PairDataset returned the wrong labels.')
+    finally:
+        shutil.rmtree(tmp_dir)
+    print('    self test for PairDataset done.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert a pickled dataset to sharded, memory-mapped '
+                    'columns.')
+    parser.add_argument('pickle_file', help='pickled dataset from data/')
+    parser.add_argument('directory', help='directory to write')
+    parser.add_argument('--shard-rows', type=int, default=SHARD_ROWS)
+    args = parser.parse_args()
+    convert_pickle(args.pickle_file, args.directory, args.shard_rows)
+    dataset = PairDataset(args.directory)
+    for split in dataset.splits:
+        print('%-10s %d pairs' % (split, len(dataset[split])))
+
+
+if __name__ == '__main__':
+    main()
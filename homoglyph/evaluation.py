@@ -0,0 +1,44 @@
+"""ROC curves of the siamese model and the edit distance baselines.
+
+Importing this module imports sklearn.  evaluate() scores the test pairs
+the way run_siamese.py reports them, and returns a dict from method name to
+{'fpr': ..., 'tpr': ..., 'auc': ...}, which homoglyph.plotting draws.
+"""
+from sklearn.metrics import roc_curve, auc
+
+from homoglyph import scoring
+
+
+def roc(y_true, y_score):
+    """ROC curve and its AUC, with y_score higher for the positive class."""
+    fpr, tpr, _ = roc_curve(y_true, y_score)
+    return {'fpr': fpr, 'tpr': tpr, 'auc': auc(fpr, tpr)}
+
+
+def evaluate(test, siamese_encoder):
+    """ROC curves on test, a list of (name1, name2, label) tuples.
+
+    siamese_encoder is an encoder.Encoder for the trained model."""
+    test_pairs = [(x[0], x[1]) for x in test]
+    results = {}
+
+    # Score the test pairs with one tower pass per unique string
+    y_test = [x[2] for x in test]
+    scores = -siamese_encoder.score_pairs(test_pairs)
+    results['siamese'] = roc(y_test, scores)
+
+    #
+    # Run Edit distance
+    #
+    y_test = [1.0-x[2] for x in test]
+    y_score = scoring.score_pairs(test_pairs, 'editdistance')
+    y_percent_score = y_score / [len(x[0]) for x in test_pairs]
+    results['editdistance'] = roc(y_test, y_score)
+    results['editdistance_percent'] = roc(y_test, y_percent_score)
+
+    #
+    # Run editdistance visual similarity
+    #
+    y_score = scoring.score_pairs(test_pairs, 'howConfusableAre')
+    results['editdistance_vs'] = roc(y_test, -y_score)
+    return results
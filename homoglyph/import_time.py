@@ -0,0 +1,112 @@
+"""Measure how long a fresh interpreter takes to import a module.
+
+Each measurement starts a new Python process, so nothing is imported yet,
+and times both the import itself and the whole process, interpreter start
+up included.  It also lists which of HEAVY_MODULES the import pulled in.
+The best of several runs is kept, as the slower ones measure other load on
+the machine.
+
+    python -m homoglyph.import_time homoglyph.scoring --limit 0.2
+
+exits with status 1 if a module starts slower than the limit or imports a
+heavy module, so it can guard the scoring entry point.
+"""
+from __future__ import with_statement
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+# dependencies that take long to import or use a lot of memory
+HEAVY_MODULES = ('keras', 'tensorflow', 'theano', 'sklearn', 'matplotlib',
+                 'PIL', 'h5py', 'editdistance')
+
+# modules scoring programs import, and the seconds they may take to start
+LIMITS = {'homoglyph': 0.2, 'homoglyph.scoring': 0.2, 'homoglyph.scan': 0.2,
+          'homoglyph.service': 0.2}
+
+_CHILD = '''
+import sys, time
+start = time.time()
+import %s
+seconds = time.time() - start
+import json
+heavy = [name for name in %r if name in sys.modules]
+sys.stdout.write(json.dumps([seconds, heavy]))
+'''
+
+
+def measure(module, repeat=5, python=sys.executable):
+    """Time importing module in repeat fresh interpreters.
+
+    Returns a dict with the best 'import_seconds', the best
+    'startup_seconds' of the whole process, and the 'heavy' modules the
+    import loaded."""
+    best_import = best_startup = float('inf')
+    heavy = []
+    for _ in range(repeat):
+        start = time.time()
+        output = subprocess.check_output(
+            [python, '-c', _CHILD % (module, HEAVY_MODULES)])
+        best_startup = min(best_startup, time.time() - start)
+        (seconds, heavy) = json.loads(output)
+        best_import = min(best_import, seconds)
+    return {'module': module, 'import_seconds': best_import,
+            'startup_seconds': best_startup, 'heavy': heavy}
+
+
+def failures(report, limit):
+    """Messages for a measure() report that breaks a start up limit or
+    imports a heavy module."""
+    messages = []
+    if limit is not None and report['startup_seconds'] > limit:
+        messages.append('%s took %.3f s to start, more than %.3f s'
+                        % (report['module'], report['startup_seconds'], limit))
+    if report['heavy']:
+        messages.append('%s imports %s'
+                        % (report['module'], ', '.join(report['heavy'])))
+    return messages
+
+
+def check(limits=LIMITS, repeat=5):
+    """Return a list of messages for modules that break their limits."""
+    return [message for module in sorted(limits)
+            for message in failures(measure(module, repeat), limits[module])]
+
+
+def import_time_selftest():
+    """Check that the scoring entry point starts fast and stays light."""
+    print('    running self test for import times ...')
+    for failure in check():
+        print('Import time check failed: %s.' % (failure,))
+    print('    self test for import times done.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the time a fresh interpreter takes to import '
+                    'modules.')
+    parser.add_argument('modules', nargs='*', default=sorted(LIMITS))
+    parser.add_argument('--limit', type=float, default=None,
+                        help='fail if a module takes longer to start '
+                        '(default: %r)' % (LIMITS,))
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    failed = []
+    for module in args.modules:
+        report = measure(module, args.repeat)
+        print('%-24s import %.3f s  startup %.3f s  heavy: %s'
+              % (module, report['import_seconds'], report['startup_seconds'],
+                 ', '.join(report['heavy']) or '-'))
+        limit = args.limit if args.limit is not None else LIMITS.get(module)
+        failed.extend(failures(report, limit))
+    for message in failed:
+        print('FAILED: %s' % (message,))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
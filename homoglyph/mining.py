@@ -0,0 +1,210 @@
+"""Choose the training pairs of each epoch, favouring informative ones.
+
+Most pairs of a large training set are easy: negatives that look nothing
+alike and positives that are identical twins, which the model gets right
+after an epoch or two and learns little more from.  A PairMiner trains each
+epoch on per_epoch pairs instead of the whole set, in the set's proportion
+of positives and negatives.  A hard_fraction of each class are the hardest
+of a random pool of candidates: negatives that look most alike, and
+positives that look least alike.  The rest are drawn at random, so the
+model still sees ordinary pairs.  Drawing the hard pairs from a new pool
+every epoch, rather than taking the hardest pairs of the whole set, keeps
+the same few pairs from being trained on over and over.
+
+How alike a pair looks comes from one of
+
+    'random'            nothing; every pair is drawn at random, like
+                        isFast's random.sample but new each epoch
+    'howConfusableAre'  strSimilarity.howConfusableAre, computed once for
+                        every pair of the training set
+    'embedding'         the distance between the current tower's
+                        embeddings, computed for the pool every epoch
+
+compare_sampling() trains with several methods for the same number of pairs
+per epoch, and reports the validation AUC reached after each minute:
+
+    python -m homoglyph.mining data/process_spoof.pkl --per-epoch 2000
+"""
+from __future__ import with_statement
+
+import argparse
+import os
+
+import numpy as np
+
+METHODS = ('random', 'howConfusableAre', 'embedding')
+
+
+class PairMiner(object):
+    """Training pairs for each epoch, chosen from the pairs of train.
+
+    train is a list of (name1, name2, label) tuples.  The choice depends only
+    on seed, the epoch and, for 'embedding', the model, so a resumed run
+    chooses the pairs it would have.  'embedding' needs the RenderCache the
+    model's images come from."""
+
+    def __init__(self, train, per_epoch, method='howConfusableAre',
+                 hard_fraction=0.5, pool=4, seed=0, cache=None):
+        if method not in METHODS:
+            raise ValueError('Unknown mining method: %s' % (method,))
+        if method == 'embedding' and cache is None:
+            raise ValueError('embedding mining needs a RenderCache')
+        self.train = list(train)
+        self.per_epoch = min(per_epoch, len(self.train))
+        self.method = method
+        self.hard_fraction = hard_fraction
+        self.pool = pool
+        self.seed = seed
+        self.cache = cache
+        labels = np.array([x[2] for x in self.train])
+        self._classes = [np.flatnonzero(labels == 0),
+                         np.flatnonzero(labels != 0)]
+        self._scores = None # howConfusableAre of every pair
+
+    def _similarity(self, indices, model):
+        """How alike the pairs at indices look; higher is more alike."""
+        pairs = [self.train[k][:2] for k in indices]
+        if self.method == 'embedding':
+            import encoder
+
+            # the distance offset does not change the order
+            siamese_encoder = encoder.Encoder(model.layers[2], 0.0, self.cache)
+            return -siamese_encoder.score_pairs(pairs)
+        if self._scores is None:
+            from homoglyph import scoring
+
+            self._scores = scoring.score_pairs(
+                [x[:2] for x in self.train], 'howConfusableAre')
+        return self._scores[indices]
+
+    def pairs(self, epoch, model=None):
+        """Return the (name1, name2, label) pairs to train on in epoch."""
+        rng = np.random.RandomState([self.seed, epoch])
+        chosen = []
+        for (label, members) in enumerate(self._classes):
+            n = int(round(self.per_epoch * len(members) /
+                          float(len(self.train))))
+            n_hard = 0 if self.method == 'random' else \
+                int(self.hard_fraction * n)
+            order = rng.permutation(members)
+            candidates = order[:min(self.pool * n_hard, len(order))]
+            hard = np.zeros(0, dtype=np.int64)
+            if n_hard:
+                similarity = self._similarity(candidates, model)
+                # alike negatives and unalike positives are hard
+                hardness = similarity if label == 0 else -similarity
+                hard = candidates[np.argsort(-hardness,
+                                             kind='mergesort')[:n_hard]]
+            rest = np.setdiff1d(order, hard, assume_unique=True)
+            chosen.extend(hard)
+            chosen.extend(rng.permutation(rest)[:n - len(hard)])
+        return [self.train[k] for k in sorted(chosen)]
+
+
+def compare_sampling(cache, train, validate, per_epoch, max_epochs,
+                     methods=METHODS, seed=0, **kwargs):
+    """Train a model for each mining method on the same number of pairs per
+    epoch, and return {method: [[epochs, seconds, validation AUC], ...]}.
+
+    Other keyword arguments go to PairMiner."""
+    from homoglyph import training
+
+    histories = {}
+    for method in methods:
+        print('Training with %s pairs' % (method,))
+        miner = PairMiner(train, per_epoch, method, seed=seed, cache=cache,
+                          **kwargs)
+        validation = []
+        training.train_best(cache, train, validate, max_epochs, seed=seed,
+                            miner=miner, history=validation)
+        histories[method] = validation
+    return histories
+
+
+def auc_by_minute(history, minutes):
+    """Best validation AUC reached within each number of minutes."""
+    return [max([auc for (_, seconds, auc) in history
+                 if seconds <= 60 * minute] or [None])
+            for minute in minutes]
+
+
+def minutes_to_auc(history, target_auc):
+    """Minutes until the validation AUC first reached target_auc, or None."""
+    for (_, seconds, auc) in history:
+        if auc >= target_auc:
+            return seconds / 60.0
+    return None
+
+
+def pair_miner_selftest():
+    """Check PairMiner's class balance, hard pairs and repeatability."""
+    print('    running self test for PairMiner ...')
+    names = ['google', 'goog1e', 'paypal', 'paypa1', 'svchost.exe',
+             'svch0st.exe', 'lsass.exe', '1sass.exe', 'example', 'exarnple']
+    train = [(a, b, int(a != b and a[:2] == b[:2]))
+             for a in names for b in names]
+    miner = PairMiner(train, 30, hard_fraction=0.5, pool=100)
+    pairs = miner.pairs(0)
+    positives = sum(x[2] for x in pairs)
+    if len(pairs) != 30 or positives != 2:
+        print('PairMiner chose %d pairs with %d positives instead of 30 '
+              'with 2.' % (len(pairs), positives))
+    # the pool holds every negative, so the 14 most alike ones are chosen
+    scores = [(miner._scores[k], x) for (k, x) in enumerate(train)
+              if not x[2]]
+    threshold = sorted([score for (score, x) in scores])[-14]
+    if not all(x in pairs for (score, x) in scores if score > threshold):
+        print('PairMiner did not choose the hardest negatives.')
+    if miner.pairs(0) != pairs or miner.pairs(1) == pairs:
+        print('PairMiner did not choose the same pairs for the same epoch.')
+    print('    self test for PairMiner done.')
+
+
+def main():
+    import cPickle as pickle
+
+    from homoglyph import rendering
+
+    parser = argparse.ArgumentParser(
+        description='Compare the validation AUC per minute of training on '
+                    'mined and randomly sampled pairs.')
+    parser.add_argument('dataset', help='pickled dataset from data/')
+    parser.add_argument('--per-epoch', type=int, default=2000,
+                        help='training pairs per epoch')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--methods', nargs='+', choices=METHODS,
+                        default=list(METHODS))
+    parser.add_argument('--hard-fraction', type=float, default=0.5)
+    parser.add_argument('--target-auc', type=float, default=0.99)
+    parser.add_argument('--font', default='Arial.ttf')
+    parser.add_argument('--cache-dir',
+                        default=os.path.join('output', 'render_cache'))
+    args = parser.parse_args()
+
+    with open(args.dataset) as f:
+        data = pickle.load(f)
+    cache = rendering.open_cache(args.cache_dir, args.font)
+    # render every string first, so that no method pays for it
+    cache.rows([st for x in data['train'] + data['validate'] for st in x[:2]])
+    histories = compare_sampling(cache, data['train'], data['validate'],
+                                 args.per_epoch, args.epochs, args.methods,
+                                 hard_fraction=args.hard_fraction)
+
+    longest = max(seconds for history in histories.values()
+                  for (_, seconds, _) in history)
+    minutes = range(1, int(np.ceil(longest / 60.0)) + 1)
+    print('validation AUC reached by minute')
+    print('%-18s%s' % ('method', ''.join('%8d' % m for m in minutes)))
+    for method in args.methods:
+        print('%-18s%s' % (method, ''.join(
+            '%8s' % ('-' if auc is None else '%.4f' % auc)
+            for auc in auc_by_minute(histories[method], minutes))))
+    for method in args.methods:
+        reached = minutes_to_auc(histories[method], args.target_auc)
+        print('%-18s AUC %g after %s' % (
+            method, args.target_auc,
+            'never' if reached is None else '%.1f minutes' % reached))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""Draw the ROC curves from homoglyph.evaluation.evaluate().
+
+Importing this module imports matplotlib, with the Agg backend so that it
+works without a display.
+"""
+import matplotlib
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt
+
+
+def plot_roc(results, title, image_file):
+    """Save a figure of the ROC curves in results to image_file."""
+    fig = plt.figure()
+    plt.plot(results['siamese']['fpr'], results['siamese']['tpr'], 'b',
+             label='Siamese CNN (AUC=%0.2f)' % results['siamese']['auc'])
+    plt.plot(results['editdistance_vs']['fpr'], results['editdistance_vs']['tpr'], 'g',
+             label='Visual edit distance (AUC=%0.2f)' % results['editdistance_vs']['auc'])
+    plt.plot(results['editdistance']['fpr'], results['editdistance']['tpr'], 'r',
+             label='Edit distance (AUC=%0.2f)' % results['editdistance']['auc'])
+    plt.plot(results['editdistance_percent']['fpr'], results['editdistance_percent']['tpr'],
+             label='Percent edit distance (AUC=%0.2f)' % results['editdistance_percent']['auc'])
+    plt.plot([0, 1], [0, 1], 'k', lw=3, linestyle='--')
+    plt.xlim([0.0, 1.0])
+    plt.ylim([0.0, 1.05])
+    plt.xlabel('False Positive Rate')
+    plt.ylabel('True Positive Rate')
+    plt.title('{} - Receiver Operating Characteristic'.format(title))
+    plt.legend(loc="lower right")
+    fig.savefig(image_file)
+    plt.close(fig)
@@ -0,0 +1,32 @@
+"""Render names into the images the siamese model takes.
+
+The images are single channel float32 in tf ordering, (height, width, 1),
+of the lower cased name drawn in black on white, as build_model expects
+them.  They come from a render_cache.RenderCache, which draws each name
+once, with PIL or a glyph atlas, and keeps it on disk.
+"""
+import os
+
+import render_cache
+
+FONT_SIZE = 10
+IMAGE_SIZE = (150, 12) # width, height
+TEXT_LOCATION = (0, 0)
+
+# input shape of the model for IMAGE_SIZE
+DATA_SHAPE = (IMAGE_SIZE[1], IMAGE_SIZE[0], 1)
+
+
+def open_cache(cache_dir, font_location, font_size=FONT_SIZE,
+               image_size=IMAGE_SIZE, text_location=TEXT_LOCATION,
+               backend='pil'):
+    """Return the RenderCache under cache_dir for a font and parameters."""
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return render_cache.RenderCache(cache_dir, font_location, font_size,
+                                    image_size, text_location, backend)
+
+
+def generate_imgs(cache, strings):
+    """Return a (strings, height, width, 1) float32 array of their images."""
+    return cache.images(strings)
@@ -0,0 +1,492 @@
+"""Scan streams of names for spoofs of the names on a watchlist.
+
+Reads domain or process names, one per line, from files or stdin, scores
+each against every watchlist name and writes a JSON line for each name
+that comes close to one:
+
+    python -m homoglyph.scan watchlist.txt dns.log proxy.log
+    tail -f names.log | python -m homoglyph.scan watchlist.txt - -j 4
+
+    {"source": "dns.log", "line": 12, "name": "paypa1.com",
+     "matches": [["paypal.com", 0.9]]}
+
+Backends (-b):
+
+    howConfusableAre  strSimilarity.howConfusableAre() scores, from a
+                      watchlist_trie.WatchlistTrie; alerts at a score of at
+                      least --threshold (default 0.8)
+    editdistance      the edit distance of the lower cased names; alerts at
+                      a distance of at most --threshold (default 1)
+    siamese           the siamese model's distance, from a tower exported
+                      with numpy_tower.py (--tower); alerts at a distance of
+                      at most --threshold, which has no default
+
+A name that is on the watchlist itself, apart from case, is not reported
+as a spoof of itself.  Input is decoded as UTF-8, so that Unicode
+lookalikes are scored as such.
+
+Names are read and scored a batch at a time, and with -j N the batches are
+scored by N worker processes, at most 2N at a time, so memory does not grow
+with the input.  A batch is scored when it has --batch-size names, or
+--max-delay seconds (default 0.5) after its first name was read, so that
+names coming slowly from tail -f are reported within about that long.
+Each worker remembers the matches of the --cache-size names it scored most
+recently, since logs repeat names.  Siamese scoring renders the names
+without adding them to the render cache, and runs in one process; NumPy
+already spreads it over the cores.
+
+A summary with the rate goes to stderr.  With a 2000-name domain watchlist
+and different domain names, on one core, howConfusableAre scans about 700
+names per second, editdistance 1,100 to 1,600 and siamese, with a tower
+of build_model's shape and DejaVu Sans, about 240.  The edit distances
+share nothing between workers, so -j N should scan up to N times as many
+on N cores; that was not measured, on a machine with a single core.
+"""
+from __future__ import with_statement
+
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+import Queue
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+BACKENDS = ('howConfusableAre', 'editdistance', 'siamese')
+DEFAULT_THRESHOLDS = {'howConfusableAre': 0.8, 'editdistance': 1}
+
+# Waiting on a worker with a timeout keeps Ctrl-C working in Python 2
+_WAIT_SECONDS = 1 << 20
+
+# what batches()' reader thread puts after the last item
+_END = object()
+
+
+def read_names(sources):
+    """Yield (source, line number, name) for the non-blank lines of the
+    files in sources, '-' being stdin, decoded as UTF-8."""
+    for source in sources:
+        if source == '-':
+            f = sys.stdin
+        else:
+            f = open(source)
+        try:
+            # readline(), since iterating over a file in Python 2 reads
+            # ahead, and holds back lines from a pipe until its buffer fills
+            for (number, line) in enumerate(iter(f.readline, ''), 1):
+                name = line.strip()
+                if name:
+                    yield (source, number, name.decode('utf-8', 'replace'))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def batches(items, size, max_delay=None):
+    """Yield lists of up to size consecutive items.
+
+    With max_delay, a batch is yielded max_delay seconds after its first
+    item was read, full or not, so that names trickling in from tail -f
+    are scanned as they come.  The items are then read on a thread, at
+    most size ahead, and an empty list is yielded each max_delay seconds
+    that no item comes, for the caller to write the results it has."""
+    items = iter(items)
+    if max_delay is None:
+        while True:
+            batch = list(itertools.islice(items, size))
+            if not batch:
+                return
+            yield batch
+
+    queue = Queue.Queue(size)
+    errors = []
+    def read():
+        try:
+            for item in items:
+                queue.put(item)
+        except Exception, e:
+            errors.append(e)
+        finally:
+            queue.put(_END)
+    reader = threading.Thread(target=read, name='read_names')
+    reader.daemon = True
+    reader.start()
+    while True:
+        try:
+            item = queue.get(True, max_delay)
+        except Queue.Empty:
+            yield []
+            continue
+        batch = []
+        deadline = time.time() + max_delay
+        while item is not _END:
+            batch.append(item)
+            if len(batch) == size:
+                break
+            try:
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    item = queue.get(True, remaining)
+                else:
+                    item = queue.get_nowait()
+            except Queue.Empty:
+                break
+        if batch:
+            yield batch
+        if item is _END:
+            if errors:
+                raise errors[0]
+            return
+
+
+class Scanner(object):
+    """Scores names against a watchlist with one backend.
+
+    threshold is the lowest score, or the largest distance, that is a
+    match; match() returns up to k matches of a name, closest first."""
+
+    def __init__(self, watchlist, backend='howConfusableAre', threshold=None,
+                 k=3, cache_size=100000, encoder=None, index_dir=None):
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend: %s' % (backend,))
+        if threshold is None:
+            threshold = DEFAULT_THRESHOLDS.get(backend)
+        if threshold is None:
+            raise ValueError('The %s backend needs a threshold' % (backend,))
+        self.names = list(watchlist)
+        self.backend = backend
+        self.threshold = threshold
+        self.k = k
+        self._lowered = set(name.lower() for name in self.names)
+        self._cache = collections.OrderedDict() # most recently used last
+        self.cache_size = cache_size
+        if backend == 'howConfusableAre':
+            import watchlist_trie
+            self._trie = watchlist_trie.WatchlistTrie(self.names)
+        elif backend == 'editdistance':
+            import editdistance
+            self._eval = editdistance.eval
+            self._by_length = {}
+            for (idx, name) in enumerate(self.names):
+                self._by_length.setdefault(len(name), []).append(
+                    (idx, name.lower()))
+        else:
+            import embedding_index
+            if encoder is None or index_dir is None:
+                raise ValueError('The siamese backend needs an encoder and '
+                                 'an index of the watchlist')
+            self._encoder = encoder
+            self._index = embedding_index.EmbeddingIndex(index_dir)
+
+    def _not_itself(self, name, matches):
+        """matches without the watchlist names equal to name, up to k."""
+        lowered = name.lower()
+        if lowered in self._lowered:
+            matches = [(other, score) for (other, score) in matches
+                       if other.lower() != lowered]
+        return matches[:self.k]
+
+    def _edit_distance_matches(self, name):
+        lowered = name.lower()
+        limit = int(self.threshold)
+        found = []
+        for length in range(max(0, len(name) - limit), len(name) + limit + 1):
+            for (idx, other) in self._by_length.get(length, ()):
+                distance = self._eval(lowered, other)
+                if distance <= self.threshold:
+                    found.append((distance, idx))
+        found.sort()
+        return [(self.names[idx], distance) for (distance, idx) in found]
+
+    def _score(self, names):
+        """Matches of each of names, without the cache."""
+        if self.backend == 'howConfusableAre':
+            return [self._not_itself(name, self._trie.query(
+                name, self.threshold, self.k + 1)) for name in names]
+        if self.backend == 'editdistance':
+            return [self._not_itself(name, self._edit_distance_matches(name))
+                    for name in names]
+        embeddings = self._encoder.embed_uncached(names)
+        (indices, distances) = self._index.search(embeddings, self.k + 1)
+        result = []
+        for (name, row, row_distances) in zip(names, indices, distances):
+            matches = [(self._index.names[idx], float(distance))
+                       for (idx, distance) in zip(row, row_distances)
+                       if idx >= 0 and distance <= self.threshold]
+            result.append(self._not_itself(name, matches))
+        return result
+
+    def match(self, names):
+        """For each of names, a list of up to k (watchlist name, score)
+        pairs that are matches, closest first."""
+        keys = [name.lower() for name in names]
+        missing = sorted(set(key for key in keys if key not in self._cache))
+        if missing:
+            for (key, matches) in zip(missing, self._score(missing)):
+                self._cache[key] = matches
+        result = []
+        for key in keys:
+            matches = self._cache.pop(key)
+            self._cache[key] = matches # most recently used
+            result.append(matches)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def alerts(self, batch):
+        """(source, line, name, matches) for the names of a batch of
+        read_names() items that have matches."""
+        matches = self.match([name for (_, _, name) in batch])
+        return [(source, number, name, found)
+                for ((source, number, name), found) in zip(batch, matches)
+                if found]
+
+
+# the Scanner of this worker process; set by _init_worker()
+_scanner = None
+
+
+def _init_worker(kwargs):
+    """Build the worker's Scanner once."""
+    global _scanner
+    _scanner = Scanner(**kwargs)
+
+
+def _scan_batch(batch):
+    return _scanner.alerts(batch)
+
+
+def _bounded_imap(pool, function, items, inflight):
+    """Like pool.imap(function, items), but reading items only as far as
+    inflight calls ahead of the results, and yielding the results that are
+    ready each time an item is read.  Empty items are not passed to
+    function."""
+    pending = collections.deque()
+    for item in items:
+        if item:
+            pending.append(pool.apply_async(function, (item,)))
+        while pending and (len(pending) >= inflight or pending[0].ready()):
+            yield pending.popleft().get(_WAIT_SECONDS)
+    while pending:
+        yield pending.popleft().get(_WAIT_SECONDS)
+
+
+def format_alert(source, number, name, matches):
+    """The JSON line of an alert."""
+    return json.dumps({'source': source, 'line': number, 'name': name,
+                       'matches': [[other, score]
+                                   for (other, score) in matches]},
+                      sort_keys=True)
+
+
+def scan(names, scanner_kwargs, out, processes=1, batch_size=1000,
+         max_delay=None):
+    """Write the alerts for the read_names() items names to out, as JSON
+    lines, scoring with Scanner(**scanner_kwargs) on processes workers.
+    A batch of names is scored once it has batch_size names or, with
+    max_delay, max_delay seconds after its first name was read.
+    Returns the count of names and alerts and the seconds it took."""
+    stats = {'names': 0, 'alerts': 0}
+    def counted(items):
+        for batch in items:
+            stats['names'] += len(batch)
+            yield batch
+    start = time.time()
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _init_worker, (scanner_kwargs,))
+        results = _bounded_imap(pool, _scan_batch,
+                                counted(batches(names, batch_size,
+                                                max_delay)),
+                                2 * processes)
+    else:
+        scanner = Scanner(**scanner_kwargs)
+        results = itertools.imap(scanner.alerts,
+                                 itertools.ifilter(None, counted(
+                                     batches(names, batch_size, max_delay))))
+    try:
+        for alerts in results:
+            for alert in alerts:
+                out.write(format_alert(*alert) + '\n')
+            stats['alerts'] += len(alerts)
+            out.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def watchlist_index(names, encoder):
+    """Write an embedding_index of the watchlist names, embedded by
+    encoder, to a new temporary directory, for the caller to remove, and
+    return the directory."""
+    import embedding_index
+
+    index_dir = tempfile.mkdtemp()
+    embedding_index.build_index(index_dir, names, encoder.embed(names),
+                                offset=encoder.offset)
+    return index_dir
+
+
+def read_watchlist(path):
+    """The names in a file of one name per line."""
+    return [name for (_, _, name) in read_names([path])]
+
+
+def scan_selftest():
+    """Check scan() against scoring every name with a Watchlist."""
+    import StringIO
+    import watchlist
+
+    print('    running self test for scan ...')
+    protected = ['paypal.com', 'google.com', 'microsoft.com', 'svchost.exe',
+                 'Explorer.exe']
+    lines = ['paypa1.com', 'google.com', '', 'rnicrosoft.com', 'example.org',
+             'svch0st.exe', u'p\u0430yp\u0430l.com', 'paypa1.com',
+             'EXPLORER.EXE', 'exp1orer.exe'] * 3
+    names = [('test', number, name) for (number, name)
+             in enumerate(lines, 1) if name]
+    exhaustive = watchlist.Watchlist(protected)
+    expected = []
+    for (source, number, name) in names:
+        matches = [(other, score) for (other, score)
+                   in exhaustive.query(name, 0.8, 4)
+                   if other.lower() != name.lower()][:3]
+        if matches:
+            expected.append(format_alert(source, number, name, matches))
+    kwargs = {'watchlist': protected, 'cache_size': 2}
+    for (processes, batch_size) in [(1, 1), (1, 4), (2, 3)]:
+        out = StringIO.StringIO()
+        stats = scan(iter(names), kwargs, out, processes, batch_size)
+        if out.getvalue().splitlines() != expected or \
+                stats['names'] != len(names) or \
+                stats['alerts'] != len(expected):
+            print('scan failed built-in test with %d processes and batches '
+                  'of %d.' % (processes, batch_size))
+            print('    It wrote %r instead of %r.'
+                  % (out.getvalue().splitlines(), expected))
+
+    # names are read only as far as the batches being scored
+    read = []
+    def source():
+        for item in names:
+            read.append(item)
+            yield item
+    pool = multiprocessing.Pool(1, _init_worker, (kwargs,))
+    try:
+        results = _bounded_imap(pool, _scan_batch, batches(source(), 2), 2)
+        results.next()
+        if len(read) > 3 * 2:
+            print('scan read %d names ahead of the first batch.'
+                  % (len(read),))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # with max_delay, names are scanned before the batch fills or the
+    # stream ends, as with tail -f
+    for processes in [1, 2]:
+        out = StringIO.StringIO()
+        written = threading.Event()
+        class Out(object):
+            def write(self, text):
+                out.write(text)
+                written.set()
+            def flush(self):
+                pass
+        def stalling():
+            yield ('test', 1, 'paypa1.com')
+            written.wait(10)
+            yield ('test', 2, 'example.org')
+        start = time.time()
+        stats = scan(stalling(), kwargs, Out(), processes, 1000, 0.05)
+        if time.time() - start > 5 or stats['names'] != 2 or \
+                stats['alerts'] != 1:
+            print('scan with %d processes held back a partial batch: %r.'
+                  % (processes, stats))
+
+    scanner = Scanner(protected, 'editdistance')
+    if scanner.match(['paypa1.com', 'PAYPAL.COM', 'example.org']) != \
+            [[('paypal.com', 1)], [], []]:
+        print('scan failed built-in test for the editdistance backend.')
+    print('    self test for scan done.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Scan names, one per line, for spoofs of watchlist names '
+                    'and write JSON-lines alerts.')
+    parser.add_argument('watchlist', help='file with one protected name per '
+                        'line')
+    parser.add_argument('inputs', nargs='*', default=['-'],
+                        help='files of names to scan, - for stdin (default)')
+    parser.add_argument('-b', '--backend', choices=BACKENDS,
+                        default='howConfusableAre')
+    parser.add_argument('-t', '--threshold', type=float, default=None,
+                        help='lowest score, or largest distance, to report '
+                        '(default: 0.8 for howConfusableAre, 1 for '
+                        'editdistance)')
+    parser.add_argument('-k', type=int, default=3,
+                        help='matches to report per name')
+    parser.add_argument('-j', '--processes', type=int, default=1,
+                        help='worker processes for the edit distances')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--max-delay', type=float, default=0.5,
+                        help='seconds a name waits for its batch to fill '
+                        'before the batch is scored anyway')
+    parser.add_argument('--cache-size', type=int, default=100000,
+                        help='recent names whose matches each worker keeps')
+    parser.add_argument('-o', '--output', help='write the alerts to this '
+                        'file instead of stdout')
+    parser.add_argument('--tower', help='tower .npz from numpy_tower.py, '
+                        'for -b siamese')
+    parser.add_argument('--font', default='Arial.ttf')
+    parser.add_argument('--cache-dir', default='output/render_cache',
+                        help='render cache for the watchlist names')
+    args = parser.parse_args()
+    # stop quietly when the reader of the alerts goes away, like head does
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    if args.threshold is None and args.backend not in DEFAULT_THRESHOLDS:
+        parser.error('-b %s needs --threshold' % (args.backend,))
+    if args.backend == 'siamese' and not args.tower:
+        parser.error('-b siamese needs --tower')
+    if args.max_delay <= 0:
+        parser.error('--max-delay must be positive')
+
+    names = read_watchlist(args.watchlist)
+    kwargs = {'watchlist': names, 'backend': args.backend,
+              'threshold': args.threshold, 'k': args.k,
+              'cache_size': args.cache_size}
+    processes = args.processes
+    index_dir = None
+    if args.backend == 'siamese':
+        from homoglyph import scoring
+        encoder = scoring.load_encoder(args.tower, args.cache_dir, args.font)
+        index_dir = watchlist_index(names, encoder)
+        kwargs.update(encoder=encoder, index_dir=index_dir)
+        processes = 1
+    out = sys.stdout
+    if args.output:
+        out = open(args.output, 'w')
+    try:
+        stats = scan(read_names(args.inputs), kwargs, out, processes,
+                     args.batch_size, args.max_delay)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if index_dir is not None:
+            shutil.rmtree(index_dir)
+    sys.stderr.write('%d names in %.1f s, %.0f names/s, %d alerts\n' % (
+        stats['names'], stats['seconds'],
+        stats['names'] / max(stats['seconds'], 1e-9), stats['alerts']))
+
+
+if __name__ == '__main__':
+    main()
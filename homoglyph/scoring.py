@@ -0,0 +1,96 @@
+"""Score name pairs by edit distance, visual edit distance or the model.
+
+This is the entry point for programs that only score, such as log scanners.
+Importing it imports NumPy; the scorers' own modules (the NIST similarity
+tables, editdistance, the NumPy tower) are imported the first time they are
+used, and Keras, sklearn and matplotlib never are.  The siamese model is
+run from a tower exported with numpy_tower.py.
+
+    python -m homoglyph.scoring pairs.tsv -m howConfusableAre
+    python -m homoglyph.scoring pairs.tsv -m siamese --tower tower.npz
+"""
+from __future__ import with_statement
+
+import argparse
+import sys
+
+import numpy as np
+
+METHODS = ('howConfusableAre', 'editdistance', 'siamese')
+
+
+def load_encoder(npz_file, cache_dir, font_location, backend='pil'):
+    """Encoder for a tower exported by numpy_tower.export_weights, with
+    images from the RenderCache under cache_dir."""
+    import encoder
+    from homoglyph import rendering
+
+    cache = rendering.open_cache(cache_dir, font_location, backend=backend)
+    return encoder.Encoder.load_npz(npz_file, cache)
+
+
+def load_keras_encoder(model_file, weight_file, cache_dir, font_location,
+                       backend='pil'):
+    """Encoder for a Keras tower saved by training.save_model, with images
+    from the RenderCache under cache_dir."""
+    import encoder
+    from homoglyph import rendering
+
+    cache = rendering.open_cache(cache_dir, font_location, backend=backend)
+    return encoder.Encoder.load(model_file, weight_file, cache)
+
+
+def score_pairs(pairs, method='howConfusableAre', siamese_encoder=None,
+                processes=None):
+    """Score (name1, name2) pairs, returning a float64 array in input order.
+
+    'howConfusableAre' gives strSimilarity.howConfusableAre() scores,
+    'editdistance' the edit distance of the lower cased names, both on
+    processes worker processes (default: one per CPU).  'siamese' gives the
+    model's distance from siamese_encoder, an encoder.Encoder; like the edit
+    distance, it is lower for names that look alike."""
+    if method not in METHODS:
+        raise ValueError('Unknown scoring method: %s' % (method,))
+    if method == 'siamese':
+        if siamese_encoder is None:
+            raise ValueError('siamese scoring needs an encoder')
+        return siamese_encoder.score_pairs(pairs).astype(np.float64)
+    import parallel_scoring
+    return parallel_scoring.score_pairs(pairs, method, processes)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Score a file of tab-separated name pairs.')
+    parser.add_argument('pairs', help='file with two tab-separated names '
+                        'per line, or - for stdin')
+    parser.add_argument('-m', '--method', choices=METHODS,
+                        default='howConfusableAre')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='worker processes for the edit distances '
+                        '(default: one per CPU)')
+    parser.add_argument('--tower', help='tower .npz from numpy_tower.py, '
+                        'for -m siamese')
+    parser.add_argument('--font', default='Arial.ttf')
+    parser.add_argument('--cache-dir', default='output/render_cache')
+    args = parser.parse_args()
+    if args.method == 'siamese' and not args.tower:
+        parser.error('-m siamese needs --tower')
+
+    import parallel_scoring
+
+    if args.pairs == '-':
+        pairs = parallel_scoring.read_pairs(sys.stdin)
+    else:
+        with open(args.pairs) as f:
+            pairs = parallel_scoring.read_pairs(f)
+    siamese_encoder = None
+    if args.method == 'siamese':
+        siamese_encoder = load_encoder(args.tower, args.cache_dir, args.font)
+    scores = score_pairs(pairs, args.method, siamese_encoder, args.processes)
+    for score in scores:
+        sys.stdout.write('%r\n' % (score,))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,563 @@
+"""Answer sensors' name lookups over a local socket, in micro-batches.
+
+Proxies and EDR sensors ask about one name at a time, but the siamese
+model spends most of a call on one name in per-call overhead.  The service
+puts the requests of all connections in one queue.  A MicroBatcher thread
+takes the first request and the requests already waiting behind it, up to
+--max-batch in all, and scores the batch with a single scan.Scanner.match()
+call: for the siamese backend, one pass of the tower over the images of the
+batch and one search of the watchlist's embedding index.  Each request is
+then answered on its own connection.  A lone request is scored at once;
+requests only pile up while a batch is being scored, so batches grow with
+the load, and stop taking requests --max-wait after their first.
+
+Python 2 has no asyncio, so each connection is served by a thread
+(SocketServer.ThreadingMixIn) that waits for its request's answer.  Only
+the batcher's thread scores names, so the model and the Scanner's cache
+are used by one thread.
+
+    python -m homoglyph.service serve watchlist.txt --port 8470
+    python -m homoglyph.service serve watchlist.txt --unix /tmp/names.sock \\
+        -b siamese --tower output/process_tower.npz --threshold 0.3
+    python -m homoglyph.service serve watchlist.txt -b siamese \\
+        --model output/process_cnn.json --weights output/process_cnn.h5 \\
+        --threshold 0.3
+
+Over HTTP (HTTP/1.1, so connections are kept open):
+
+    GET /score?name=paypa1.com
+        {"name": "paypa1.com", "spoof": true, "matches": [["paypal.com", 0.9]]}
+    GET /metrics
+        queue depth, batch sizes and latencies, as histograms
+
+Over a unix socket, each line sent is a name, and each answer a JSON line.
+
+The load generator sends names from a file at increasing concurrency and
+reports the throughput and the p50 and p99 latency of each:
+
+    python -m homoglyph.service loadgen names.txt --port 8470 -c 1,8,32
+"""
+from __future__ import with_statement
+
+import argparse
+import bisect
+import BaseHTTPServer
+import httplib
+import json
+import os
+import Queue
+import shutil
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+# upper bounds of the buckets of the latency histograms, in milliseconds,
+# and of the batch size and queue depth histograms; the last bucket has
+# the larger values
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+
+class Histogram(object):
+    """Counts of values by bucket.  Safe to share between threads."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0
+
+    def record(self, value):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def asDict(self):
+        """The counts, mean and maximum, ready for JSON."""
+        with self.lock:
+            labels = ['<=%s' % (bound,) for bound in self.buckets] + \
+                ['>%s' % (self.buckets[-1],)]
+            return {'count': self.count,
+                    'mean': self.total / self.count if self.count else 0,
+                    'max': self.max,
+                    'buckets': [[label, n] for (label, n)
+                                in zip(labels, self.counts)]}
+
+
+class _Request(object):
+    """A name waiting for its answer."""
+    __slots__ = ('name', 'queued', 'done', 'result', 'error')
+
+    def __init__(self, name):
+        self.name = name
+        self.queued = time.time()
+        self.done = threading.Event()
+        self.result = self.error = None
+
+
+class MicroBatcher(object):
+    """Scores single names in batches on one thread.
+
+    score takes a list of names and returns a list of their results.  A
+    batch is scored as soon as no other request is waiting, so a lone
+    request is not held back.  Under load, requests keep coming while one
+    batch is scored, and the next batch takes them, until it has
+    max_batch, or max_wait seconds have passed since its first request
+    was taken."""
+
+    def __init__(self, score, max_batch=64, max_wait=0.005):
+        self.score = score
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = Queue.Queue()
+        self.batchSizes = Histogram(SIZE_BUCKETS)
+        self.queueDepths = Histogram(SIZE_BUCKETS)
+        self.queueWait = Histogram(LATENCY_BUCKETS)
+        self.scoreTime = Histogram(LATENCY_BUCKETS)
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self._thread = threading.Thread(target=self._run,
+                                        name='MicroBatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, name, timeout=None):
+        """Return the result for name, once its batch has been scored."""
+        request = _Request(name)
+        self._queue.put(request)
+        # Event.wait() with a timeout, so that Ctrl-C works in Python 2
+        if not request.done.wait(timeout if timeout is not None else 1 << 20):
+            raise RuntimeError('No answer for %r in time' % (name,))
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close(self):
+        """Stop the scoring thread, after the batches already queued."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _batch(self):
+        """The next batch of requests, or None when closed."""
+        first = self._queue.get()
+        if first is None:
+            return None
+        self.queueDepths.record(self._queue.qsize() + 1)
+        batch = [first]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch and time.time() < deadline:
+            try:
+                request = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None) # close once this batch is answered
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._batch()
+            if batch is None:
+                return
+            start = time.time()
+            try:
+                results = self.score([request.name for request in batch])
+                error = None
+            except Exception, e:
+                results = [None] * len(batch)
+                error = e
+            end = time.time()
+            self.batchSizes.record(len(batch))
+            self.scoreTime.record(1000 * (end - start))
+            for (request, result) in zip(batch, results):
+                self.queueWait.record(1000 * (start - request.queued))
+                self.latency.record(1000 * (end - request.queued))
+                request.result = result
+                request.error = error
+                request.done.set()
+
+    def metrics(self):
+        """Queue depth, batch sizes and latencies in milliseconds, as a
+        dict ready for JSON."""
+        return {'queueDepth': self._queue.qsize(),
+                'maxBatch': self.max_batch,
+                'maxWaitMs': 1000 * self.max_wait,
+                'queueDepths': self.queueDepths.asDict(),
+                'batchSizes': self.batchSizes.asDict(),
+                'queueWaitMs': self.queueWait.asDict(),
+                'scoreMs': self.scoreTime.asDict(),
+                'latencyMs': self.latency.asDict()}
+
+
+def verdict(name, matches):
+    """The JSON answer for name and its scan.Scanner.match() matches."""
+    return json.dumps({'name': name, 'spoof': bool(matches),
+                       'matches': [[other, score]
+                                   for (other, score) in matches]},
+                      sort_keys=True)
+
+
+class _HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep connections open
+    # the headers and body are written apart; with Nagle's algorithm the
+    # body waits for the client's delayed ACK of the headers, 40 ms or so
+    disable_nagle_algorithm = True
+
+    def _reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body) + 1))
+        self.end_headers()
+        self.wfile.write(body + '\n')
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/metrics':
+            self._reply(200, json.dumps(self.server.batcher.metrics(),
+                                        sort_keys=True))
+            return
+        if url.path != '/score':
+            self._reply(404, json.dumps({'error': 'unknown path'}))
+            return
+        names = urlparse.parse_qs(url.query).get('name')
+        if not names:
+            self._reply(400, json.dumps({'error': 'no name'}))
+            return
+        name = names[0].decode('utf-8', 'replace')
+        try:
+            matches = self.server.batcher.submit(name)
+        except Exception, e:
+            self._reply(500, json.dumps({'error': str(e)}))
+            return
+        self._reply(200, verdict(name, matches))
+
+    def log_message(self, format, *args):
+        pass # one line per name is too many
+
+
+class _UnixHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            name = line.strip().decode('utf-8', 'replace')
+            try:
+                answer = verdict(name, self.server.batcher.submit(name))
+            except Exception, e:
+                answer = json.dumps({'name': name, 'error': str(e)})
+            self.wfile.write(answer + '\n')
+            self.wfile.flush()
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Answers /score and /metrics on localhost, one thread a connection."""
+    daemon_threads = True
+    request_queue_size = 128 # so many clients connecting at once
+
+    def __init__(self, port, batcher, host='127.0.0.1'):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _HTTPHandler)
+        self.batcher = batcher
+
+
+class UnixServer(SocketServer.ThreadingUnixStreamServer):
+    """Answers a name a line on a unix socket, one thread a connection."""
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, path, batcher):
+        SocketServer.ThreadingUnixStreamServer.__init__(self, path,
+                                                        _UnixHandler)
+        self.batcher = batcher
+
+
+class _HTTPClient(object):
+    """One kept-open connection to an HTTPServer."""
+
+    def __init__(self, port, host='127.0.0.1'):
+        self.connection = httplib.HTTPConnection(host, port)
+
+    def ask(self, name):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        self.connection.request('GET', '/score?' + urllib.urlencode(
+            {'name': name}))
+        response = self.connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError('HTTP %d: %s' % (response.status, body))
+        return json.loads(body)
+
+    def close(self):
+        self.connection.close()
+
+
+class _UnixClient(object):
+    """One connection to a UnixServer."""
+
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.rfile = self.socket.makefile('rb')
+
+    def ask(self, name):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        self.socket.sendall(name + '\n')
+        return json.loads(self.rfile.readline())
+
+    def close(self):
+        self.rfile.close()
+        self.socket.close()
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def load_test(connect, names, concurrency, requests, start=0):
+    """Send requests names, taken from names in turn from names[start], on
+    concurrency connections at once, each waiting for an answer before its
+    next name.
+
+    connect() returns a new client.  Returns the throughput in requests
+    per second and the p50 and p99 latency in milliseconds."""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(xrange(start, start + requests))
+    def client():
+        connection = connect()
+        mine = []
+        try:
+            while True:
+                with lock:
+                    k = next(counter, None)
+                if k is None:
+                    break
+                start = time.time()
+                connection.ask(names[k % len(names)])
+                mine.append(1000 * (time.time() - start))
+        except Exception, e:
+            errors.append(e)
+        finally:
+            connection.close()
+            with lock:
+                latencies.extend(mine)
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+    if errors:
+        raise errors[0]
+    latencies.sort()
+    return {'concurrency': concurrency, 'requests': len(latencies),
+            'seconds': seconds, 'throughput': len(latencies) / seconds,
+            'p50Ms': _percentile(latencies, .5),
+            'p99Ms': _percentile(latencies, .99)}
+
+
+def make_scanner(watchlist, backend='howConfusableAre', threshold=None, k=3,
+                 tower=None, font='Arial.ttf', cache_dir='output/render_cache',
+                 model=None, weights=None):
+    """A scan.Scanner for the service, and the directory of its index to
+    remove when done (None if there is none).
+
+    The siamese backend runs the NumPy tower in tower if given, or else the
+    Keras model in the model and weights files."""
+    from homoglyph import scan
+
+    kwargs = {'watchlist': watchlist, 'backend': backend,
+              'threshold': threshold, 'k': k}
+    index_dir = None
+    if backend == 'siamese':
+        from homoglyph import scoring
+        if tower:
+            encoder = scoring.load_encoder(tower, cache_dir, font)
+        else:
+            encoder = scoring.load_keras_encoder(model, weights, cache_dir,
+                                                 font)
+        index_dir = scan.watchlist_index(watchlist, encoder)
+        kwargs.update(encoder=encoder, index_dir=index_dir)
+    return (scan.Scanner(**kwargs), index_dir)
+
+
+def service_selftest():
+    """Check the answers of both servers, that concurrent requests are
+    batched, and that a lone request does not wait out max_wait."""
+    import tempfile
+    from homoglyph import scan
+
+    print('    running self test for service ...')
+    protected = ['paypal.com', 'google.com', 'microsoft.com', 'svchost.exe']
+    names = ['paypa1.com', 'example.org', 'rnicrosoft.com', 'svch0st.exe',
+             u'g\u043e\u043egle.com', 'paypal.com']
+    expected = scan.Scanner(protected).match(names)
+    scanner = scan.Scanner(protected)
+    batcher = MicroBatcher(scanner.match, max_batch=8, max_wait=0.5)
+    http = HTTPServer(0, batcher)
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'service.sock')
+    unix = UnixServer(path, batcher)
+    for server in (http, unix):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    try:
+        port = http.server_address[1]
+        for connect in (lambda: _HTTPClient(port), lambda: _UnixClient(path)):
+            client = connect()
+            try:
+                answers = [client.ask(name) for name in names]
+            finally:
+                client.close()
+            for (name, answer, matches) in zip(names, answers, expected):
+                if answer != json.loads(verdict(name, matches)):
+                    print('service failed built-in test for %r.' % (name,))
+                    print('    It answered %r instead of %r.'
+                          % (answer, verdict(name, matches)))
+
+        start = time.time()
+        batcher.submit('paypa1.com')
+        if time.time() - start >= batcher.max_wait:
+            print('service held a lone request for %.3f s.'
+                  % (time.time() - start,))
+
+        batcher.batchSizes.reset()
+        result = load_test(lambda: _HTTPClient(port), names, 8, 64)
+        sizes = batcher.metrics()['batchSizes']
+        if result['requests'] != 64 or sizes['count'] >= 64 or \
+                sizes['mean'] <= 1:
+            print('service did not batch concurrent requests: %r, %r.'
+                  % (result, sizes))
+        metrics = _HTTPClient(port)
+        try:
+            metrics.connection.request('GET', '/metrics')
+            keys = set(json.loads(metrics.connection.getresponse().read()))
+        finally:
+            metrics.close()
+        if not set(['queueDepth', 'batchSizes', 'latencyMs']) <= keys:
+            print('service metrics are missing: %r.' % (sorted(keys),))
+    finally:
+        http.shutdown()
+        unix.shutdown()
+        http.server_close()
+        unix.server_close()
+        batcher.close()
+        shutil.rmtree(tmp_dir)
+    print('    self test for service done.')
+
+
+def serve(args):
+    from homoglyph import scan
+
+    watchlist = scan.read_watchlist(args.watchlist)
+    (scanner, index_dir) = make_scanner(
+        watchlist, args.backend, args.threshold, args.k, args.tower,
+        args.font, args.cache_dir, args.model, args.weights)
+    batcher = MicroBatcher(scanner.match, args.max_batch,
+                           args.max_wait / 1000.0)
+    if args.unix:
+        server = UnixServer(args.unix, batcher)
+    else:
+        server = HTTPServer(args.port, batcher)
+    sys.stderr.write('serving %d names on %s\n' % (
+        len(watchlist), args.unix or 'http://127.0.0.1:%d/' % (args.port,)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if args.unix:
+            os.remove(args.unix)
+        if index_dir is not None:
+            shutil.rmtree(index_dir)
+
+
+def loadgen(args):
+    with open(args.names) as f:
+        names = [line.strip() for line in f if line.strip()]
+    if args.unix:
+        connect = lambda: _UnixClient(args.unix)
+    else:
+        connect = lambda: _HTTPClient(args.port)
+    print('%11s %10s %10s %10s' % ('concurrency', 'names/s', 'p50 ms',
+                                   'p99 ms'))
+    start = 0
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        # new names for each concurrency, past the service's cache of the
+        # last ones, as long as names lasts
+        result = load_test(connect, names, concurrency, args.requests, start)
+        start += args.requests
+        print('%11d %10.0f %10.1f %10.1f' % (
+            concurrency, result['throughput'], result['p50Ms'],
+            result['p99Ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Answer name lookups on a local socket in micro-batches, '
+                    'or load test a running service.')
+    commands = parser.add_subparsers()
+
+    serve_parser = commands.add_parser('serve', help='run the service')
+    serve_parser.set_defaults(command=serve)
+    serve_parser.add_argument('watchlist', help='file with one protected '
+                              'name per line')
+    serve_parser.add_argument('-b', '--backend', default='howConfusableAre',
+                              choices=('howConfusableAre', 'editdistance',
+                                       'siamese'))
+    serve_parser.add_argument('-t', '--threshold', type=float, default=None,
+                              help='as for homoglyph.scan')
+    serve_parser.add_argument('-k', type=int, default=3)
+    serve_parser.add_argument('--max-batch', type=int, default=64)
+    serve_parser.add_argument('--max-wait', type=float, default=5,
+                              help='most milliseconds a batch keeps taking '
+                              'waiting requests after its first')
+    serve_parser.add_argument('--tower', help='tower .npz from '
+                              'numpy_tower.py, for -b siamese')
+    serve_parser.add_argument('--model', help='Keras model .json from '
+                              'run_siamese.py, for -b siamese without --tower')
+    serve_parser.add_argument('--weights', help='weights .h5 for --model')
+    serve_parser.add_argument('--font', default='Arial.ttf')
+    serve_parser.add_argument('--cache-dir', default='output/render_cache')
+
+    load_parser = commands.add_parser('loadgen', help='load test a service')
+    load_parser.set_defaults(command=loadgen)
+    load_parser.add_argument('names', help='file of names to send, one per '
+                             'line')
+    load_parser.add_argument('-c', '--concurrency', default='1,4,16,64',
+                             help='comma separated connection counts')
+    load_parser.add_argument('-n', '--requests', type=int, default=2000,
+                             help='requests at each concurrency')
+
+    for subparser in (serve_parser, load_parser):
+        subparser.add_argument('--port', type=int, default=8470)
+        subparser.add_argument('--unix', help='unix socket path instead of '
+                               'HTTP on localhost')
+    args = parser.parse_args()
+    if args.command is serve and args.backend == 'siamese' and \
+            (not (args.tower or args.model and args.weights) or
+             args.threshold is None):
+        parser.error('-b siamese needs --tower, or --model and --weights, '
+                     'and --threshold')
+    args.command(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+"""Build and train the siamese model.
+
+Importing this module imports Keras and its backend.  Datasets are lists of
+(name1, name2, label) tuples, with label 1 for a spoof and 0 otherwise, and
+the images come from a RenderCache (see homoglyph.rendering).
+
+train_best() trains once, keeping the weights from the epoch with the best
+validation AUC, and can stop early and resume an interrupted run from the
+checkpoint it writes after every epoch.
+"""
+from __future__ import with_statement
+
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+import encoder
+import pair_batches
+
+from keras.callbacks import Callback
+from keras.layers import Dense, Input, Lambda, Flatten, Convolution2D, MaxPooling2D
+from keras.layers.advanced_activations import LeakyReLU
+from keras.models import Sequential, Model
+from keras import backend as K
+from keras.optimizers import RMSprop
+from sklearn.metrics import roc_auc_score
+
+from homoglyph import rendering
+
+# files of a checkpoint directory; the weights are kept for the last epoch
+# and the best one, the optimizer state for the last one
+STATE_FILE = 'state.json'
+WEIGHTS_FILE = 'epoch_%03d.h5'
+OPTIMIZER_FILE = 'epoch_%03d.npz'
+
+
+def generate_batches(cache, pairs, batch_size=8, seed=None, start_epoch=0):
+    """Stream ([X1, X2], y) batches instead of holding every image in memory."""
+    return pair_batches.PairBatches(cache, [(x[0], x[1]) for x in pairs],
+                                    [x[2] for x in pairs],
+                                    batch_size=batch_size, seed=seed,
+                                    start_epoch=start_epoch)
+
+
+class ValidationAUC(Callback):
+    """Track the epoch with the best AUC on the validation pairs.
+
+    Each epoch the tower embeds every unique validation string once, and the
+    pairs are scored from the embeddings.  The weights of the best epoch are
+    kept in best_weights, and state['history'] lists [epochs, seconds since
+    started, AUC] for every epoch.  With a checkpoint_dir, the weights, the
+    optimizer state and state are written there after every epoch.  With
+    patience, training stops after that many epochs without a better AUC.
+    """
+    def __init__(self, cache, validate, checkpoint_dir=None, patience=None,
+                 state=None):
+        super(ValidationAUC, self).__init__()
+        self.cache = cache
+        self.pairs = [(x[0], x[1]) for x in validate]
+        self.y_valid = [x[2] for x in validate]
+        self.checkpoint_dir = checkpoint_dir
+        self.patience = patience
+        self.state = {'epochs': 0, 'max_auc': 0.0, 'max_idx': 0,
+                      'stopped': False, 'seconds': 0.0, 'history': []}
+        self.state.update(state or {})
+        self.best_weights = None
+        # wall clock time training started, less time spent before a resume
+        self.started = time.time() - self.state['seconds']
+
+    @property
+    def max_auc(self):
+        return self.state['max_auc']
+
+    @property
+    def max_idx(self):
+        return self.state['max_idx']
+
+    def on_epoch_end(self, epoch, logs=None):
+        # the distance offset does not change the order of the scores
+        siamese_encoder = encoder.Encoder(self.model.layers[2], 0.0,
+                                          self.cache)
+        scores = -siamese_encoder.score_pairs(self.pairs)
+
+        t_auc = roc_auc_score(self.y_valid, scores)
+        self.state['epochs'] = epoch+1
+        self.state['seconds'] = time.time() - self.started
+        self.state['history'].append([epoch+1, self.state['seconds'], t_auc])
+        print('Validation AUC %f after %.1f minutes'
+              % (t_auc, self.state['seconds'] / 60))
+        if t_auc > self.max_auc:
+            print('Updated best AUC from %f to %f' % (self.max_auc, t_auc))
+            self.state['max_auc'] = t_auc
+            self.state['max_idx'] = epoch+1
+            self.best_weights = self.model.get_weights()
+        elif self.patience is not None and \
+                epoch+1 - self.max_idx >= self.patience:
+            print('No better AUC for %d epochs, stopping' % (self.patience,))
+            self.state['stopped'] = True
+            self.model.stop_training = True
+        if self.checkpoint_dir:
+            save_checkpoint(self.model, self.checkpoint_dir, self.state)
+
+
+def save_checkpoint(model, checkpoint_dir, state):
+    """Write the weights and optimizer state of epoch state['epochs'], then
+    the state, and remove the files no longer needed.  The state is
+    replaced atomically and written last, so it only ever names files that
+    are complete."""
+    epochs = state['epochs']
+    model.save_weights(os.path.join(checkpoint_dir, WEIGHTS_FILE % epochs),
+                       overwrite=True)
+    with open(os.path.join(checkpoint_dir, OPTIMIZER_FILE % epochs),
+              'wb') as f:
+        np.savez(f, *model.optimizer.get_weights())
+    state_file = os.path.join(checkpoint_dir, STATE_FILE)
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.rename(state_file + '.tmp', state_file)
+
+    keep = set([WEIGHTS_FILE % epochs, OPTIMIZER_FILE % epochs,
+                WEIGHTS_FILE % state['max_idx']])
+    for name in os.listdir(checkpoint_dir):
+        if name.startswith('epoch_') and name not in keep:
+            os.remove(os.path.join(checkpoint_dir, name))
+
+
+def load_checkpoint(model, checkpoint_dir, state):
+    """Read the state of the checkpoint in checkpoint_dir, if there is one
+    for the same data (state['data']), into state, and load the weights and
+    optimizer state of its last epoch into model.  Returns True if it did."""
+    state_file = os.path.join(checkpoint_dir, STATE_FILE)
+    if not os.path.isfile(state_file):
+        return False
+    with open(state_file) as f:
+        saved = json.load(f)
+    if saved.get('data') != state['data']:
+        print('Checkpoint in %s is for other data, starting over'
+              % (checkpoint_dir,))
+        return False
+    state.update(saved)
+    if state['epochs']:
+        model.load_weights(os.path.join(checkpoint_dir,
+                                        WEIGHTS_FILE % state['epochs']))
+        # the optimizer creates its state with the training function
+        model._make_train_function()
+        with open(os.path.join(checkpoint_dir,
+                               OPTIMIZER_FILE % state['epochs']), 'rb') as f:
+            npz = np.load(f)
+            model.optimizer.set_weights([npz['arr_%d' % k]
+                                         for k in range(len(npz.files))])
+    print('Resuming from epoch %d of %s' % (state['epochs'], checkpoint_dir))
+    return True
+
+
+def data_digest(train, validate):
+    """Hash of the training and validation pairs a checkpoint belongs to."""
+    digest = hashlib.sha1()
+    for pairs in (train, validate):
+        for x in pairs:
+            digest.update(repr(x))
+        digest.update('\n')
+    return digest.hexdigest()
+
+
+def euclidean_distance(vects):
+    x, y = vects
+    return K.sqrt(K.sum(K.square(x - y)+np.random.rand()*.0001, axis=1, keepdims=True))
+
+
+def eucl_dist_output_shape(shapes):
+    shape1, shape2 = shapes
+    return (shape1[0], 1)
+
+
+def contrastive_loss(y_true, y_pred):
+    '''Contrastive loss from Hadsell-et-al.'06
+    http://yann.lecun.com/exdb/publis/pdf/hadsell-chopra-lecun-06.pdf
+    '''
+    margin = 1
+    return K.mean(y_true * K.square(y_pred) + (1 - y_true) * K.square(K.maximum(margin - y_pred, 0)), axis=-1, keepdims=False)
+
+
+def build_model(data_shape=rendering.DATA_SHAPE):
+    model = Sequential()
+
+    model.add(Convolution2D(128, 5, 5, input_shape=data_shape))
+    model.add(LeakyReLU(alpha=.1))
+
+    model.add(MaxPooling2D(pool_size=(2, 2)))
+
+    model.add(Convolution2D(64, 3, 3))
+    model.add(LeakyReLU(alpha=.1))
+
+    model.add(MaxPooling2D(pool_size=(2, 2)))
+
+    model.add(Flatten())
+    model.add(Dense(32))
+
+    input_a = Input(shape=data_shape)
+    input_b = Input(shape=data_shape)
+
+    processed_a = model(input_a)
+    processed_b = model(input_b)
+
+    distance = Lambda(euclidean_distance, output_shape=eucl_dist_output_shape)([processed_a, processed_b])
+
+    model = Model(input=[input_a, input_b], output=distance)
+
+    # # train
+    rms = RMSprop()
+    model.compile(loss=contrastive_loss, optimizer=rms)
+
+    return model
+
+
+def train_best(cache, train, validate, max_epochs, checkpoint_dir=None,
+               patience=None, seed=None, miner=None, history=None):
+    """Train a new model for up to max_epochs epochs, and return (model,
+    epochs, AUC) with the weights of the epoch with the best validation AUC.
+
+    Training stops early after patience epochs without a better AUC.  With
+    a checkpoint_dir, a run that was interrupted continues from its last
+    epoch, with the same order of training pairs, and a run that finished
+    returns its best model without training.
+
+    With a miner, a homoglyph.mining.PairMiner, each epoch trains on the
+    pairs miner.pairs() chooses from train for it instead of all of them.
+    If history is a list, [epochs, seconds, validation AUC] of every epoch
+    is appended to it."""
+    model = build_model(cache.shape + (1,))
+    state = {'data': data_digest(train, validate), 'seed': seed}
+    resumed = False
+    if checkpoint_dir:
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        resumed = load_checkpoint(model, checkpoint_dir, state)
+    if state['seed'] is None:
+        state['seed'] = np.random.randint(2**31)
+
+    validation = ValidationAUC(cache, validate, checkpoint_dir, patience, state)
+    state = validation.state
+    if miner is None and not state['stopped'] and state['epochs'] < max_epochs:
+        train_batches = generate_batches(cache, train, seed=state['seed'],
+                                         start_epoch=state['epochs'])
+        model.fit_generator(train_batches, train_batches.samples_per_epoch, max_epochs, callbacks=[validation], initial_epoch=state['epochs'])
+        train_batches.close()
+    elif miner is not None:
+        # one epoch at a time, each on its own pairs
+        while not state['stopped'] and state['epochs'] < max_epochs:
+            epoch = state['epochs']
+            train_batches = generate_batches(cache, miner.pairs(epoch, model),
+                                             seed=state['seed'],
+                                             start_epoch=epoch)
+            model.fit_generator(train_batches, train_batches.samples_per_epoch, epoch+1, callbacks=[validation], initial_epoch=epoch)
+            train_batches.close()
+
+    if history is not None:
+        history.extend(state['history'])
+    if validation.best_weights is not None:
+        model.set_weights(validation.best_weights)
+    elif resumed and state['max_idx']:
+        model.load_weights(os.path.join(checkpoint_dir,
+                                        WEIGHTS_FILE % state['max_idx']))
+    return (model, state['max_idx'], state['max_auc'])
+
+
+def save_model(model, model_file, weight_file):
+    """Save the model the way encoder.Encoder.load reads it back."""
+    json_string = model.to_json()
+    model.save_weights(weight_file, overwrite=True)
+    with open(model_file, 'wb') as f:
+        f.write(json_string)
+
+
+def train_best_selftest(font_location):
+    """Check that train_best keeps the best epoch and resumes."""
+    import shutil
+    import tempfile
+
+    print('    running self test for train_best ...')
+    names = ['google', 'goog1e', 'paypal', 'paypa1', 'svchost.exe',
+             'svch0st.exe', 'lsass.exe', '1sass.exe', 'example', 'exarnple']
+    pairs = [(a, b, float(a[:3] == b[:3] or a[-3:] == b[-3:]))
+             for a in names for b in names]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cache = rendering.open_cache(os.path.join(tmp_dir, 'cache'),
+                                     font_location)
+        checkpoint_dir = os.path.join(tmp_dir, 'checkpoint')
+        train_best(cache, pairs, pairs, 2, checkpoint_dir, seed=1)
+        (model, epochs, best_auc) = train_best(cache, pairs, pairs, 3,
+                                               checkpoint_dir)
+        with open(os.path.join(checkpoint_dir, STATE_FILE)) as f:
+            state = json.load(f)
+        if state['epochs'] != 3 or state['seed'] != 1:
+            print('train_best did not resume: %r' % (state,))
+        siamese_encoder = encoder.Encoder.from_model(model, cache)
+        scores = -siamese_encoder.score_pairs([x[:2] for x in pairs])
+        found = roc_auc_score([x[2] for x in pairs], scores)
+        if abs(found - best_auc) > 1e-6:
+            print('train_best returned a model with AUC %f instead of %f.'
+                  % (found, best_auc))
+        expected = set([WEIGHTS_FILE % 3, OPTIMIZER_FILE % 3,
+                        WEIGHTS_FILE % epochs, STATE_FILE])
+        if set(os.listdir(checkpoint_dir)) != expected:
+            print('train_best left %r in its checkpoint.'
+                  % (sorted(os.listdir(checkpoint_dir)),))
+    finally:
+        shutil.rmtree(tmp_dir)
+    print('    self test for train_best done.')
@@ -0,0 +1,232 @@
+"""Candidate generation for large watchlists with an n-gram inverted index.
+
+Names are folded with skeleton.visualSkeleton(name, level, transitive=True),
+so that characters and digraphs that look alike according to
+charSimilarity's tables become the same character, and split into
+overlapping n-grams.  Characters past ASCII in unicode names are first
+replaced by the ASCII character unicode_confusables.txt says they look
+like.  A query returns the names that share enough folded n-grams with it;
+only those need the edit distance.
+
+How many is enough follows from the q-gram lemma.  An edit changes at most
+n of the query's n-grams, a transposition n + 1, and an edit that
+folding does not hide costs at least minEditCost(level), so a name within
+distance d of the query shares all but (n + 1)*d/minEditCost(level) of
+them.  d is the largest distance that still scores min_score against a
+name of that length (strSimilarity.maxLevenshteinFor).  Sharing a padded
+.com n-gram with the query is no longer enough.
+
+The bound is not exact: a repetition can be deleted for less than
+minEditCost(level).  measureRecall() measures what that costs against
+scoring every name, to tune n, or set a fixed min_overlap, for a
+watchlist.
+"""
+from __future__ import with_statement
+
+import argparse
+import time
+
+import numpy as np
+
+import charSimilarity
+import skeleton
+import strSimilarity
+import watchlist
+
+# marks the start and end of a name, so short names have n-grams too
+PAD = '\x00'
+
+# the cheapest 2 for 2 digraph substitution, like mn for nm; folding leaves
+# those alone at any level
+digraphSwapCost = min([1 - similarity for ((str1, str2), similarity)
+                       in charSimilarity.dcsimtab.items()
+                       if len(str1) == len(str2) == 2 and similarity > 0] +
+                      [1])
+
+# {level: {character past ASCII: the ASCII character it folds into}}
+_unicodeFolds = {}
+
+
+def minEditCost(level):
+    """The least an edit that folding at level does not hide can cost."""
+    return min(1 - level, digraphSwapCost)
+
+
+def unicodeFolds(level):
+    """Map the characters past ASCII that are at least level similar to an
+    ASCII character to that character, from unicode_confusables.txt."""
+    if level not in _unicodeFolds:
+        import unicode_confusables
+        folds = {}
+        best = {}
+        for ((ch1, ch2), similarity) in \
+                unicode_confusables.readDataFile().items():
+            if ord(ch2) < 128 <= ord(ch1) and similarity >= level and \
+                    similarity > best.get(ch1, 0):
+                folds[ch1] = ch2
+                best[ch1] = similarity
+        _unicodeFolds[level] = folds
+    return _unicodeFolds[level]
+
+
+def foldedNgrams(name, n, level):
+    """Return the set of n-grams of name after visual folding."""
+    if isinstance(name, unicode) and any(ord(ch) >= 128 for ch in name):
+        folds = unicodeFolds(level)
+        name = u''.join(folds.get(ch, ch) for ch in name.lower())
+    folded = skeleton.visualSkeleton(name, level, transitive=True)
+    padded = PAD*(n-1) + folded + PAD*(n-1)
+    return set(padded[k:k+n] for k in range(len(padded) - n + 1))
+
+
+class NgramIndex(object):
+    """Inverted index from folded n-grams to watchlist names.
+
+    candidates() keeps the names sharing at least min_overlap n-grams with
+    the query, or, if min_overlap is None, as many as the q-gram bound
+    for min_score asks of each."""
+
+    def __init__(self, names, n=3, level=0.3, min_overlap=None,
+                 min_score=0.8):
+        self.names = list(names)
+        self.n = n
+        self.level = level
+        self.min_overlap = min_overlap
+        self.min_score = min_score
+        self._lengths = np.array([len(name) for name in self.names],
+                                 dtype=np.float64)
+        postings = {}
+        for idx, name in enumerate(self.names):
+            for gram in foldedNgrams(name, n, level):
+                postings.setdefault(gram, []).append(idx)
+        self._postings = dict((gram, np.array(members, dtype=np.int32))
+                              for (gram, members) in postings.items())
+
+    def requiredOverlap(self, name, grams, min_score):
+        """The n-grams each watchlist name must share with name, out of
+        its grams, to be within reach of min_score."""
+        maxlen = np.maximum(self._lengths, len(name))
+        lendiff = np.abs(self._lengths - len(name))
+        maxDist = strSimilarity.maxLevenshteinFor(maxlen, lendiff, min_score)
+        # the edits that distance pays for, if none is folded away
+        edits = np.floor(maxDist / minEditCost(self.level) + 1e-9)
+        return len(grams) - (self.n + 1) * edits
+
+    def candidates(self, name, min_overlap=None, min_score=None):
+        """Indices of the names sharing enough n-grams with name."""
+        if min_overlap is None:
+            min_overlap = self.min_overlap
+        if min_score is None:
+            min_score = self.min_score
+        grams = foldedNgrams(name, self.n, self.level)
+        if min_overlap is None:
+            min_overlap = self.requiredOverlap(name, grams, min_score)
+        hits = [self._postings[gram] for gram in grams
+                if gram in self._postings]
+        if hits:
+            counts = np.bincount(np.concatenate(hits),
+                                 minlength=len(self.names))
+        else:
+            counts = np.zeros(len(self.names), dtype=np.int64)
+        return np.flatnonzero(counts >= min_overlap)
+
+
+def measureRecall(names, queries, min_score, ns=(2, 3),
+                  overlaps=(None, 1, 2, 3), level=0.3):
+    """Measure the recall of NgramIndex against scoring every name.
+
+    For each n and min_overlap (None for the q-gram bound), returns a dict
+    with the fraction of the (query, name) pairs scoring at least min_score
+    that the index returns ('recall'), the average fraction of the
+    watchlist it returns ('candidates'), and the query time in seconds
+    ('seconds').  The pairs
+    scoring at least min_score come from a Watchlist without an index,
+    which gives the same answer as scoring every name.
+    """
+    names = list(names)
+    exhaustive = watchlist.Watchlist(names)
+    truth = [set(name for (name, score) in exhaustive.query(query, min_score))
+             for query in queries]
+    relevant = sum(len(found) for found in truth)
+
+    results = []
+    for n in ns:
+        index = NgramIndex(names, n=n, level=level)
+        for min_overlap in overlaps:
+            start = time.time()
+            candidates = [set(names[idx]
+                              for idx in index.candidates(query, min_overlap,
+                                                          min_score))
+                          for query in queries]
+            seconds = time.time() - start
+            recalled = sum(len(found & cands)
+                           for (found, cands) in zip(truth, candidates))
+            returned = sum(len(cands) for cands in candidates)
+            results.append({
+                'n': n,
+                'min_overlap': min_overlap,
+                'recall': float(recalled)/relevant if relevant else 1.0,
+                'candidates': float(returned)/(len(names)*len(queries)),
+                'seconds': seconds,
+            })
+    return results
+
+
+def ngramIndex_selftest():
+    """Check that a Watchlist with an NgramIndex gives the same answers as
+    one without, and that the index leaves out names only sharing .com."""
+    print('    running self test for NgramIndex ...')
+    corpus = sorted(set(st for (str1, str2, _) in
+                        strSimilarity.levenshteinTestCases +
+                        strSimilarity.howConfusableAreTestCases
+                        for st in (str1, str2) if len(st) < 40))
+    exhaustive = watchlist.Watchlist(corpus)
+    for n in [2, 3]:
+        indexed = watchlist.Watchlist(corpus, NgramIndex(corpus, n=n))
+        for name in corpus:
+            for min_score in [0, .3, .6, .8, .9]:
+                result = indexed.query(name, min_score)
+                expected = exhaustive.query(name, min_score)
+                if result != expected:
+                    print('NgramIndex failed built-in test for %r, n %r and '
+                          'min_score %r.' % (name, n, min_score))
+                    print('    It returned %r instead of %r.'
+                          % (result, expected))
+
+    syllables = ['ba', 'co', 'de', 'fi', 'go', 'ka', 'li', 'mo', 'pa', 'te']
+    names = ['%s%s%s.com' % (a, b, c) for a in syllables for b in syllables
+             for c in syllables]
+    indexed = watchlist.Watchlist(names, NgramIndex(names))
+    result = indexed.query('bac0de.com', .8)
+    stats = indexed.lastQueryStats
+    if result != watchlist.Watchlist(names).query('bac0de.com', .8) or \
+            stats['filtered'] < .9 * len(names):
+        print('NgramIndex failed to filter a .com watchlist: %r, %r.'
+              % (result, stats))
+    print('    self test for NgramIndex done.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure n-gram candidate recall for a watchlist.')
+    parser.add_argument('watchlist', help='file with one protected name per line')
+    parser.add_argument('queries', help='file with one query name per line')
+    parser.add_argument('--min-score', type=float, default=0.8)
+    parser.add_argument('--level', type=float, default=0.3)
+    args = parser.parse_args()
+
+    with open(args.watchlist) as f:
+        names = [line.strip() for line in f if line.strip()]
+    with open(args.queries) as f:
+        queries = [line.strip() for line in f if line.strip()]
+    print('n  min_overlap  recall  candidates  seconds')
+    for result in measureRecall(names, queries, args.min_score,
+                                level=args.level):
+        min_overlap = result['min_overlap']
+        print('%d  %11s  %6.4f  %10.4f  %7.3f' % (
+            result['n'], 'bound' if min_overlap is None else min_overlap,
+            result['recall'], result['candidates'], result['seconds']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+"""Run the tower of a trained siamese model with NumPy alone.
+
+Scoring only needs the tower's forward pass, and importing Keras and its
+backend for it takes seconds and hundreds of MB per process.
+export_weights() writes the tower's layers and weights, and the offset
+encoder.Encoder measures, to a plain .npz file.  NumpyTower reads it back
+and computes the same embeddings with im2col convolutions and matrix
+products, and this module imports nothing but NumPy at the top.
+
+With int8=True the convolution and dense weights are stored as int8 with
+one float32 scale per output channel, a quarter of the size, and are turned
+back into float32 when loaded.  The activations are not quantized.
+compare() measures how far the embeddings and the AUC move.
+"""
+from __future__ import with_statement
+
+import argparse
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# layer kinds NumpyTower knows, by Keras class name
+LAYER_KINDS = {'Convolution2D': 'conv', 'LeakyReLU': 'leaky',
+               'MaxPooling2D': 'pool', 'Flatten': 'flatten', 'Dense': 'dense'}
+
+
+def _check(layer, key, value):
+    """Raise ValueError unless a layer's config has key set to value."""
+    config = layer.get_config()
+    if config.get(key, value) != value:
+        raise ValueError('%s layer %s has %s %r, only %r is supported'
+                         % (type(layer).__name__, layer.name, key,
+                            config[key], value))
+
+
+def quantize(W):
+    """Quantize W to int8 with one scale per output channel (last axis).
+
+    Returns (int8 array, float32 scales); W is about their product."""
+    peak = np.abs(W).reshape(-1, W.shape[-1]).max(axis=0)
+    scale = np.where(peak > 0, peak / 127.0, 1.0).astype(np.float32)
+    return (np.round(W / scale).astype(np.int8), scale)
+
+
+def export_weights(model, npz_file, int8=False):
+    """Write the tower of a siamese model built by build_model to npz_file.
+
+    model is the Keras model run_siamese.py saves; its layers are input a,
+    input b, the tower and the distance.  Raises ValueError for a tower
+    NumpyTower cannot run."""
+    tower = model.layers[2]
+    arrays = {'input_shape': np.array(tower.input_shape[1:]),
+              'int8': np.array(int8)}
+    kinds = []
+    for k, layer in enumerate(tower.layers):
+        name = type(layer).__name__
+        if name not in LAYER_KINDS:
+            raise ValueError('NumpyTower cannot run %s layers' % (name,))
+        kind = LAYER_KINDS[name]
+        if kind in ('conv', 'dense'):
+            _check(layer, 'activation', 'linear')
+            _check(layer, 'bias', True)
+        if kind == 'conv':
+            _check(layer, 'border_mode', 'valid')
+            _check(layer, 'subsample', (1, 1))
+            _check(layer, 'dim_ordering', 'tf')
+        elif kind == 'pool':
+            _check(layer, 'border_mode', 'valid')
+            _check(layer, 'dim_ordering', 'tf')
+            config = layer.get_config()
+            if tuple(config['strides']) != tuple(config['pool_size']):
+                raise ValueError('NumpyTower needs pool strides equal to the '
+                                 'pool size')
+            arrays['%d_pool' % k] = np.array(config['pool_size'])
+        elif kind == 'leaky':
+            arrays['%d_alpha' % k] = np.float32(layer.get_config()['alpha'])
+        if kind in ('conv', 'dense'):
+            (W, b) = layer.get_weights()
+            if int8:
+                (arrays['%d_W' % k], arrays['%d_scale' % k]) = quantize(W)
+            else:
+                arrays['%d_W' % k] = W.astype(np.float32)
+            arrays['%d_b' % k] = b.astype(np.float32)
+        kinds.append(kind)
+    arrays['layers'] = np.array(kinds)
+
+    # the random constant euclidean_distance adds, as encoder.Encoder does
+    blank = np.zeros((1,) + model.input_shape[0][1:], dtype=np.float32)
+    arrays['offset'] = np.float32(model.predict([blank, blank])[0, 0]**2)
+    with open(npz_file, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def random_tower(npz_file, input_shape=(12, 150, 1), seed=0, int8=False):
+    """Write a tower with build_model's layers and random weights, for
+    measuring speed without a trained model or Keras."""
+    rng = np.random.RandomState(seed)
+    (height, width, channels) = input_shape
+    flat = ((height - 4) // 2 - 2) // 2 * (((width - 4) // 2 - 2) // 2) * 64
+    weights = {0: (5, 5, channels, 128), 3: (3, 3, 128, 64), 7: (flat, 32)}
+    arrays = {'input_shape': np.array(input_shape), 'int8': np.array(int8),
+              'layers': np.array(['conv', 'leaky', 'pool', 'conv', 'leaky',
+                                  'pool', 'flatten', 'dense']),
+              '1_alpha': np.float32(.1), '4_alpha': np.float32(.1),
+              '2_pool': np.array([2, 2]), '5_pool': np.array([2, 2]),
+              'offset': np.float32(1e-5)}
+    for (k, shape) in weights.items():
+        W = (rng.randn(*shape) / np.sqrt(np.prod(shape[:-1]))).astype(
+            np.float32)
+        if int8:
+            (arrays['%d_W' % k], arrays['%d_scale' % k]) = quantize(W)
+        else:
+            arrays['%d_W' % k] = W
+        arrays['%d_b' % k] = np.zeros(shape[-1], dtype=np.float32)
+    with open(npz_file, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def _conv(x, W, b):
+    """Valid convolution of NHWC x with a (rows, cols, in, out) kernel.
+
+    The patches under the kernel are gathered with one strided view into
+    an (outputs, rows*cols*in) matrix and multiplied with the kernel."""
+    (n, h, w, c) = x.shape
+    (kh, kw, _, out) = W.shape
+    (oh, ow) = (h - kh + 1, w - kw + 1)
+    (sn, sh, sw, sc) = x.strides
+    patches = as_strided(x, shape=(n, oh, ow, kh, kw, c),
+                         strides=(sn, sh, sw, sh, sw, sc))
+    y = np.dot(patches.reshape(n*oh*ow, kh*kw*c), W.reshape(kh*kw*c, out))
+    y += b
+    return y.reshape(n, oh, ow, out)
+
+
+def _pool(x, size):
+    """Valid max pooling of NHWC x with strides equal to the pool size."""
+    (n, h, w, c) = x.shape
+    (ph, pw) = size
+    (oh, ow) = (h // ph, w // pw)
+    x = x[:, :oh*ph, :ow*pw]
+    return x.reshape(n, oh, ph, ow, pw, c).max(axis=4).max(axis=2)
+
+
+class NumpyTower(object):
+    """Tower of a siamese model read from a file written by export_weights.
+
+    predict() and output_shape work like the Keras tower's, so an
+    encoder.Encoder can use either.  Images go through at most max_batch
+    at a time, since the im2col matrices grow with the batch (by 650 kB an
+    image for build_model's tower) and bigger batches are no faster."""
+
+    def __init__(self, npz_file, max_batch=64):
+        self.max_batch = max_batch
+        with open(npz_file, 'rb') as f:
+            npz = np.load(f)
+            arrays = dict((key, npz[key]) for key in npz.files)
+        self.input_shape = (None,) + tuple(int(d) for d in
+                                           arrays['input_shape'])
+        self.int8 = bool(arrays['int8'])
+        self.offset = float(arrays['offset'])
+        self.layers = [] # (kind, parameters)
+        for k, kind in enumerate(arrays['layers']):
+            kind = str(kind)
+            if kind in ('conv', 'dense'):
+                W = arrays['%d_W' % k].astype(np.float32)
+                if self.int8:
+                    W *= arrays['%d_scale' % k]
+                self.layers.append((kind, (W, arrays['%d_b' % k])))
+            elif kind == 'leaky':
+                self.layers.append((kind, float(arrays['%d_alpha' % k])))
+            elif kind == 'pool':
+                self.layers.append((kind, tuple(arrays['%d_pool' % k])))
+            elif kind == 'flatten':
+                self.layers.append((kind, None))
+            else:
+                raise ValueError('Unknown layer kind in %s: %s'
+                                 % (npz_file, kind))
+        self.output_shape = (None, self.layers[-1][1][0].shape[-1])
+
+    def _forward(self, x):
+        """Embeddings of one batch of NHWC images."""
+        for (kind, params) in self.layers:
+            if kind == 'conv':
+                x = _conv(x, *params)
+            elif kind == 'leaky':
+                x = np.maximum(x, params * x) if params < 1 else \
+                    np.where(x > 0, x, params * x)
+            elif kind == 'pool':
+                x = _pool(x, params)
+            elif kind == 'flatten':
+                x = x.reshape(len(x), -1) # NHWC order, like Keras with tf
+            else:
+                x = np.dot(x, params[0]) + params[1]
+        return x
+
+    def predict(self, images, batch_size=None):
+        """Embed (images, height, width, 1) float32 images, batch_size (up
+        to max_batch) at a time."""
+        batch_size = min(batch_size or self.max_batch, self.max_batch)
+        images = np.asarray(images, dtype=np.float32)
+        embeddings = np.empty((len(images), self.output_shape[1]),
+                              dtype=np.float32)
+        for start in range(0, len(images), batch_size):
+            embeddings[start:start+batch_size] = self._forward(
+                images[start:start+batch_size])
+        return embeddings
+
+
+def compare(model, npz_file, int8_file, cache, pairs, labels):
+    """Compare the Keras tower with NumpyTower in float32 and int8.
+
+    pairs are scored like run_siamese.py does, with labels 1 for similar
+    pairs.  Returns a dict with the largest embedding difference of each
+    NumpyTower from Keras, the AUC of each, and the seconds each took to
+    embed the strings."""
+    from sklearn.metrics import roc_auc_score
+
+    strings = sorted(set(st for pair in pairs for st in pair))
+    images = cache.images(strings)
+    row = dict((st, k) for (k, st) in enumerate(strings))
+    first = [row[pair[0]] for pair in pairs]
+    second = [row[pair[1]] for pair in pairs]
+    report = {'strings': len(strings), 'pairs': len(pairs)}
+    expected = None
+    float32 = NumpyTower(npz_file)
+    for (name, tower) in [('keras', model.layers[2]), ('float32', float32),
+                          ('int8', NumpyTower(int8_file))]:
+        start = time.time()
+        embeddings = tower.predict(images, batch_size=64)
+        report[name + '_seconds'] = time.time() - start
+        if expected is None:
+            expected = embeddings
+        else:
+            report[name + '_max_difference'] = float(
+                np.abs(embeddings - expected).max())
+        distances = np.sqrt(np.sum(np.square(
+            embeddings[first] - embeddings[second]), axis=1) + float32.offset)
+        report[name + '_auc'] = roc_auc_score(labels, -distances)
+    return report
+
+
+def numpy_tower_selftest(model_file, weight_file, font_location):
+    """Check NumpyTower embeddings against the Keras tower."""
+    import os
+    import shutil
+    import tempfile
+
+    from keras.models import model_from_json
+
+    import render_cache
+
+    print('    running self test for NumpyTower ...')
+    with open(model_file) as f:
+        model = model_from_json(f.read())
+    model.load_weights(weight_file)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cache = render_cache.RenderCache(tmp_dir, font_location, 10,
+                                         (150, 12), (0, 0))
+        images = cache.images(['google', 'goog1e', 'paypal', 'svchost.exe',
+                               'svch0st.exe', 'lsass.exe', '', 'w'*40])
+        expected = model.layers[2].predict(images)
+        for int8 in (False, True):
+            npz_file = os.path.join(tmp_dir, 'tower.npz')
+            export_weights(model, npz_file, int8)
+            tower = NumpyTower(npz_file)
+            embeddings = tower.predict(images, batch_size=3)
+            # int8 weights move the embeddings by up to about 1%
+            tolerance = 0.02 if int8 else 1e-4
+            scale = np.abs(expected).max()
+            if not np.allclose(embeddings, expected, rtol=tolerance,
+                               atol=tolerance * scale):
+                print('NumpyTower failed built-in test with int8=%r.' % int8)
+                print('    Largest difference %g, for embeddings up to %g.'
+                      % (np.abs(embeddings - expected).max(), scale))
+    finally:
+        shutil.rmtree(tmp_dir)
+    print('    self test for NumpyTower done.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export the tower of a siamese model for NumpyTower, '
+                    'and compare NumpyTower with Keras.')
+    subparsers = parser.add_subparsers(dest='command')
+    export = subparsers.add_parser('export', help='write the tower to .npz')
+    export.add_argument('model_file', help='model .json from run_siamese.py')
+    export.add_argument('weight_file', help='weights .h5 from run_siamese.py')
+    export.add_argument('npz_file')
+    export.add_argument('--int8', action='store_true',
+                        help='store int8 weights with per channel scales')
+    check = subparsers.add_parser(
+        'compare', help='embedding differences and AUC on a dataset split')
+    check.add_argument('model_file')
+    check.add_argument('weight_file')
+    check.add_argument('dataset', help='pickled dataset from data/')
+    check.add_argument('--split', default='test')
+    check.add_argument('--font', default='Arial.ttf')
+    check.add_argument('--cache-dir', default='output/render_cache')
+    args = parser.parse_args()
+
+    from keras.models import model_from_json
+
+    with open(args.model_file) as f:
+        model = model_from_json(f.read())
+    model.load_weights(args.weight_file)
+    if args.command == 'export':
+        export_weights(model, args.npz_file, args.int8)
+        return
+
+    import cPickle as pickle
+    import os
+    import shutil
+    import tempfile
+
+    import render_cache
+
+    with open(args.dataset) as f:
+        data = pickle.load(f)
+    pairs = [(x[0], x[1]) for x in data[args.split]]
+    labels = [x[2] for x in data[args.split]]
+    cache = render_cache.RenderCache(args.cache_dir, args.font, 10,
+                                     (150, 12), (0, 0))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        npz_file = os.path.join(tmp_dir, 'float32.npz')
+        int8_file = os.path.join(tmp_dir, 'int8.npz')
+        export_weights(model, npz_file)
+        export_weights(model, int8_file, int8=True)
+        report = compare(model, npz_file, int8_file, cache, pairs, labels)
+        report['float32_bytes'] = os.path.getsize(npz_file)
+        report['int8_bytes'] = os.path.getsize(int8_file)
+    finally:
+        shutil.rmtree(tmp_dir)
+    for key in sorted(report):
+        print('%-24s %s' % (key + ':', report[key]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""Stream training batches of string pair images for model.fit_generator.
+
+Building X1_train and X2_train for the whole dataset takes two float32
+images per pair in memory, which does not fit for the full datasets.
+PairBatches renders (or finds) every string once in a render_cache
+RenderCache, which keeps the images in a memory-mapped file, and then
+copies one batch at a time out of it into a ring of reused NHWC buffers.
+Background threads fill the next few batches while the model trains on the
+current one, so memory use depends on the batch size, not the dataset.
+
+fit_generator keeps up to max_q_size batches queued, plus one per worker
+being queued and the one being trained on, so a buffer is only reused once
+that many newer batches have been handed out.  Pass fit_generator the same
+max_q_size and nb_worker as PairBatches.
+"""
+import threading
+
+import numpy as np
+
+
+class PairBatches(object):
+    """Endless iterator over ([X1, X2], y) batches of string pairs.
+
+    Each pass over the pairs is one epoch of samples_per_epoch samples, in
+    a new random order if shuffle is True.  The last batch of a pass is
+    smaller if the batch size does not divide the number of pairs.  The
+    order of each epoch only depends on the seed, so a run that resumes
+    with the same seed and start_epoch sees the batches it would have.
+    """
+
+    def __init__(self, cache, pairs, labels, batch_size=8, shuffle=True,
+                 max_q_size=10, nb_worker=1, prefetch=4, threads=2,
+                 seed=None, start_epoch=0):
+        pairs = list(pairs)
+        self.cache = cache
+        self.rows1 = cache.rows([pair[0] for pair in pairs])
+        self.rows2 = cache.rows([pair[1] for pair in pairs])
+        self.labels = np.asarray(labels, dtype=np.float32)
+        self.samples_per_epoch = len(pairs)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = np.random.randint(2**31) if seed is None else seed
+        self.batches_per_epoch = -(-len(pairs) // batch_size)
+        if not self.batches_per_epoch:
+            raise ValueError('PairBatches needs at least one pair')
+
+        # batches handed out that fit_generator may still be holding
+        self._held = max_q_size + 2*nb_worker + 1
+        self._prefetch = prefetch
+        ring = self._held + prefetch
+        shape = (ring, batch_size) + cache.shape + (1,)
+        self._x1 = np.zeros(shape, dtype=np.float32)
+        self._x2 = np.zeros(shape, dtype=np.float32)
+        self._y = np.zeros((ring, batch_size), dtype=np.float32)
+
+        self._cond = threading.Condition()
+        self._closed = False
+        # next batch for a thread to fill, and batches handed out by next()
+        self._next_fill = self._handed_out = \
+            start_epoch * self.batches_per_epoch
+        self._ready = {} # batch number -> ring slot of filled batches
+        self._orders = {} # epoch -> order of the pairs
+        self._threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self._fill_batches)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __iter__(self):
+        return self
+
+    def _order(self, epoch):
+        """Order of the pairs in an epoch.  Call with the lock held."""
+        if epoch not in self._orders:
+            if self.shuffle:
+                rng = np.random.RandomState([self.seed, epoch])
+                self._orders[epoch] = rng.permutation(self.samples_per_epoch)
+            else:
+                self._orders[epoch] = np.arange(self.samples_per_epoch)
+            # batches are filled at most prefetch ahead, so no thread is
+            # still working on an epoch before the previous one
+            for old in [e for e in self._orders if e < epoch - 1]:
+                del self._orders[old]
+        return self._orders[epoch]
+
+    def _fill_batches(self):
+        """Fill batches until closed, at most prefetch ahead of next()."""
+        while True:
+            with self._cond:
+                while not self._closed and \
+                        self._next_fill >= self._handed_out + self._prefetch:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                batch = self._next_fill
+                self._next_fill += 1
+                (epoch, k) = divmod(batch, self.batches_per_epoch)
+                order = self._order(epoch)
+            members = order[k*self.batch_size:(k+1)*self.batch_size]
+            slot = batch % len(self._y)
+            n = len(members)
+            self.cache.take(self.rows1[members], self._x1[slot, :n])
+            self.cache.take(self.rows2[members], self._x2[slot, :n])
+            self._y[slot, :n] = self.labels[members]
+            with self._cond:
+                self._ready[batch] = (slot, n)
+                self._cond.notify_all()
+
+    def next(self):
+        """Return the next ([X1, X2], y) batch.  Safe to call from threads."""
+        with self._cond:
+            if self._closed:
+                raise StopIteration
+            batch = self._handed_out
+            self._handed_out += 1
+            self._cond.notify_all()
+            while batch not in self._ready:
+                self._cond.wait()
+            (slot, n) = self._ready.pop(batch)
+        return ([self._x1[slot, :n], self._x2[slot, :n]], self._y[slot, :n])
+
+    __next__ = next
+
+    def close(self):
+        """Stop the background threads."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+def pair_batches_selftest(font_location):
+    """Check PairBatches, holding on to batches like fit_generator does."""
+    import collections
+    import shutil
+    import tempfile
+
+    import render_cache
+
+    print('    running self test for PairBatches ...')
+    names = ['google', 'goog1e', 'paypal', 'paypa1', 'svchost.exe',
+             'svch0st.exe', 'lsass.exe', '1sass.exe', 'example', 'exarnple']
+    rng = np.random.RandomState(0)
+    pairs = [(names[a], names[b]) for (a, b) in rng.randint(len(names),
+                                                            size=(53, 2))]
+    labels = [float(a[:3] == b[:3]) for (a, b) in pairs]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cache = render_cache.RenderCache(tmp_dir, font_location, 10,
+                                         (150, 12), (0, 0))
+        X1 = cache.images([a for (a, b) in pairs])
+        X2 = cache.images([b for (a, b) in pairs])
+        y = np.array(labels, dtype=np.float32)
+
+        batches = PairBatches(cache, pairs, labels, batch_size=8,
+                              max_q_size=3, nb_worker=1, seed=1)
+        held = collections.deque() # (expected, batch) still in use
+        for epoch in range(3):
+            seen = []
+            for k in range(batches.batches_per_epoch):
+                ([x1, x2], yb) = next(batches)
+                order = np.random.RandomState([1, epoch]).permutation(53)
+                members = order[k*8:(k+1)*8]
+                seen.extend(members)
+                held.append(((X1[members], X2[members], y[members]),
+                             (x1, x2, yb)))
+                if len(held) > batches._held:
+                    held.popleft()
+                for (expected, batch) in held:
+                    if not all(np.array_equal(a, b)
+                               for (a, b) in zip(expected, batch)):
+                        print('PairBatches failed built-in test in epoch %d, '
+                              'batch %d.' % (epoch, k))
+            if sorted(seen) != range(len(pairs)):
+                print('PairBatches did not return every pair once in '
+                      'epoch %d.' % (epoch,))
+        batches.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+    print('    self test for PairBatches done.')
@@ -0,0 +1,159 @@
+"""Score long lists of string pairs on a pool of worker processes.
+
+score_pairs() splits a list of (name1, name2) pairs into chunks, scores
+the chunks on a multiprocessing pool and returns the scores in input order
+as a NumPy array.  Each worker imports the scoring modules, and with them
+builds the similarity tables, once when it starts.
+
+It can also be run on a file with two tab-separated names per line:
+
+    python parallel_scoring.py pairs.tsv -o scores.npy -j 32
+"""
+from __future__ import with_statement
+
+import argparse
+import multiprocessing
+import sys
+
+import numpy as np
+
+SCORERS = ('howConfusableAre', 'editdistance')
+
+# name of the scorer used by this worker; set by _init_worker()
+_scorer = None
+
+
+def _init_worker(scorer):
+    """Import the scorer's modules once per worker process."""
+    global _scorer
+    if scorer == 'howConfusableAre':
+        import batch_similarity
+    elif scorer == 'editdistance':
+        import editdistance
+    else:
+        raise ValueError('Unknown scorer: %s' % (scorer,))
+    _scorer = scorer
+
+
+def _score_chunk(pairs):
+    """Score one chunk of pairs with this worker's scorer."""
+    if _scorer == 'howConfusableAre':
+        import batch_similarity
+        return batch_similarity.howConfusableAre_many(pairs)
+    import editdistance
+    return np.array([editdistance.eval(name1.lower(), name2.lower())
+                     for (name1, name2) in pairs], dtype=np.float64)
+
+
+def score_pairs(pairs, scorer='howConfusableAre', processes=None,
+                chunksize=2000):
+    """Score (name1, name2) pairs in parallel.
+
+    scorer is 'howConfusableAre', for strSimilarity.howConfusableAre(), or
+    'editdistance', for the plain edit distance of the lower cased names.
+    processes defaults to the number of CPUs; with 1, no pool is started.
+    Returns a float64 array with one score per pair, in input order.
+    """
+    if scorer not in SCORERS:
+        raise ValueError('Unknown scorer: %s' % (scorer,))
+    pairs = list(pairs)
+    chunks = [pairs[start:start+chunksize]
+              for start in range(0, len(pairs), chunksize)]
+    if not chunks:
+        return np.zeros(0, dtype=np.float64)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(chunks))
+
+    if processes == 1:
+        _init_worker(scorer)
+        return np.concatenate([_score_chunk(chunk) for chunk in chunks])
+
+    pool = multiprocessing.Pool(processes, _init_worker, (scorer,))
+    try:
+        # imap keeps the chunks in input order
+        scores = np.concatenate(list(pool.imap(_score_chunk, chunks)))
+    finally:
+        pool.close()
+        pool.join()
+    return scores
+
+
+def read_pairs(f):
+    """Read (name1, name2) pairs from lines of tab-separated names."""
+    pairs = []
+    for line in f:
+        fields = line.rstrip('\r\n').split('\t')
+        if len(fields) >= 2:
+            pairs.append((fields[0], fields[1]))
+    return pairs
+
+
+def parallel_scoring_selftest():
+    """Check score_pairs() against scoring each pair, in and out of a pool,
+    over several chunks."""
+    import editdistance
+    import strSimilarity
+
+    print('    running self test for parallel_scoring ...')
+    pairs = [(str1, str2) for (str1, str2, _) in
+             strSimilarity.howConfusableAreTestCases]
+    pairs += strSimilarity.fuzzedPairs(20)
+    pairs += [(str2.upper(), str1) for (str1, str2) in pairs]
+    expected = {
+        'howConfusableAre': [strSimilarity.howConfusableAre(str1, str2)
+                             for (str1, str2) in pairs],
+        'editdistance': [editdistance.eval(str1.lower(), str2.lower())
+                         for (str1, str2) in pairs],
+    }
+    for scorer in SCORERS:
+        for processes in [1, 2]:
+            scores = score_pairs(pairs, scorer, processes, chunksize=17)
+            if len(scores) != len(pairs):
+                print('score_pairs returned %d scores for %d pairs with %s '
+                      'on %d processes.'
+                      % (len(scores), len(pairs), scorer, processes))
+                continue
+            for (pair, score, score0) in zip(pairs, scores,
+                                             expected[scorer]):
+                if not strSimilarity.fEqual(score, score0):
+                    print('score_pairs failed built-in test for %r with %s '
+                          'on %d processes.' % (pair, scorer, processes))
+                    print('    It returned %r instead of %r.'
+                          % (score, score0))
+            empty = score_pairs([], scorer, processes)
+            if empty.shape != (0,) or empty.dtype != np.float64:
+                print('score_pairs returned %r for no pairs with %s on %d '
+                      'processes.' % (empty, scorer, processes))
+    print('    self test for parallel_scoring done.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Score a file of tab-separated name pairs in parallel.')
+    parser.add_argument('pairs', help='file with two tab-separated names '
+                        'per line, or - for stdin')
+    parser.add_argument('-o', '--output', help='write the scores to this '
+                        '.npy file instead of one per line to stdout')
+    parser.add_argument('-s', '--scorer', choices=SCORERS,
+                        default='howConfusableAre')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--chunksize', type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.pairs == '-':
+        pairs = read_pairs(sys.stdin)
+    else:
+        with open(args.pairs) as f:
+            pairs = read_pairs(f)
+    scores = score_pairs(pairs, args.scorer, args.processes, args.chunksize)
+    if args.output:
+        np.save(args.output, scores)
+    else:
+        for score in scores:
+            sys.stdout.write('%r\n' % (score,))
+
+
+if __name__ == '__main__':
+    main()
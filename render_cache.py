@@ -0,0 +1,238 @@
+"""Persistent on-disk cache of rendered string images.
+
+Rendering every string of the train, validate and test sets with PIL takes
+longer than it should, and the datasets repeat the same names many times.
+A RenderCache keeps each image it renders in a memory-mapped float32 file
+under a directory named after a hash of the font file and the rendering
+parameters, with an index from the lower cased string to its row.  Strings
+already in the cache are read back from the memory map; only new ones are
+rendered, once each, and appended.  PIL is only imported when there is
+something to render, so a warm run does not load it at all.
+
+Several processes can share a cache directory.  Appending holds an
+exclusive flock on its lock file and starts from the index on disk, not
+the one the process loaded, so writers never overwrite each other's rows.
+
+Images are drawn with PIL one string at a time ('pil' backend), or put
+together from a glyph_atlas.GlyphAtlas ('atlas' backend).
+"""
+from __future__ import with_statement
+
+import cPickle as pickle
+import fcntl
+import hashlib
+import os
+
+import numpy as np
+
+IMAGES_FILE = 'images.f32'
+INDEX_FILE = 'index.pkl'
+LOCK_FILE = 'lock'
+
+BACKENDS = ('pil', 'atlas')
+
+# New strings are rendered and appended this many at a time, so that
+# filling a cache for a whole dataset does not hold all of it in memory.
+RENDER_CHUNK = 4096
+
+
+def render_strings(strings, font_location, font_size, image_size,
+                   text_location):
+    """Render strings with PIL into a (strings, height, width) float32 array."""
+    from PIL import Image
+    from PIL import ImageDraw
+    from PIL import ImageFont
+
+    font = ImageFont.truetype(font_location, font_size)
+    imgs = np.zeros((len(strings), image_size[1], image_size[0]),
+                    dtype=np.float32)
+    for k, st in enumerate(strings):
+        # Create a single channel image of floats
+        img = Image.new('F', image_size)
+        dimg = ImageDraw.Draw(img)
+        dimg.text(text_location, st.lower(), font=font)
+        imgs[k] = np.asarray(img, dtype=np.float32)
+    return imgs
+
+
+def cache_key(font_location, font_size, image_size, text_location,
+              backend='pil'):
+    """Hash of the font file contents and the rendering parameters."""
+    digest = hashlib.sha1()
+    with open(font_location, 'rb') as f:
+        digest.update(f.read())
+    digest.update(repr((font_size, tuple(image_size), tuple(text_location))))
+    if backend != 'pil':
+        digest.update(backend)
+    return digest.hexdigest()
+
+
+class RenderCache(object):
+    """Rendered images of strings for one font and set of parameters."""
+
+    def __init__(self, cache_dir, font_location, font_size, image_size,
+                 text_location, backend='pil'):
+        if backend not in BACKENDS:
+            raise ValueError('Unknown rendering backend: %s' % (backend,))
+        self.backend = backend
+        self.font_location = font_location
+        self.font_size = font_size
+        self.image_size = tuple(image_size)
+        self.text_location = tuple(text_location)
+        self.shape = (self.image_size[1], self.image_size[0])
+        self.directory = os.path.join(cache_dir, cache_key(
+            font_location, font_size, image_size, text_location, backend))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._images_file = os.path.join(self.directory, IMAGES_FILE)
+        self._index_file = os.path.join(self.directory, INDEX_FILE)
+        self._lock_file = os.path.join(self.directory, LOCK_FILE)
+
+        self.index = {} # lower cased string -> row of the images file
+        self._load_index()
+        self._images = None
+        self._atlas = None
+        self._map()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _load_index(self):
+        """Read the index from disk, if there is one yet."""
+        if os.path.isfile(self._index_file):
+            with open(self._index_file, 'rb') as f:
+                self.index = pickle.load(f)
+
+    def _map(self):
+        """Memory map the rows of the images file that the index covers."""
+        self._images = None
+        if self.index:
+            self._images = np.memmap(self._images_file, dtype=np.float32,
+                                     mode='r',
+                                     shape=(len(self.index),) + self.shape)
+
+    def render(self, strings):
+        """Return a (strings, height, width) float32 array of their images,
+        rendered with the cache's parameters but not added to it."""
+        if self.backend == 'atlas':
+            if self._atlas is None:
+                import glyph_atlas
+                self._atlas = glyph_atlas.GlyphAtlas(
+                    self.font_location, self.font_size, self.image_size,
+                    self.text_location)
+            return self._atlas.render(strings)[:, :, :, 0]
+        return render_strings(strings, self.font_location, self.font_size,
+                              self.image_size, self.text_location)
+
+    def _append(self, strings):
+        """Render strings, which were not in the cache, and add them."""
+        rowbytes = self.shape[0] * self.shape[1] * 4
+        self._images = None
+        with open(self._lock_file, 'a') as lock:
+            # released when the lock file is closed
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # another process may have added rows since the index was read
+            self._load_index()
+            strings = [st for st in strings if st not in self.index]
+            if strings:
+                with open(self._images_file, 'ab') as f:
+                    # drop rows left by a run that stopped before writing
+                    # its index
+                    f.truncate(len(self.index) * rowbytes)
+                    f.seek(0, os.SEEK_END)
+                    for start in range(0, len(strings), RENDER_CHUNK):
+                        imgs = self.render(strings[start:start+RENDER_CHUNK])
+                        f.write(imgs.tobytes())
+                for st in strings:
+                    self.index[st] = len(self.index)
+                # write the index last, and atomically, so it never lists
+                # rows that are not in the images file
+                tmp_file = self._index_file + '.tmp'
+                with open(tmp_file, 'wb') as f:
+                    pickle.dump(self.index, f, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmp_file, self._index_file)
+            self._map()
+
+    def rows(self, strings):
+        """Rows of the images file for strings, rendering any new ones."""
+        lowered = [st.lower() for st in strings]
+        missing = []
+        seen = set()
+        for st in lowered:
+            if st not in self.index and st not in seen:
+                seen.add(st) # render duplicates only once
+                missing.append(st)
+        if missing:
+            self._append(missing)
+        return np.array([self.index[st] for st in lowered], dtype=np.int64)
+
+    def take(self, rows, out):
+        """Copy the images in rows, as returned by rows(), into out.
+
+        out is a contiguous (rows, height, width) or (rows, height, width, 1)
+        float32 array.  Nothing is rendered, so this is safe to call from
+        several threads once rows() has been called for all the strings."""
+        target = out.view()
+        target.shape = (len(rows),) + self.shape # raises instead of copying
+        np.take(self._images, rows, axis=0, out=target, mode='clip')
+
+    def images(self, strings):
+        """Return a (strings, height, width, 1) float32 array of their images.
+
+        The array is in tf ordering, which is what the siamese model takes.
+        """
+        rows = self.rows(strings)
+        imgs = np.empty((len(rows),) + self.shape + (1,), dtype=np.float32)
+        if len(rows):
+            self.take(rows, imgs)
+        return imgs
+
+
+def render_cache_selftest(font_location, cache_dir=None):
+    """Check that cached images equal freshly rendered ones."""
+    import shutil
+    import tempfile
+
+    print('    running self test for RenderCache ...')
+    params = (font_location, 10, (150, 12), (0, 0))
+    strings = ['google', 'GOOGLE', 'goog1e', 'svchost.exe', 'google', '']
+    expected = render_strings(strings, *params)[:, :, :, None]
+
+    tmp_dir = tempfile.mkdtemp() if cache_dir is None else cache_dir
+    try:
+        atlas = RenderCache(tmp_dir, *params, backend='atlas').images(strings)
+        if not np.array_equal(atlas, expected):
+            print('RenderCache failed built-in test for the atlas backend.')
+        cache = RenderCache(tmp_dir, *params)
+        cold = cache.images(strings)
+        if len(cache) != 4:
+            print('RenderCache rendered %d strings instead of 4.'
+                  % (len(cache),))
+        warm = RenderCache(tmp_dir, *params).images(strings[::-1])[::-1]
+        more = RenderCache(tmp_dir, *params).images(['paypa1'] + strings)[1:]
+        for (name, imgs) in [('cold', cold), ('warm', warm), ('more', more)]:
+            if not np.array_equal(imgs, expected):
+                print('RenderCache failed built-in test for the %s cache.'
+                      % (name,))
+
+        # two caches on one directory, each appending from a stale index
+        shared_dir = os.path.join(tmp_dir, 'shared')
+        first = RenderCache(shared_dir, *params)
+        second = RenderCache(shared_dir, *params)
+        first.rows(['paypal', 'google'])
+        second.rows(['microsoft', 'google'])
+        names = ['paypal', 'google', 'microsoft']
+        expected = render_strings(names, *params)[:, :, :, None]
+        reopened = RenderCache(shared_dir, *params)
+        for (name, cache) in [('first', first), ('second', second),
+                              ('reopened', reopened)]:
+            if not np.array_equal(cache.images(names), expected):
+                print('RenderCache failed built-in test for the %s of two '
+                      'caches sharing a directory.' % (name,))
+        if len(reopened) != 3:
+            print('RenderCache shared by two caches has %d strings instead '
+                  'of 3.' % (len(reopened),))
+    finally:
+        if cache_dir is None:
+            shutil.rmtree(tmp_dir)
+    print('    self test for RenderCache done.')
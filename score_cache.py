@@ -0,0 +1,226 @@
+"""Remember howConfusableAre() scores of pairs that come up again.
+
+Log streams see the same pairs over and over: the same processes start
+again and the same domains are looked up against the same protected names.
+A ConfusableCache keeps the scores of the pairs scored most recently and
+returns them instead of running the edit distance again.  The score does
+not depend on the order of the strings or their case (see
+strSimilarity.howConfusableAre_chkSym), so a pair is kept once under its
+lower cased strings in sorted order, and always scored in that order.
+
+Scores asked for with min_score are kept too.  A score of at least
+min_score is the full score; a 0 only says that the full score is below
+min_score, and answers later queries with a min_score at least as high.
+
+The cache is bounded by a number of entries and optionally by an estimate
+of the bytes they take, and forgets the least recently used pairs first.
+One lock guards it, so threads can share a cache; the scores are computed
+outside the lock.  save() writes the most recently used pairs so that
+load() can warm a new process's cache with them:
+
+    cache = score_cache.ConfusableCache(maxEntries=1000000)
+    cache.load('scores.cache')
+    cache.howConfusableAre('paypa1.com', 'paypal.com', min_score=0.8)
+    cache.stats() # {'hits': ..., 'misses': ..., 'evictions': ..., ...}
+    cache.save('scores.cache')
+"""
+from __future__ import with_statement
+
+import collections
+import cPickle as pickle
+import os
+import sys
+import threading
+
+import strSimilarity
+
+# estimated bytes of an entry besides its two strings: the key tuple, the
+# float, the OrderedDict's link and its share of the two dicts' tables
+ENTRY_OVERHEAD = sys.getsizeof((None, None)) + sys.getsizeof(0.0) + \
+    sys.getsizeof([None, None, None]) + 2 * 3 * 8 * 2
+
+
+def pairKey(str1, str2):
+    """The key a pair is kept under: its lower cased strings in order."""
+    (a, b) = (str1.lower(), str2.lower())
+    return (a, b) if a <= b else (b, a)
+
+
+def entryBytes(key):
+    """Estimated bytes a cache entry for key takes."""
+    return sys.getsizeof(key[0]) + sys.getsizeof(key[1]) + ENTRY_OVERHEAD
+
+
+class ConfusableCache(object):
+    """Least recently used cache of howConfusableAre() scores."""
+
+    def __init__(self, maxEntries=100000, maxBytes=None,
+                 scorer=strSimilarity.howConfusableAre):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.scorer = scorer
+        self._lock = threading.Lock()
+        # key -> full score, or -bound when the score is known to be
+        # below bound; the most recently used last
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key, min_score):
+        """The score of key for min_score, or None if it has to be
+        computed.  Must be called with the lock held."""
+        value = self._entries.get(key)
+        if value is None:
+            return None
+        if value >= 0:
+            score = value
+            if min_score is not None and score < min_score:
+                score = 0.0
+        elif min_score is not None and min_score >= -value:
+            score = 0.0
+        else:
+            return None # only a bound, lower than min_score
+        # most recently used
+        del self._entries[key]
+        self._entries[key] = value
+        return score
+
+    def _store(self, key, value):
+        """Keep value for key and evict entries over the bounds.  Must be
+        called with the lock held."""
+        old = self._entries.pop(key, None)
+        if old is None:
+            self._bytes += entryBytes(key)
+        elif old >= 0 and value < 0:
+            value = old # never replace a full score with a bound
+        self._entries[key] = value
+        while self._entries and (
+                len(self._entries) > self.maxEntries or
+                (self.maxBytes is not None and self._bytes > self.maxBytes)):
+            (oldKey, _) = self._entries.popitem(last=False)
+            self._bytes -= entryBytes(oldKey)
+            self.evictions += 1
+
+    def howConfusableAre(self, str1, str2, min_score=None):
+        """strSimilarity.howConfusableAre(str1, str2, min_score), from the
+        cache when the pair has been scored before."""
+        if min_score is not None and min_score <= 0:
+            min_score = None
+        key = pairKey(str1, str2)
+        with self._lock:
+            score = self._lookup(key, min_score)
+            if score is not None:
+                self.hits += 1
+                return score
+            self.misses += 1
+        score = self.scorer(key[0], key[1], min_score=min_score)
+        if min_score is None or score >= min_score:
+            value = score
+        else:
+            value = -min_score
+        with self._lock:
+            self._store(key, value)
+        return score
+
+    def stats(self):
+        """Counts of hits, misses and evictions, and the size now."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hitRate': self.hits / float(lookups) if lookups else 0.0,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes}
+
+    def clear(self):
+        """Forget every score and reset the counts."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def save(self, path, maxEntries=None):
+        """Write the maxEntries most recently used scores (all of them if
+        None) to path, replacing it only once they are written."""
+        with self._lock:
+            entries = self._entries.items()
+        if maxEntries is not None:
+            entries = entries[len(entries) - maxEntries:] if maxEntries else []
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump({'version': 1, 'entries': entries}, f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+
+    def load(self, path):
+        """Add the scores save() wrote to path, as if they had just been
+        used in the order they were saved.  Returns how many were read."""
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        if saved['version'] != 1:
+            raise ValueError('Unknown score cache version in %s: %r'
+                             % (path, saved['version']))
+        with self._lock:
+            for (key, value) in saved['entries']:
+                self._store(key, value)
+        return len(saved['entries'])
+
+
+def confusableCache_selftest():
+    """Check ConfusableCache against scoring every pair."""
+    import shutil
+    import tempfile
+
+    print('    running self test for ConfusableCache ...')
+    pairs = [(str1, str2) for (str1, str2, _) in
+             strSimilarity.howConfusableAreTestCases]
+    cache = ConfusableCache(maxEntries=len(pairs))
+    for repeat in range(2):
+        for (str1, str2) in pairs:
+            for min_score in [None, .9, .5, 0]:
+                for (a, b) in [(str1, str2), (str2.upper(), str1)]:
+                    expected = strSimilarity.howConfusableAre(
+                        a, b, min_score=min_score)
+                    score = cache.howConfusableAre(a, b, min_score=min_score)
+                    if not strSimilarity.fEqual(score, expected):
+                        print('ConfusableCache failed built-in test for %r '
+                              'and %r with min_score %r.' % (a, b, min_score))
+                        print('    It returned %r instead of %r.'
+                              % (score, expected))
+    stats = cache.stats()
+    if stats['misses'] != len(set(pairKey(*pair) for pair in pairs)) or \
+            stats['evictions']:
+        print('ConfusableCache counted %r.' % (stats,))
+
+    small = ConfusableCache(maxEntries=2)
+    for (str1, str2) in pairs[:3]:
+        small.howConfusableAre(str1, str2)
+    small.howConfusableAre(*pairs[1])
+    small.howConfusableAre(*pairs[0]) # evicts pairs[2], used before pairs[1]
+    if small.stats()['evictions'] != 2 or small.hits != 1 or \
+            small._entries.keys() != [pairKey(*pairs[1]), pairKey(*pairs[0])]:
+        print('ConfusableCache did not evict the least recently used pair.')
+    bounded = ConfusableCache(maxEntries=100,
+                              maxBytes=2 * entryBytes(pairKey(*pairs[0])))
+    for (str1, str2) in pairs:
+        bounded.howConfusableAre(str1, str2)
+    if bounded.stats()['bytes'] > bounded.maxBytes or not len(bounded):
+        print('ConfusableCache went over its byte bound: %r.'
+              % (bounded.stats(),))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'scores.cache')
+        cache.save(path, maxEntries=5)
+        warm = ConfusableCache()
+        if warm.load(path) != 5 or \
+                warm._entries.items() != cache._entries.items()[-5:]:
+            print('ConfusableCache did not load the pairs it saved.')
+    finally:
+        shutil.rmtree(tmp_dir)
+    print('    self test for ConfusableCache done.')
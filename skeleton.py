@@ -0,0 +1,133 @@
+"""Visual skeletons of strings, for finding exact confusables by hashing.
+
+visualSkeleton(s, level) lower cases s and replaces every character, and
+every digraph such as rn, with one representative of the characters it is
+at least level similar to, according to the tables in charSimilarity.
+Two strings with the same skeleton line up character by character or
+digraph by character, and every pair that lines up is at least level
+similar.  At level 1 that means howConfusableAre() rates them 1.0, so a
+dict from skeleton to names finds exact confusables with one lookup.
+
+Similarity is not transitive (1 and l are identical, l and i are identical,
+but 1 and i are not), so characters are only folded together if every two
+of them are at least level similar.  Pairs of digraphs, like mn and nm,
+are not folded.  With transitive=True, chains of similar characters are
+folded together too.  Such skeletons collide more often than the strings
+really look alike, which is what candidate generation wants.
+"""
+import charSimilarity
+import strSimilarity
+
+# folding tables already built, by (level, transitive)
+_folds = {}
+
+
+def _build_folds(level, transitive=False):
+    """Return (characters, digraphs), the folding tables for level.
+
+    characters maps a character to its representative, and digraphs maps
+    a digraph to the representative of the characters it looks like.
+    """
+    charSim = charSimilarity.fastCharacterSimilarity
+    digraphSim = charSimilarity.fastDigraphSimilarity
+
+    # Group characters, most similar pairs first, as long as every two
+    # characters of a group stay at least level similar (or always, if
+    # transitive).
+    pairs = []
+    for ((ch1, ch2), similarity) in charSimilarity.scsimtab.items():
+        if ch1.isupper() or ch2.isupper() or similarity < level:
+            continue
+        pairs.append((-similarity, min(ch1, ch2), max(ch1, ch2)))
+    groups = {}
+    for (_, ch1, ch2) in sorted(pairs):
+        group1 = groups.get(ch1, [ch1])
+        group2 = groups.get(ch2, [ch2])
+        if group1 is group2:
+            continue
+        if transitive or \
+                all(charSim(a, b) >= level for a in group1 for b in group2):
+            merged = group1 + group2
+            for ch in merged:
+                groups[ch] = merged
+    characters = dict((ch, min(group)) for (ch, group) in groups.items())
+
+    # A digraph folds into a group of characters if it is at least level
+    # similar to all of them, and to the other digraphs folded into it (or
+    # to any of them, if transitive).
+    entries = []
+    for ((str1, str2), similarity) in charSimilarity.dcsimtab.items():
+        if str1 != str1.lower() or str2 != str2.lower() or \
+                similarity < level or len(str1) == len(str2):
+            continue
+        (digraph, ch) = (str1, str2) if len(str1) == 2 else (str2, str1)
+        entries.append((-similarity, digraph, ch))
+    digraphs = {}
+    folded = {} # representative -> digraphs folded into it
+    for (_, digraph, ch) in sorted(entries):
+        if digraph in digraphs:
+            continue
+        group = groups.get(ch, [ch])
+        rep = characters.get(ch, ch)
+        others = folded.get(rep, [])
+        if transitive or \
+                (all(digraphSim(digraph, other) >= level for other in group) and
+                 all(digraphSim(digraph, other) >= level for other in others)):
+            digraphs[digraph] = rep
+            folded[rep] = others + [digraph]
+    return characters, digraphs
+
+
+def visualSkeleton(s, level=1.0, transitive=False):
+    """Return the visual skeleton of s at the given similarity level."""
+    if (level, transitive) not in _folds:
+        _folds[(level, transitive)] = _build_folds(level, transitive)
+    characters, digraphs = _folds[(level, transitive)]
+
+    sl = s.lower() # do all comparisons lower case
+    skeleton = []
+    k = 0
+    while k < len(sl):
+        digraph = sl[k:k+2]
+        if digraph in digraphs:
+            skeleton.append(digraphs[digraph])
+            k += 2
+        else:
+            skeleton.append(characters.get(sl[k], sl[k]))
+            k += 1
+    return ''.join(skeleton)
+
+
+def visualSkeleton_selftest():
+    """Built-in self test for visualSkeleton()."""
+    print('    running self test for visualSkeleton() ...')
+    # exact confusables must collide
+    for (str1, str2) in [('Corn', 'Com'), ('exarnple', 'example'),
+                         ('examp1e', 'example'), ('wams', 'warns'),
+                         ('T1', 'tl'), ('y', 'Y')]:
+        if visualSkeleton(str1) != visualSkeleton(str2):
+            print('visualSkeleton failed built-in test for %r and %r.'
+                  % (str1, str2))
+            print('    It returned %r and %r.'
+                  % (visualSkeleton(str1), visualSkeleton(str2)))
+
+    # A collision at level 1 must mean a score of 1.  Check every two
+    # strings of the self test corpus, and each with its exact confusables.
+    corpus = set(st for (str1, str2, _) in
+                 strSimilarity.levenshteinTestCases +
+                 strSimilarity.howConfusableAreTestCases
+                 for st in (str1, str2))
+    for st in list(corpus):
+        corpus.add(st.lower().replace('m', 'rn').replace('l', '1'))
+    corpus = sorted(corpus)
+    for str1 in corpus:
+        for str2 in corpus:
+            if visualSkeleton(str1) != visualSkeleton(str2):
+                continue
+            score = strSimilarity.howConfusableAre(str1, str2)
+            if score != 1:
+                print('visualSkeleton failed built-in test for %r and %r.'
+                      % (str1, str2))
+                print('    They have the same skeleton, %r, but score %r.'
+                      % (visualSkeleton(str1), score))
+    print('    self test for visualSkeleton() done.')
@@ -32,6 +32,10 @@ versionMod=' *modified "Thu May 15 14:12:24 2008" *by "Paul E. Black"'
 #
 #----------------------------------------------------------------------------
 
+import bisect
+import threading
+import time
+
 import charSimilarity
 
 # Notes: similarity is not transitive.  SIM(X, Y) and SIM(Y, Z) does
@@ -104,20 +108,78 @@ def repetitionInsert(sl, i, tl, j):
 # I derived levenshtein() from code originally accessed 8 Feb 2008 at
 # http://en.wikibooks.org/wiki/Algorithm_implementation/Strings/Levenshtein_distance 
 
-traceLeven = 0
+# The cost of one cell of the matrix.  levenshtein(), levenshteinWithin()
+# and watchlist_trie.WatchlistTrie all compute their cells with
+# levenshteinCell(), so a cost rule only has to change here.  Two copies
+# remain: levenshteinInstrumented() names the operation that wins each
+# cell, and batch_similarity.levenshtein_many() computes whole anti-
+# diagonals with NumPy.  Their self tests compare them with levenshtein()
+# on fuzzedPairs().
+def levenshteinCell(sl, i, tl, j, above2, above, row,
+		    # bound once, as the cell is computed many times
+		    characterSimilarity=charSimilarity.fastCharacterSimilarity,
+		    digraphSimilarity=charSimilarity.fastDigraphSimilarity,
+		    repetitionInsert=repetitionInsert):
+    """Cost of d[i+1][j+1] in levenshtein()'s matrix d for the lower
+    cased strings sl and tl, from above2 = d[i-1] (unused if i == 0),
+    above = d[i] and row = d[i+1], filled up to row[j]."""
+    # "delete" or "insert" is in terms of changing s into t
+
+    # delete
+    minCost = above[j+1] + 1
+    # insert
+    cost = row[j] + 1
+    if cost < minCost: minCost = cost
+    # insert after repetition
+    repiCost = repetitionInsert(sl, i, tl, j)
+    if repiCost >= 0:
+        cost = row[j] + repiCost
+        if cost < minCost: minCost = cost
+    # delete after repetition
+    repdCost = repetitionInsert(tl, j, sl, i)
+    if repdCost >= 0:
+        cost = above[j+1] + repdCost
+        if cost < minCost: minCost = cost
+    # substite s[i] by t[j] - 0 cost if identical
+    cost = above[j] + (1 - characterSimilarity(sl[i], tl[j]))
+    if cost < minCost: minCost = cost
+
+    # compute total costs of 2 for 1, 1 for 2, or 2 for 2 substitution
+    if i > 0:
+        # cost of substituting s[i-1:i+1] by t[j]
+        subs21Cost = 1-digraphSimilarity(sl[i-1:i+1],tl[j])
+        if subs21Cost == 1: subs21Cost = 2 # substitute TWO characters
+        cost = above2[j] + subs21Cost
+        if cost < minCost: minCost = cost
+    if j > 0:
+        # cost of substituting s[i] by t[j-1:j+1]
+        subs12Cost = 1-digraphSimilarity(sl[i],tl[j-1:j+1])
+        if subs12Cost == 1: subs12Cost = 2 # substitute TWO characters
+        cost = above[j-1] + subs12Cost
+        if cost < minCost: minCost = cost
+    if i > 0 and j > 0:
+        # cost of substituting s[i-1:i+1] by t[j-1:j+1]
+        subs22Cost = 1-digraphSimilarity(sl[i-1:i+1],tl[j-1:j+1])
+        if subs22Cost == 1: subs22Cost = 2 # substitute TWO characters
+        cost = above2[j-1] + subs22Cost
+        if cost < minCost: minCost = cost
+
+        # cost of transposing s[i-1] and s[i] to get t[j-1] and t[j]
+        if sl[i-1] == tl[j] and sl[i] == tl[j-1]:
+            transpCost = 1 - characterSimilarity(sl[i], tl[j])
+            cost = above2[j-1] + transpCost
+            if cost < minCost: minCost = cost
+    return minCost
+
+traceLeven = 0 # print the matrix and every cost update (instrumented path)
+
+effInfinity = 9999999 # effectively infinity
 
 def levenshtein(s, t):
     """Find the Levenshtein (edit) distance between strings."""
-    effInfinity = 9999999 # effectively infinity
-    
-    def updateCost(baseCost, oprCost, lowestCostSoFar, operation):
-        (baseCostX, baseCostY) = baseCost
-        if baseCostX >= 0 and baseCostY >= 0:
-            newCost = d[baseCostX][baseCostY] + oprCost
-            if newCost < lowestCostSoFar:
-                if traceLeven: print newCost, oprCost, operation
-                return newCost
-        return lowestCostSoFar
+    # checked once per call, so instrumentation costs nothing when off
+    if levenshteinHook is not None or traceLeven:
+        return levenshteinInstrumented(s, t, levenshteinHook)
 
     # TO TEST SELF-TEST
     # make sure symmetry self-test works
@@ -130,63 +192,323 @@ def levenshtein(s, t):
     # CAUTION: HARDCODED INSERTION COST FOR EACH LOCATION
     d = [range(len_t+1)]
     d += [[i] for i in range(1, len_s+1)]
-    if traceLeven: print s, t, d # diagnostic
+    above = None
     for i in xrange(0, len_s):
+        (above2, above) = (above, d[i])
+        row = d[i+1]
         for j in xrange(0, len_t):
-            minCost = effInfinity
-            
-	    # "delete" or "insert" is in terms of changing s into t
+            row.append(levenshteinCell(sl, i, tl, j, above2, above, row))
+    return d[len_s][len_t]
 
-            # delete
-            minCost = updateCost((i, j+1), 1, minCost, 'd '+s[i])
-                
-            # insert
-            minCost = updateCost((i+1, j), 1, minCost, 'i '+t[j])
+#----------------------------------------------------------------------------
+#
+#   Instrumentation.  When levenshteinHook is set, levenshtein() runs
+#   levenshteinInstrumented() instead, the same dynamic program that also
+#   counts, for each call, the cells evaluated, the operation that won
+#   each cell, the cells where a repetition discount applied and the
+#   digraph substitutions that found similar digraphs.  It passes them
+#   to hook.record() with the time the call took.  LevenshteinStats is a
+#   hook that adds them up:
+#
+#	stats = LevenshteinStats()
+#	setLevenshteinHook(stats)
+#	... score production traffic ...
+#	setLevenshteinHook(None)
+#	print stats.asDict()
+#
+#   levenshteinWithin() is not instrumented.
+#
+#----------------------------------------------------------------------------
 
-            # insert after repetition
-            repiCost = repetitionInsert(sl, i, tl, j)
-            if repiCost >= 0:
-                minCost = updateCost((i+1, j), repiCost, minCost, 'ri '+t[j])
+levenshteinHook = None
+
+# operations that can set a cell, in the order they are tried; on a tie
+# the first one wins
+levenOperations = ('delete', 'insert', 'repetitionInsert',
+                   'repetitionDelete', 'substitute', 'substitute21',
+                   'substitute12', 'substitute22', 'transpose')
+digraphOperations = ('substitute21', 'substitute12', 'substitute22')
+
+def setLevenshteinHook(hook):
+    """Send the counts of every levenshtein() call to hook.record(), or
+    stop if hook is None.  Returns the hook that was set before."""
+    global levenshteinHook
+    oldHook = levenshteinHook
+    levenshteinHook = hook
+    return oldHook
+
+def levenshteinInstrumented(s, t, hook=None):
+    """levenshtein(), counting what it does for hook.record().
+
+    The cells are computed by a copy of levenshteinCell() that names the
+    operation each one takes; a change to a cost rule goes in both."""
+    started = time.time()
+    wins = dict.fromkeys(levenOperations, 0)
+    digraphHits = dict.fromkeys(digraphOperations, 0)
+    counts = {'cells': len(s) * len(t), 'wins': wins, 'repetitions': 0,
+              'digraphHits': digraphHits}
+
+    def updateCost(baseCost, oprCost, lowestCostSoFar, operation, trace):
+        (baseCostX, baseCostY) = baseCost
+        if baseCostX >= 0 and baseCostY >= 0:
+            newCost = d[baseCostX][baseCostY] + oprCost
+            if newCost < lowestCostSoFar[0]:
+                if traceLeven: print newCost, oprCost, trace
+                lowestCostSoFar[:] = [newCost, operation]
 
-            # delete after repetition
+    len_s = len(s)
+    len_t = len(t)
+    sl = s.lower() # do all comparisons lower case
+    tl = t.lower()
+    # the compiled tables take lower case arguments
+    characterSimilarity = charSimilarity.fastCharacterSimilarity
+    digraphSimilarity = charSimilarity.fastDigraphSimilarity
+
+    # CAUTION: HARDCODED INSERTION COST FOR EACH LOCATION
+    d = [range(len_t+1)]
+    d += [[i] for i in range(1, len_s+1)]
+    if traceLeven: print s, t, d # diagnostic
+    for i in xrange(0, len_s):
+        for j in xrange(0, len_t):
+            minCost = [effInfinity, None] # cost and the operation for it
+            updateCost((i, j+1), 1, minCost, 'delete', 'd '+s[i])
+            updateCost((i+1, j), 1, minCost, 'insert', 'i '+t[j])
+            repiCost = repetitionInsert(sl, i, tl, j)
             repdCost = repetitionInsert(tl, j, sl, i)
+            if repiCost >= 0 or repdCost >= 0:
+                counts['repetitions'] += 1
+            if repiCost >= 0:
+                updateCost((i+1, j), repiCost, minCost, 'repetitionInsert',
+                           'ri '+t[j])
             if repdCost >= 0:
-                minCost = updateCost((i, j+1), repdCost, minCost, 'rd '+s[i])
-
-            # substite s[i] by t[j] - 0 cost if identical
-            subsCost = 1 - charSimilarity.characterSimilarity(sl[i], tl[j])
-            minCost = updateCost((i, j), subsCost, minCost,'s '+s[i]+'->'+t[j])
-
-            # compute total costs of 2 for 1, 1 for 2, or 2 for 2 substitution
+                updateCost((i, j+1), repdCost, minCost, 'repetitionDelete',
+                           'rd '+s[i])
+            subsCost = 1 - characterSimilarity(sl[i], tl[j])
+            updateCost((i, j), subsCost, minCost, 'substitute',
+                       's '+s[i]+'->'+t[j])
             if i > 0:
-                # cost of substituting s[i-1:i+1] by t[j]
-                subs21Cost = \
-                         1-charSimilarity.digraphSimilarity(sl[i-1:i+1],tl[j])
+                subs21Cost = 1-digraphSimilarity(sl[i-1:i+1],tl[j])
                 if subs21Cost == 1: subs21Cost = 2 # substitute TWO characters
-                minCost = updateCost((i-1, j), subs21Cost, minCost, 's21')
+                else: digraphHits['substitute21'] += 1
+                updateCost((i-1, j), subs21Cost, minCost, 'substitute21',
+                           's21')
             if j > 0:
-                # cost of substituting s[i] by t[j-1:j+1]
-                subs12Cost = \
-                         1-charSimilarity.digraphSimilarity(sl[i],tl[j-1:j+1])
+                subs12Cost = 1-digraphSimilarity(sl[i],tl[j-1:j+1])
                 if subs12Cost == 1: subs12Cost = 2 # substitute TWO characters
-                minCost = updateCost((i, j-1), subs12Cost, minCost, 's12')
+                else: digraphHits['substitute12'] += 1
+                updateCost((i, j-1), subs12Cost, minCost, 'substitute12',
+                           's12')
             if i > 0 and j > 0:
-                # cost of substituting s[i-1:i+1] by t[j-1:j+1]
-                subs22Cost = \
-                    1-charSimilarity.digraphSimilarity(sl[i-1:i+1],tl[j-1:j+1])
+                subs22Cost = 1-digraphSimilarity(sl[i-1:i+1],tl[j-1:j+1])
                 if subs22Cost == 1: subs22Cost = 2 # substitute TWO characters
-                minCost = updateCost((i-1, j-1), subs22Cost, minCost, 's22')
-
-                # cost of transposing s[i-1] and s[i] to get t[j-1] and t[j]
+                else: digraphHits['substitute22'] += 1
+                updateCost((i-1, j-1), subs22Cost, minCost, 'substitute22',
+                           's22')
                 if sl[i-1] == tl[j] and sl[i] == tl[j-1]:
-		    transpCost = \
-                        1 - charSimilarity.characterSimilarity(sl[i], tl[j])
-		    minCost = updateCost((i-1, j-1), transpCost, minCost, 't')
-            d[i+1].append(minCost)
+                    transpCost = 1 - characterSimilarity(sl[i], tl[j])
+                    updateCost((i-1, j-1), transpCost, minCost, 'transpose',
+                               't')
+            d[i+1].append(minCost[0])
+            wins[minCost[1]] += 1
             if traceLeven: print d #diagnostic
     if traceLeven: print d #diagnostic
+    if hook is not None:
+        hook.record(s, t, counts, time.time() - started)
     return d[len_s][len_t]
 
+class LevenshteinStats(object):
+    """A levenshtein() hook that adds up the counts and times of calls.
+
+    Safe to share between threads.  The times are of the instrumented
+    program, which is slower than the plain one."""
+
+    # upper bounds of the buckets of the call time histogram, in
+    # microseconds; the last bucket has the slower calls
+    timeBuckets = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget every call recorded so far."""
+        self.calls = 0
+        self.cells = 0
+        self.repetitions = 0
+        self.wins = dict.fromkeys(levenOperations, 0)
+        self.digraphHits = dict.fromkeys(digraphOperations, 0)
+        self.seconds = 0.0
+        self.maxSeconds = 0.0
+        self.timeHistogram = [0] * (len(self.timeBuckets) + 1)
+
+    def record(self, s, t, counts, seconds):
+        """Add the counts of one levenshtein(s, t) call."""
+        bucket = bisect.bisect_left(self.timeBuckets, seconds * 1e6)
+        with self.lock:
+            self.calls += 1
+            self.cells += counts['cells']
+            self.repetitions += counts['repetitions']
+            for (operation, n) in counts['wins'].iteritems():
+                self.wins[operation] += n
+            for (operation, n) in counts['digraphHits'].iteritems():
+                self.digraphHits[operation] += n
+            self.seconds += seconds
+            self.maxSeconds = max(self.maxSeconds, seconds)
+            self.timeHistogram[bucket] += 1
+
+    def asDict(self):
+        """The aggregates as a dict of numbers, ready for JSON."""
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'cells': self.cells,
+                'repetitionCells': self.repetitions,
+                'wins': dict(self.wins),
+                'digraphHits': dict(self.digraphHits),
+                'seconds': self.seconds,
+                'meanSeconds': self.seconds / self.calls if self.calls else 0,
+                'maxSeconds': self.maxSeconds,
+                'timeHistogramMicroseconds': dict(
+                    ('<=%d' % bound if k < len(self.timeBuckets) else
+                     '>%d' % self.timeBuckets[-1], n)
+                    for (k, (bound, n)) in enumerate(zip(
+                        self.timeBuckets + (self.timeBuckets[-1],),
+                        self.timeHistogram))),
+            }
+
+#----------------------------------------------------------------------------
+#
+#   Find the Levenshtein distance, but only if it is at most maxDist.
+#   This is the lazy evaluation suggested above.  A cell of d that costs
+#   more than maxDist cannot be on a path that costs less, so it is
+#   treated as infinite.  Each row is only computed over the columns the
+#   cells of the two rows above it can still reach, plus as far along the
+#   row as insertions stay within maxDist.  Once two rows in a row are
+#   all over maxDist, no later cell can be within it.
+#
+#   A fixed diagonal band, |i - j| <= maxDist, is NOT enough here: rn for
+#   m and long repetitions move to another diagonal for free.  So the band
+#   follows the cells that are still within maxDist instead.
+#
+#----------------------------------------------------------------------------
+
+def levenshteinWithin(s, t, maxDist):
+    """Find the Levenshtein distance between strings if it is <= maxDist.
+
+    Returns the same distance as levenshtein() if that is at most maxDist,
+    and effInfinity otherwise."""
+    len_s = len(s)
+    len_t = len(t)
+    sl = s.lower() # do all comparisons lower case
+    tl = t.lower()
+    bound = maxDist + 1e-9 # allow for rounding in maxDist
+    if bound < 0:
+        return effInfinity
+
+    # Only three rows of d are kept: prev2 and prev, the rows for s[:i-1]
+    # and s[:i], and row, the one for s[:i+1].  lo and hi are the first
+    # and last columns of a row that are within bound (hi < lo if none).
+    # CAUTION: HARDCODED INSERTION COST FOR EACH LOCATION
+    prev2 = None
+    lo2, hi2 = len_t+1, -1
+    prev = [effInfinity] * (len_t+1)
+    lo, hi = 0, min(len_t, int(bound))
+    for j in xrange(0, hi+1):
+        prev[j] = j
+    for i in xrange(0, len_s):
+        row = [effInfinity] * (len_t+1)
+        if i+1 <= bound:
+            row[0] = i+1
+            rowLo, rowHi = 0, 0
+        else:
+            rowLo, rowHi = len_t+1, -1
+        # columns fed by cells of the rows above that are within bound
+        reach = max(hi+1, hi2+1)
+        for j in xrange(max(0, min(lo-1, lo2)), len_t):
+            if j > reach and row[j] > bound:
+                break # only insertions reach further, and they are too costly
+            minCost = levenshteinCell(sl, i, tl, j, prev2, prev, row)
+            if minCost <= bound:
+                row[j+1] = minCost
+                rowLo = min(rowLo, j+1)
+                rowHi = j+1
+
+        if rowHi < 0 and hi < 0:
+            return effInfinity # two rows all over the bound
+        prev2, lo2, hi2 = prev, lo, hi
+        prev, lo, hi = row, rowLo, rowHi
+    return prev[len_t]
+
+#----------------------------------------------------------------------------
+#
+#   Skip most of the prefix and suffix two strings share.  Names compared
+#   with each other often share long parts, like .com, .exe or -update,
+#   and identical characters cost nothing.  But the rules look around the
+#   characters they compare: a repetition looks back along the whole run,
+#   and the digraph and transposition rules look one character further.
+#   So trimAffixes() keeps the run next to each cut and trimContext more
+#   shared characters.
+#
+#   Even so, the distance of the trimmed strings is only an upper bound:
+#   in unusual strings a path through the shared part is cheaper, say a
+#   repetition in a run further back and look-alike characters to get
+#   back in step.  Every path of the trimmed strings is a path of the
+#   whole ones that costs no less, so the bound holds.
+#   levenshteinTrimmed() passes it to levenshteinWithin() on the whole
+#   strings.  That gives exactly levenshtein()'s distance, but only
+#   computes the cells within the bound, a narrow band along the shared
+#   parts.  howConfusableAre() with a min_score needs no trimming: the
+#   band of levenshteinWithin() already follows the shared parts.
+#
+#----------------------------------------------------------------------------
+
+trimContext = 2 # shared characters kept at each cut, besides the run there
+
+# trim only if the trimmed matrix has at most 1/trimMinGain of the cells
+trimMinGain = 4
+
+def commonAffixes(sl, tl):
+    """Lengths of the prefix and the suffix that sl and tl share.
+
+    The suffix does not overlap the prefix."""
+    n = min(len(sl), len(tl))
+    prefix = 0
+    while prefix < n and sl[prefix] == tl[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and sl[-1-suffix] == tl[-1-suffix]:
+        suffix += 1
+    return (prefix, suffix)
+
+def trimAffixes(s, t, context=trimContext):
+    """Return s and t lower cased, without the prefix and suffix they
+    share, except for the run at each cut and context more characters."""
+    sl = s.lower() # do all comparisons lower case
+    tl = t.lower()
+    (prefix, suffix) = commonAffixes(sl, tl)
+    start = 0
+    if prefix:
+        start = prefix - 1
+        while start > 0 and sl[start-1] == sl[prefix-1]:
+            start -= 1 # the run the prefix ends with
+        start = max(0, start - context)
+    end = 0
+    if suffix:
+        end = suffix - 1
+        while end > 0 and sl[-end] == sl[-suffix]:
+            end -= 1 # the run the suffix starts with
+        end = max(0, end - context)
+    return (sl[start:len(sl)-end], tl[start:len(tl)-end])
+
+def levenshteinTrimmed(s, t):
+    """levenshtein(s, t), computing fewer cells when s and t share a long
+    prefix or suffix."""
+    (st, tt) = trimAffixes(s, t)
+    if (len(st)+1) * (len(tt)+1) * trimMinGain > (len(s)+1) * (len(t)+1):
+        return levenshtein(s, t) # too little shared for a second pass
+    # levenshtein(st, tt) is at least levenshtein(s, t)
+    return levenshteinWithin(s, t, levenshtein(st, tt))
+
 # floats are rarely exactly the same. this allows for a range
 def fEqual(f1, f2):
     """Return True if floats passed are nearly equal."""
@@ -215,54 +537,160 @@ def levenshtein_chkPair(str1, str2, expectedScore):
 				str1, 'and', str2 + '.'
 	print '    It returned', resultScore, \
 				'instead of', str(expectedScore) + '.'
-
-def levenshtein_selftest():
-    """Built-in self test levenshtein()."""
-    print '    running self test for levenshtein() ...'
+    levenshteinWithin_chkPair(str1, str2, expectedScore)
+    # the length bound must not be over the distance
+    if minLevenshteinFor(str1, str2) > expectedScore + .0000001:
+	print 'minLevenshteinFor() failed built-in test for', \
+				str1, 'and', str2 + '.'
+	print '    It returned', minLevenshteinFor(str1, str2), \
+				'which is over', str(expectedScore) + '.'
+
+def levenshteinWithin_chkPair(str1, str2, expectedScore):
+    """Check that levenshteinWithin() works in one instance."""
+    # just within the bound, and just over it
+    for (maxDist, expectedResult) in [(expectedScore, expectedScore),
+				(expectedScore - .05, effInfinity)]:
+	resultScore = levenshteinWithin(str1, str2, maxDist)
+	if not fEqual(resultScore, expectedResult):
+	    print 'levenshteinWithin() failed built-in test for', \
+				str1, 'and', str2, 'within', str(maxDist) + '.'
+	    print '    It returned', resultScore, \
+				'instead of', str(expectedResult) + '.'
+
+# pairs of strings and their expected distances for levenshtein_selftest()
+levenshteinTestCases = [
     # check degenerate cases
-    levenshtein_chkPair('', '', 0)
-    levenshtein_chkPair('a', '', 1)
-    levenshtein_chkPair('bc', '', 2)
+    ('', '', 0),
+    ('a', '', 1),
+    ('bc', '', 2),
     # check simple cases
-    levenshtein_chkPair('G', 'G', 0)   # same character
-    levenshtein_chkPair('H', 'h', 0)   # upper case vs. lower case
-    levenshtein_chkPair('i', 'qI', 1)  # insertion before
-    levenshtein_chkPair('J', 'Jd', 1)  # insertion after
-    levenshtein_chkPair('K', 'mk-', 2) # insertion before and after
-    levenshtein_chkPair('s', 'x', 1)   # substitution
-    levenshtein_chkPair('lrQ', 'l4q', 1) # embedded substitution
+    ('G', 'G', 0),   # same character
+    ('H', 'h', 0),   # upper case vs. lower case
+    ('i', 'qI', 1),  # insertion before
+    ('J', 'Jd', 1),  # insertion after
+    ('K', 'mk-', 2), # insertion before and after
+    ('s', 'x', 1),   # substitution
+    ('lrQ', 'l4q', 1), # embedded substitution
     # check similar single character substitutions
-    levenshtein_chkPair('T1', 'tl', 0)
-    levenshtein_chkPair('uh', 'vH', .9)
-    levenshtein_chkPair('Scar', 'Soar', .7)
-    levenshtein_chkPair('labsRUs', 'ladsRUs', .8)
+    ('T1', 'tl', 0),
+    ('uh', 'vH', .9),
+    ('Scar', 'Soar', .7),
+    ('labsRUs', 'ladsRUs', .8),
     # check similar double character substitutions
-    levenshtein_chkPair('f', 'fl', .5)
-    levenshtein_chkPair('Clock', 'Dock', .6) # lower case looks similar
-    levenshtein_chkPair('WN', 'vvn', .2) # at beginning
-    levenshtein_chkPair('mn', 'mn', 0)
-    levenshtein_chkPair('Mn', 'nm', .5)
-    levenshtein_chkPair('xmn', 'xnm', .5) # at end
-    levenshtein_chkPair('m', 'NN', .5)
-    levenshtein_chkPair('AAf', 'mFL', 1.3) # two substitutions
-    levenshtein_chkPair('wams', 'warns', 0) # embedded
+    ('f', 'fl', .5),
+    ('Clock', 'Dock', .6), # lower case looks similar
+    ('WN', 'vvn', .2), # at beginning
+    ('mn', 'mn', 0),
+    ('Mn', 'nm', .5),
+    ('xmn', 'xnm', .5), # at end
+    ('m', 'NN', .5),
+    ('AAf', 'mFL', 1.3), # two substitutions
+    ('wams', 'warns', 0), # embedded
     # check transposition
-    levenshtein_chkPair('often', 'otfen', .7)
-    levenshtein_chkPair('cheif', 'chief', 1)
-    levenshtein_chkPair('Pterodactyl', 'Tperodactyl', 1) # mixed case
+    ('often', 'otfen', .7),
+    ('cheif', 'chief', 1),
+    ('Pterodactyl', 'Tperodactyl', 1), # mixed case
     # check repetition insert
-    levenshtein_chkPair('Mm', 'mmM', .9) # minimal, longer on right
-    levenshtein_chkPair('XIIII', 'XIII', .5) # 4 vs. 3, longer on left
-    levenshtein_chkPair('aaaah', 'aaaaah', .1) # 4 vs. 5, at start
-    levenshtein_chkPair('MiSSsssipPpi', 'MisSSssSippi', .9)
+    ('Mm', 'mmM', .9), # minimal, longer on right
+    ('XIIII', 'XIII', .5), # 4 vs. 3, longer on left
+    ('aaaah', 'aaaaah', .1), # 4 vs. 5, at start
+    ('MiSSsssipPpi', 'MisSSssSippi', .9),
     # other checks
-    levenshtein_chkPair('xw', '5t', 2)
-    levenshtein_chkPair('w', 'dd', 2)
-    levenshtein_chkPair('', 'We-the-People-of-the-United-States-in-Order-to-form-a-more-perfect-Union-establish-Justice-insure-domestic-Tranquility-provide-for-the-common-defence-promote-the-general-Welfare-and-secure-the-Blessings-of-Liberty-to-ourselves-and-our-Posterity-do-ordain-and-establish-this-Constitution-for-the-United-States-of-America', 319) # long word
-    levenshtein_chkPair('aerometeorograph','floccinaucinihilipilification',26.1)
-    #levenshtein_chkPair('', '', )
+    ('xw', '5t', 2),
+    ('w', 'dd', 2),
+    ('', 'We-the-People-of-the-United-States-in-Order-to-form-a-more-perfect-Union-establish-Justice-insure-domestic-Tranquility-provide-for-the-common-defence-promote-the-general-Welfare-and-secure-the-Blessings-of-Liberty-to-ourselves-and-our-Posterity-do-ordain-and-establish-this-Constitution-for-the-United-States-of-America', 319), # long word
+    ('aerometeorograph','floccinaucinihilipilification',26.1),
+    # check Unicode lookalikes
+    (u'p\u0430yp\u0430l', 'paypal', 0), # Cyrillic a
+    (u'\u0433\u043e\u043e\u0433\u04cf\u0435', 'google', 2), # ghe is not g
+    #('', '', ),
+]
+
+def levenshtein_selftest():
+    """Built-in self test levenshtein()."""
+    print '    running self test for levenshtein() ...'
+    for (str1, str2, expectedScore) in levenshteinTestCases:
+        levenshtein_chkPair(str1, str2, expectedScore)
     print '    self test for levenshtein() done.'
 
+def levenshteinHook_selftest():
+    """Built-in self test for the levenshtein() instrumentation."""
+    print '    running self test for levenshteinHook ...'
+    stats = LevenshteinStats()
+    oldHook = setLevenshteinHook(stats)
+    try:
+        for (str1, str2, expectedScore) in levenshteinTestCases:
+            levenshtein_chkPair(str1, str2, expectedScore)
+        cells = sum(len(str1) * len(str2)
+                    for (str1, str2, expectedScore) in levenshteinTestCases)
+        if stats.calls != 2 * len(levenshteinTestCases) or \
+			stats.cells != 2 * cells or \
+			sum(stats.wins.values()) != stats.cells:
+            print 'levenshteinHook failed built-in test: counted', \
+				stats.calls, 'calls,', stats.cells, 'cells and', \
+				sum(stats.wins.values()), 'wins.'
+        stats.reset()
+        levenshtein('rn', 'm')
+        if stats.wins['substitute21'] != 1 or \
+			stats.digraphHits['substitute21'] != 1:
+            print 'levenshteinHook failed built-in test for rn and m.'
+            print '    It counted', stats.asDict()
+        stats.reset()
+        levenshtein('misssippi', 'missssippi')
+        if stats.repetitions < 1 or stats.wins['repetitionInsert'] < 1:
+            print 'levenshteinHook failed built-in test for repetitions.'
+            print '    It counted', stats.asDict()
+    finally:
+        setLevenshteinHook(oldHook)
+    # levenshteinInstrumented() keeps its own copy of levenshteinCell()
+    for (str1, str2) in fuzzedPairs(100):
+        expectedScore = levenshtein(str1, str2)
+        resultScore = levenshteinInstrumented(str1, str2)
+        if resultScore != expectedScore:
+            print 'levenshteinInstrumented() failed built-in test for', \
+				str1, 'and', str2 + '.'
+            print '    It returned', resultScore, \
+				'instead of', str(expectedScore) + '.'
+    print '    self test for levenshteinHook done.'
+
+def fuzzedPairs(count=200, seed=0):
+    """Random pairs of strings sharing a prefix and a suffix around
+    differing cores, count from each of three alphabets: two of
+    look-alikes, so that every cost rule comes up, and a plain one."""
+    import random
+    pairs = []
+    rng = random.Random(seed)
+    for alphabet in ['rnmsil1o0vwcd', 'sl1iorn',
+			'abcdefghijklmnopqrstuvwxyz0123456789.-']:
+        for k in range(count):
+            (prefix, suffix) = [''.join(rng.choice(alphabet)
+				for _ in range(rng.randint(0, 12))) for _ in 'ps']
+            core = ''.join(rng.choice(alphabet)
+				for _ in range(rng.randint(0, 8)))
+            other = ''.join(ch if rng.random() < .6 else rng.choice(alphabet)
+				for ch in core)[:rng.randint(0, 10)]
+            pairs.append((prefix + core + suffix, prefix + other + suffix))
+    return pairs
+
+def levenshteinTrimmed_selftest():
+    """Built-in self test for levenshteinTrimmed()."""
+    print '    running self test for levenshteinTrimmed() ...'
+    pairs = [(str1, str2) for (str1, str2, expectedScore) in
+			levenshteinTestCases + [('wrc111rsolrsmmc', 'wrc111rsmmc', 0),
+			('secure-login-paypal-update.com',
+			 'secure-login-paypa1-update.com', 0)]]
+    # shared affixes around random cores, from alphabets of look-alikes
+    pairs += fuzzedPairs()
+    for (str1, str2) in pairs:
+        expectedScore = levenshtein(str1, str2)
+        resultScore = levenshteinTrimmed(str1, str2)
+        if resultScore != expectedScore:
+            print 'levenshteinTrimmed() failed built-in test for', \
+				str1, 'and', str2 + '.'
+            print '    It returned', resultScore, \
+				'instead of', str(expectedScore) + '.'
+    print '    self test for levenshteinTrimmed() done.'
+
 
 #----------------------------------------------------------------------------
 #
@@ -272,10 +700,65 @@ def levenshtein_selftest():
 #
 #----------------------------------------------------------------------------
 
-def howConfusableAre(str1, str2):
+#----------------------------------------------------------------------------
+#
+#   Lower bound on the distance from the lengths of the strings.  Any
+#   alignment of s and t needs at least abs(len(s) - len(t)) edits that
+#   change the length by one: insertions and deletions, with or without
+#   a repetition, and 2 for 1 or 1 for 2 substitutions.  Plain insertions
+#   and deletions cost 1, but the others can cost less, down to 0 for rn
+#   and m, so the cost of each such edit is only bounded by what the
+#   strings contain.
+#
+#----------------------------------------------------------------------------
+
+# cheapest 2 for 1 or 1 for 2 substitution each digraph or character is in
+lengthChangeCosts = {}
+for ((str1, str2), similarity) in charSimilarity.dcsimtab.items():
+    if len(str1) != len(str2) and similarity > 0 and \
+			str1 == str1.lower() and str2 == str2.lower():
+	for st in (str1, str2):
+	    lengthChangeCosts[st] = min(lengthChangeCosts.get(st, 1),
+					1 - similarity)
+
+def lengthChangeFloor(s):
+    """Lowest cost of an edit involving s that changes the length."""
+    sl = s.lower()
+    floor = 1 # insertion or deletion
+    run = 1
+    for k in xrange(len(sl)):
+	# a repetition insert or delete after a run of this length
+	if k > 0 and sl[k] == sl[k-1]:
+	    run += 1
+	    floor = min(floor, max(0, 1.7 - 0.4*run))
+	else:
+	    run = 1
+	# a substitution with the character or the digraph starting here
+	floor = min(floor, lengthChangeCosts.get(sl[k], 1),
+		    lengthChangeCosts.get(sl[k:k+2], 1))
+    return floor
+
+def minLevenshteinFor(s, t, floor_s=None, floor_t=None):
+    """Lower bound on levenshtein(s, t) from the lengths of the strings.
+
+    floor_s and floor_t are lengthChangeFloor() of s and t, if known."""
+    if floor_s is None: floor_s = lengthChangeFloor(s)
+    if floor_t is None: floor_t = lengthChangeFloor(t)
+    # each edit costs at least the floor of both strings
+    return abs(len(s) - len(t)) * max(floor_s, floor_t)
+
+# largest levenshtein() distance that still scores at least minScore
+def maxLevenshteinFor(maxlen, lendiff, minScore):
+    """Solve howConfusableAre()'s score formula for the distance."""
+    # minScore <= (maxlen - levDist)/(maxlen + 3*levDist + lendiff*levDist)
+    return maxlen*(1.0 - minScore)/(1 + minScore*(3 + lendiff))
+
+def howConfusableAre(str1, str2, min_score=None):
     """Rate the visible similarity of the strings.
 
-    Rating is 0 to 1 inclusive, where 1 means visually indistinguishable."""
+    Rating is 0 to 1 inclusive, where 1 means visually indistinguishable.
+    If min_score is given, ratings below it are returned as 0.  That lets
+    the edit distance stop as soon as the rating can no longer reach it."""
 
     # None parameters not handled
 
@@ -284,16 +767,23 @@ def howConfusableAre(str1, str2):
     #if str1 == 'a':
     #    return .777
 
+    minlen = min(len(str1), len(str2))
+    maxlen = max(len(str1), len(str2))
+    lendiff = abs(len(str1) - len(str2))
+
     # Begin with a Levenshtein distance between the strings.
     # Substitution of visually similar characters "costs" less than
     # one insertion, deletion, or substitution
-    levDist = 0.0 + levenshtein(str1, str2)
+    if min_score is not None and min_score > 0 and maxlen > 0:
+        levDist = 0.0 + levenshteinWithin(str1, str2,
+                            maxLevenshteinFor(maxlen, lendiff, min_score))
+        if levDist >= effInfinity:
+            return 0.0 # can't reach min_score
+    else:
+        levDist = 0.0 + levenshteinTrimmed(str1, str2)
 
     # Normalize to [0, 1] and account for longer words being more
     # confusable than shorter words with the same Levenshtein distance
-    minlen = min(len(str1), len(str2))
-    maxlen = max(len(str1), len(str2))
-    lendiff = abs(len(str1) - len(str2))
     # SKIMP the maxlen==0 test is approximate.  Strictly, we should
     # ask if the values used in the scoring would be n/0.  But I don't
     # want to be changing this test all the time while the scoring fn
@@ -308,7 +798,9 @@ def howConfusableAre(str1, str2):
     if not (0 <= score and score <= 1):
         print '**ERROR: NON-NORMAL SCORE:', score, 'for', str1, str2
     assert(0 <= score and score <= 1)
-    
+
+    if min_score is not None and score < min_score:
+        return 0.0
     return score
 
 def howConfusableAre_chkSym(str1, str2):
@@ -338,27 +830,51 @@ def howConfusableAre_chkPair(str1, str2, expectedScore):
 				str1, 'and', str2 + '.'
 	print '    It returned', resultScore, \
 				'instead of', str(expectedScore) + '.'
+    howConfusableAre_chkMinScore(str1, str2)
+
+def howConfusableAre_chkMinScore(str1, str2):
+    """Check that min_score only drops ratings below it."""
+    fullScore = howConfusableAre(str1, str2)
+    for minScore in [0, .1, .3, .5, .63, .8, .95, 1, 1.1]:
+	if fullScore >= minScore:
+	    expectedScore = fullScore
+	else:
+	    expectedScore = 0
+	resultScore = howConfusableAre(str1, str2, min_score=minScore)
+	if not fEqual(resultScore, expectedScore):
+	    print 'howConfusableAre failed built-in test for', \
+				str1, 'and', str2, 'with min_score', minScore
+	    print '    It returned', resultScore, \
+				'instead of', str(expectedScore) + '.'
+
+# pairs of strings and their expected scores for howConfusableAre_selftest()
+howConfusableAreTestCases = [
+    ('', '', 1),
+    ('', '2', 0),
+    ('y', 'Y', 1),
+    ('a', 'ab', .17),
+    ('Corn', 'Com', 1),
+    ('biz', 'bz', .29),
+    ('evample', 'example', .63),
+    ('exomple', 'example', .69),
+    ('exarnple', 'example', 1),
+    ('examqle', 'example', .63),
+    ('examp1e', 'example', 1),
+    ('exampl', 'example', .55),
+    ('examplo', 'example', .66),
+    ('z', 'zoology', .016),
+]
 
 def howConfusableAre_selftest():
     """Built-in self test for howConfusableAre()."""
     charSimilarity.characterSimilarity_selftest()
     charSimilarity.digraphSimilarity_selftest()
     levenshtein_selftest()
+    levenshteinHook_selftest()
+    levenshteinTrimmed_selftest()
     print '    running self test for howConfusableAre() ...'
-    howConfusableAre_chkPair('', '', 1)
-    howConfusableAre_chkPair('', '2', 0)
-    howConfusableAre_chkPair('y', 'Y', 1)
-    howConfusableAre_chkPair('a', 'ab', .17)
-    howConfusableAre_chkPair('Corn', 'Com', 1)
-    howConfusableAre_chkPair('biz', 'bz', .29)
-    howConfusableAre_chkPair('evample', 'example', .63)
-    howConfusableAre_chkPair('exomple', 'example', .69)
-    howConfusableAre_chkPair('exarnple', 'example', 1)
-    howConfusableAre_chkPair('examqle', 'example', .63)
-    howConfusableAre_chkPair('examp1e', 'example', 1)
-    howConfusableAre_chkPair('exampl', 'example', .55)
-    howConfusableAre_chkPair('examplo', 'example', .66)
-    howConfusableAre_chkPair('z', 'zoology', .016)
+    for (str1, str2, expectedScore) in howConfusableAreTestCases:
+        howConfusableAre_chkPair(str1, str2, expectedScore)
     print '    self test for howConfusableAre() done.'
 
 # end of $Source: /home/black/GTLD/RCS/strSimilarity.py,v $
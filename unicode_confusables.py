@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+"""Similarities of Unicode characters that look like ASCII ones.
+
+charSimilarity.scsimtab only has ASCII pairs, so characterSimilarity() rates
+the Cyrillic a (U+0430) in a spoofed paypal.com as different from a.  The
+data file unicode_confusables.txt lists, for each of a few thousand lower
+case Unicode characters, the ASCII character it looks like and how similar
+they are, one line each:
+
+    0430 ;	0061 ;	1	# ( а -> a ) CYRILLIC SMALL LETTER A -> LATIN SMALL LETTER A
+
+It is bundled with the code and was generated offline by generateLines(),
+from the hand made LOOKALIKES table below and the compatibility and
+canonical decompositions in unicodedata (fullwidth, mathematical and
+accented letters).
+
+loadConfusables() reads it into a ConfusablesTable.  As the init loops of
+charSimilarity do for scsimtab, it adds a lower case version of every pair
+with an upper case character and reports inconsistencies.  Two characters
+that look like the same ASCII character also look like each other, and like
+the ASCII characters scsimtab rates it similar to, so the table also has
+those pairs, each as similar as the less similar of the two pairs it
+comes from.  That is tens of thousands of pairs, too many for a dict with
+tuple keys.  A ConfusablesTable keeps them as a sorted array of code point
+pairs, each packed in one integer, and an array of similarities, and finds
+a pair by binary search:
+
+    python unicode_confusables.py            # size, memory and lookup time
+    python unicode_confusables.py --generate # write the data file again
+"""
+from __future__ import with_statement
+
+import argparse
+import array
+import bisect
+import os
+import sys
+import time
+import unicodedata
+
+import charSimilarity
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'unicode_confusables.txt')
+
+# the ASCII characters data file lines can point to
+TARGETS = 'abcdefghijklmnopqrstuvwxyz0123456789-._'
+
+# code points are packed as (smaller << CODE_BITS) | larger
+CODE_BITS = 21
+
+# lower case lookalikes of ASCII characters that no decomposition gives
+LOOKALIKES = {
+	# Cyrillic
+	(u'а', 'a'):	1,	# a
+	(u'е', 'e'):	1,	# ie
+	(u'о', 'o'):	1,	# o
+	(u'р', 'p'):	1,	# er
+	(u'с', 'c'):	1,	# es
+	(u'у', 'y'):	.9,	# u
+	(u'х', 'x'):	1,	# ha
+	(u'ѕ', 's'):	1,	# dze
+	(u'і', 'i'):	1,	# byelorussian-ukrainian i
+	(u'ј', 'j'):	1,	# je
+	(u'һ', 'h'):	1,	# shha
+	(u'ԁ', 'd'):	1,	# komi de
+	(u'ԛ', 'q'):	1,	# qa
+	(u'ԝ', 'w'):	1,	# we
+	(u'ӏ', 'l'):	1,	# palochka
+	(u'ѵ', 'v'):	.9,	# izhitsa
+	(u'ѡ', 'w'):	.6,	# omega
+	(u'к', 'k'):	.5,	# ka
+	(u'м', 'm'):	.5,	# em
+	(u'п', 'n'):	.6,	# pe
+	(u'т', 't'):	.4,	# te
+	(u'г', 'r'):	.5,	# ghe
+	(u'ь', 'b'):	.5,	# soft sign
+	(u'в', 'b'):	.3,	# ve
+	(u'з', '3'):	.7,	# ze
+	(u'ӡ', '3'):	.8,	# abkhasian dze
+	(u'б', '6'):	.6,	# be
+	# Greek
+	(u'ο', 'o'):	1,	# omicron
+	(u'ϲ', 'c'):	1,	# lunate sigma
+	(u'ϳ', 'j'):	1,	# yot
+	(u'α', 'a'):	.7,	# alpha
+	(u'ν', 'v'):	.9,	# nu
+	(u'ρ', 'p'):	.9,	# rho
+	(u'ι', 'i'):	.8,	# iota
+	(u'κ', 'k'):	.8,	# kappa
+	(u'υ', 'u'):	.8,	# upsilon
+	(u'χ', 'x'):	.8,	# chi
+	(u'η', 'n'):	.7,	# eta
+	(u'γ', 'y'):	.6,	# gamma
+	(u'ω', 'w'):	.6,	# omega
+	(u'ε', 'e'):	.5,	# epsilon
+	(u'β', 'b'):	.5,	# beta
+	(u'μ', 'u'):	.5,	# mu
+	(u'τ', 't'):	.5,	# tau
+	# Armenian
+	(u'օ', 'o'):	1,	# oh
+	(u'ս', 'u'):	.9,	# seh
+	(u'ո', 'n'):	.9,	# vo
+	(u'ց', 'g'):	.8,	# co
+	(u'հ', 'h'):	.8,	# ho
+	(u'զ', 'q'):	.7,	# za
+	(u'ք', 'p'):	.5,	# keh
+	# Latin letters with no decomposition
+	(u'ɑ', 'a'):	.9,	# alpha
+	(u'ɡ', 'g'):	1,	# script g
+	(u'ı', 'i'):	.8,	# dotless i
+	(u'ȷ', 'j'):	.8,	# dotless j
+	(u'ɩ', 'i'):	.8,	# iota
+	(u'ɪ', 'i'):	.6,	# small capital i
+	(u'ʏ', 'y'):	.7,	# small capital y
+	(u'ʜ', 'h'):	.5,	# small capital h
+	(u'ᴀ', 'a'):	.6,	# small capital a
+	(u'ᴄ', 'c'):	.9,	# small capital c
+	(u'ᴏ', 'o'):	.9,	# small capital o
+	(u'ᴜ', 'u'):	.9,	# small capital u
+	(u'ᴠ', 'v'):	.9,	# small capital v
+	(u'ᴡ', 'w'):	.9,	# small capital w
+	(u'ᴢ', 'z'):	.9,	# small capital z
+	(u'ꜱ', 's'):	.9,	# small capital s
+	(u'ɵ', 'o'):	.6,	# barred o
+	(u'ƀ', 'b'):	.7,	# b with stroke
+	(u'đ', 'd'):	.7,	# d with stroke
+	(u'ħ', 'h'):	.7,	# h with stroke
+	(u'ł', 'l'):	.7,	# l with stroke
+	(u'ø', 'o'):	.7,	# o with stroke
+	# digits
+	(u'߀', '0'):	.8,	# nko digit zero
+	(u'०', '0'):	.7,	# devanagari digit zero
+	(u'০', '0'):	.7,	# bengali digit zero
+	(u'๐', 'o'):	.6,	# thai digit zero
+	(u'١', '1'):	.8,	# arabic-indic digit one
+	(u'۱', '1'):	.8,	# extended arabic-indic digit one
+	(u'٩', '9'):	.6,	# arabic-indic digit nine
+	# punctuation
+	(u'‐', '-'):	1,	# hyphen
+	(u'−', '-'):	1,	# minus sign
+	(u'˗', '-'):	.9,	# modifier letter minus sign
+	(u'‒', '-'):	.9,	# figure dash
+	(u'–', '-'):	.8,	# en dash
+	(u'—', '-'):	.6,	# em dash
+	(u'⁃', '-'):	.8,	# hyphen bullet
+	(u'۔', '-'):	.5,	# arabic full stop
+	(u'٠', '.'):	.8,	# arabic-indic digit zero
+	(u'۰', '.'):	.8,	# extended arabic-indic digit zero
+	(u'·', '.'):	.6,	# middle dot
+	(u'・', '.'):	.6,	# katakana middle dot
+	(u'ˍ', '_'):	.9,	# modifier letter low macron
+}
+
+# similarity of a character and its decomposition, by formatting tag; no
+# tag is a canonical decomposition, and a missing tag is not used
+DECOMPOSITION_SIMILARITY = {
+	'':		1,
+	'<font>':	.9,
+	'<wide>':	.9,
+	'<narrow>':	.9,
+	'<noBreak>':	1,
+	'<compat>':	.7,
+	'<small>':	.8,
+	'<super>':	.5,
+	'<sub>':	.5,
+	'<circle>':	.4,
+}
+
+# similarity of a letter with one or more accents to the bare letter
+ACCENT_SIMILARITY = [1, .8, .6]
+
+
+def _decompose(ch):
+    """Return (the character ch decomposes to, similarity) with accents
+    dropped, or None if ch does not decompose to one character."""
+    decomposition = unicodedata.decomposition(ch)
+    if not decomposition:
+        return (ch, 1)
+    fields = decomposition.split()
+    tag = ''
+    if fields[0].startswith('<'):
+        tag = fields.pop(0)
+    if tag not in DECOMPOSITION_SIMILARITY:
+        return None
+    chars = [unichr(int(field, 16)) for field in fields]
+    marks = [c for c in chars[1:] if unicodedata.combining(c)]
+    if len(chars) - len(marks) != 1 or unicodedata.combining(chars[0]):
+        return None
+    result = _decompose(chars[0])
+    if result is None:
+        return None
+    similarity = DECOMPOSITION_SIMILARITY[tag] * \
+        ACCENT_SIMILARITY[min(len(marks), len(ACCENT_SIMILARITY)-1)]
+    return (result[0], result[1] * similarity)
+
+
+def generateLines(maxCode=sys.maxunicode):
+    """Lines of the data file, from LOOKALIKES and unicodedata."""
+    lookalikes = dict((ch, (target, similarity)) for ((ch, target),
+                      similarity) in LOOKALIKES.items())
+    entries = {}
+    for code in xrange(128, maxCode+1):
+        ch = unichr(code)
+        if ch.lower() != ch or ch.isupper() or \
+                unicodedata.category(ch) in ('Cn', 'Co', 'Cs', 'Mn'):
+            continue # only lower case characters are compared
+        if ch in lookalikes:
+            entries[ch] = lookalikes[ch]
+            continue
+        result = _decompose(ch)
+        if result is None or result[0] == ch:
+            continue
+        (base, similarity) = result
+        base = base.lower()
+        if base in lookalikes:
+            (base, baseSimilarity) = lookalikes[base]
+            similarity *= baseSimilarity
+        if base in TARGETS and similarity > 0:
+            entries[ch] = (base, similarity)
+    lines = []
+    for ch in sorted(entries):
+        (target, similarity) = entries[ch]
+        lines.append(u'%04X ;\t%04X ;\t%s\t# ( %s -> %s ) %s -> %s' % (
+            ord(ch), ord(target), round(similarity, 2), ch, target,
+            unicodedata.name(ch, '?'), unicodedata.name(unicode(target))))
+    return lines
+
+
+def writeDataFile(path=DATA_FILE):
+    """Write the data file from generateLines()."""
+    with open(path + '.tmp', 'w') as f:
+        f.write('# Lower case Unicode characters and the ASCII characters '
+                'they look like.\n')
+        f.write('# Generated by unicode_confusables.writeDataFile() from '
+                'Unicode %s.\n' % (unicodedata.unidata_version,))
+        f.write('# code point ; ASCII code point ; similarity # names\n')
+        for line in generateLines():
+            f.write(line.encode('utf-8') + '\n')
+    os.rename(path + '.tmp', path)
+
+
+def readDataFile(path=DATA_FILE, maxCode=sys.maxunicode):
+    """Return the {(character, target): similarity} pairs of a data file.
+
+    Pairs with upper case characters get a lower case version too, as in
+    the init loops of charSimilarity, and a lower case version that is
+    already present with another similarity is reported.  Characters past
+    maxCode are left out: a narrow Python build has no unichr() for the
+    mathematical letters past U+FFFF."""
+    table = {}
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            (code1, code2, similarity) = [field.strip()
+                                          for field in line.split(';')]
+            (code1, code2) = (int(code1, 16), int(code2, 16))
+            if code1 > maxCode or code2 > maxCode:
+                continue
+            table[(unichr(code1), unichr(code2))] = float(similarity)
+    for ((ch1, ch2), similarity) in table.items():
+        if ch1.isupper() or ch2.isupper():
+            lower = (ch1.lower(), ch2.lower())
+            # make sure we don't override another entry
+            if table.get(lower, similarity) != similarity:
+                print('Inconsistency: (%r, %r) to be inserted, but is already '
+                      'present as lower case.' % (ch1, ch2))
+            table[lower] = similarity
+    return table
+
+
+def expandPairs(table):
+    """Add the pairs that characters with the same lookalike make, and
+    pairs with the ASCII characters scsimtab rates similar to theirs.
+
+    Returns {(smaller code point, larger code point): similarity}."""
+    pairs = {}
+    def add(ch1, ch2, similarity):
+        key = tuple(sorted((ord(ch1), ord(ch2))))
+        if key[0] != key[1] and similarity > pairs.get(key, 0):
+            pairs[key] = similarity
+    classes = {} # ASCII character -> [(character, similarity)]
+    for ((ch1, ch2), similarity) in table.items():
+        if ch1.isupper() or ch2.isupper():
+            continue # upper case ones can never match
+        add(ch1, ch2, similarity)
+        if ord(ch2) < 128 <= ord(ch1):
+            classes.setdefault(ch2, []).append((ch1, similarity))
+        elif ord(ch1) < 128 <= ord(ch2):
+            classes.setdefault(ch1, []).append((ch2, similarity))
+    for (target, members) in classes.items():
+        for (k, (ch1, similarity1)) in enumerate(members):
+            for (ch2, similarity2) in members[:k]:
+                add(ch1, ch2, min(similarity1, similarity2))
+            for code in xrange(128):
+                if chr(code) != target:
+                    asciiSimilarity = charSimilarity.fastCharacterSimilarity(
+                        target, chr(code))
+                    if asciiSimilarity:
+                        add(ch1, chr(code), min(similarity1, asciiSimilarity))
+    return pairs
+
+
+class ConfusablesTable(object):
+    """Symmetric similarities of character pairs, by binary search in a
+    sorted array of packed code point pairs."""
+
+    def __init__(self, pairs):
+        keys = sorted(((code1 << CODE_BITS) | code2, similarity)
+                      for ((code1, code2), similarity) in pairs.items())
+        # 'l' is 64 bits wide here; packed pairs need 2*CODE_BITS bits
+        self.keys = array.array('l', [key for (key, _) in keys])
+        self.similarities = array.array('d', [value for (_, value) in keys])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def similarity(self, code1, code2):
+        """Similarity of two different code points, 0.0 if not listed."""
+        if code1 > code2:
+            (code1, code2) = (code2, code1)
+        key = (code1 << CODE_BITS) | code2
+        k = bisect.bisect_left(self.keys, key)
+        if k < len(self.keys) and self.keys[k] == key:
+            return self.similarities[k]
+        return 0.0
+
+    def pairs(self):
+        """Yield every (code point, code point, similarity), smaller first."""
+        mask = (1 << CODE_BITS) - 1
+        for (key, similarity) in zip(self.keys, self.similarities):
+            yield (key >> CODE_BITS, key & mask, similarity)
+
+    def memoryBytes(self):
+        """Bytes the two arrays take."""
+        return sys.getsizeof(self.keys) + sys.getsizeof(self.similarities)
+
+
+def checkTable(table, pairs):
+    """Report the inconsistencies in a data file's pairs and the table
+    made from them, as charSimilarity_selftest() does for scsimtab.
+    Returns how many there are."""
+    problems = []
+    for ((ch1, ch2), similarity) in table.items():
+        # no pair should be in backwards
+        if table.get((ch2, ch1), similarity) != similarity:
+            problems.append('both (%r, %r) and (%r, %r) are present'
+                            % (ch1, ch2, ch2, ch1))
+        # there should be lower case versions of every pair
+        if (ch1.lower(), ch2.lower()) not in table:
+            problems.append('(%r, %r) present, but not its lower case'
+                            % (ch1, ch2))
+        # ASCII pairs belong in scsimtab
+        if ord(ch1) < 128 and ord(ch2) < 128:
+            problems.append('(%r, %r) is an ASCII pair' % (ch1, ch2))
+        if not 0 < similarity <= 1:
+            problems.append('(%r, %r) has similarity %r'
+                            % (ch1, ch2, similarity))
+    for ((code1, code2), similarity) in pairs.items():
+        if code1 >= code2 or code2 < 128:
+            problems.append('pair (%x, %x) is not a Unicode pair in order'
+                            % (code1, code2))
+    for problem in problems:
+        print('inconsistency in Unicode confusables table: ' + problem)
+    return len(problems)
+
+
+def loadConfusables(path=DATA_FILE, maxCode=sys.maxunicode):
+    """Read a data file into a ConfusablesTable."""
+    table = readDataFile(path, maxCode)
+    pairs = expandPairs(table)
+    checkTable(table, pairs)
+    return ConfusablesTable(pairs)
+
+
+def _residentBytes():
+    """Resident memory of this process, from /proc."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def report(path=DATA_FILE, lookups=200000):
+    """Time loading path and looking pairs up, in the table and in a dict
+    with tuple keys like scsimtab's, and measure their memory."""
+    import random
+
+    result = {}
+    before = _residentBytes()
+    start = time.time()
+    table = loadConfusables(path)
+    result['loadSeconds'] = time.time() - start
+    result['pairs'] = len(table)
+    result['tableBytes'] = table.memoryBytes()
+
+    # the same pairs in a dict, as scsimtab would keep them
+    start = _residentBytes()
+    tuples = dict(((unichr(code1), unichr(code2)), similarity)
+                  for (code1, code2, similarity) in table.pairs())
+    result['dictResidentBytes'] = _residentBytes() - start
+    result['residentBytes'] = start - before
+
+    rng = random.Random(0)
+    hits = [(unichr(code1), unichr(code2))
+            for (code1, code2, _) in table.pairs()]
+    chars = list(set(ch for pair in hits for ch in pair))
+    queries = [rng.choice(hits) if k % 2 else
+               (rng.choice(chars), rng.choice(chars))
+               for k in xrange(lookups)] # half of them listed
+    fast = charSimilarity.fastCharacterSimilarity
+    charSimilarity.unicodeConfusablesTable() # not timed
+    start = time.time()
+    for (ch1, ch2) in queries:
+        fast(ch1, ch2)
+    result['lookupNs'] = 1e9 * (time.time() - start) / lookups
+    def dictSimilarity(ch1, ch2):
+        # characterSimilarity()'s lookup in scsimtab
+        if (ch1, ch2) in tuples:
+            return tuples[(ch1, ch2)]
+        elif (ch2, ch1) in tuples:
+            return tuples[(ch2, ch1)]
+        return 0.0
+    start = time.time()
+    for (ch1, ch2) in queries:
+        dictSimilarity(ch1, ch2)
+    result['dictLookupNs'] = 1e9 * (time.time() - start) / lookups
+    return result
+
+
+def confusables_selftest():
+    """Check the bundled table and its use by charSimilarity."""
+    print('    running self test for Unicode confusables ...')
+    table = readDataFile()
+    pairs = expandPairs(table)
+    if checkTable(table, pairs):
+        print('Unicode confusables table has inconsistencies.')
+    store = ConfusablesTable(pairs)
+    for ((code1, code2), similarity) in pairs.items():
+        if store.similarity(code1, code2) != similarity or \
+                store.similarity(code2, code1) != similarity:
+            print('ConfusablesTable failed built-in test for %x and %x.'
+                  % (code1, code2))
+    if store.similarity(0x430, 0x431) or store.similarity(0x10ffff, 0x61):
+        print('ConfusablesTable found a pair that is not listed.')
+    # as a narrow build, with no characters past U+FFFF, loads it
+    narrow = loadConfusables(maxCode=0xffff)
+    if not 0 < len(narrow) < len(store) or \
+            max(code2 for (_, code2, _) in narrow.pairs()) > 0xffff or \
+            narrow.similarity(0x430, 0x61) != 1:
+        print('loadConfusables failed built-in test for a narrow build.')
+    for (ch1, ch2, expected) in [
+            (u'а', 'a', 1), # Cyrillic a
+            (u'і', 'l', 1), # Cyrillic i, like i and so l and 1
+            (u'і', '1', .9),
+            (u'а', u'α', .7), # Cyrillic and Greek a
+            (u'ａ', 'a', .9), # fullwidth a
+            (u'é', 'e', .8), # e acute
+            (u'é', 'o', .2), # like e, so like o
+            (u'é', 'x', 0),
+            (u'а', u'а', 1)]:
+        for (a, b) in [(ch1, ch2), (ch2, ch1)]:
+            for function in (charSimilarity.characterSimilarity,
+                             charSimilarity.fastCharacterSimilarity):
+                if function(a, b) != expected:
+                    print('%s failed built-in test for %r and %r.'
+                          % (function.__name__, a, b))
+                    print('    It returned %r instead of %r.'
+                          % (function(a, b), expected))
+    print('    self test for Unicode confusables done.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report the size and speed of the Unicode confusables '
+                    'table, or generate its data file.')
+    parser.add_argument('--generate', action='store_true',
+                        help='write %s from unicodedata' % (DATA_FILE,))
+    args = parser.parse_args()
+    if args.generate:
+        writeDataFile()
+    result = report()
+    print('pairs               %12d' % result['pairs'])
+    print('load seconds        %12.3f' % result['loadSeconds'])
+    print('array bytes         %12d' % result['tableBytes'])
+    print('resident bytes      %12d' % result['residentBytes'])
+    print('dict resident bytes %12d' % result['dictResidentBytes'])
+    print('lookup ns           %12.0f' % result['lookupNs'])
+    print('dict lookup ns      %12.0f' % result['dictLookupNs'])
+
+
+if __name__ == '__main__':
+    main()
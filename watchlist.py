@@ -0,0 +1,165 @@
+"""Find the protected names that a new name is most confusable with.
+
+A Watchlist holds a fixed list of protected names, such as popular domains
+or system process names, and scores new names against all of them with
+strSimilarity.howConfusableAre().  Names whose length alone keeps them
+under the threshold are skipped, and the rest are scored best-bound first
+so that the threshold for a top-k query rises as early as possible.
+Exact visual twins, which share a visual skeleton, are found by a single
+dict lookup before any edit distance is computed.  For very large
+watchlists, an ngram_index.NgramIndex over the same names can narrow each
+query down to the names that share folded n-grams with it, and a
+score_cache.ConfusableCache remembers the scores of pairs seen before.
+"""
+import heapq
+
+import skeleton
+import strSimilarity
+
+
+def _best_score(maxlen, lendiff, minDist):
+    """howConfusableAre()'s score at the smallest distance possible."""
+    if maxlen == 0:
+        return 1.0
+    return (maxlen - minDist)/(maxlen + 3*minDist + lendiff*minDist)
+
+
+class Watchlist(object):
+    """Protected names to compare new names against."""
+
+    def __init__(self, names, ngramIndex=None, cache=None):
+        self.names = list(names)
+        self.ngramIndex = ngramIndex
+        self.cache = cache
+        self._floors = [strSimilarity.lengthChangeFloor(name)
+                        for name in self.names]
+        self._by_length = {}
+        self._by_skeleton = {}
+        for idx, name in enumerate(self.names):
+            self._by_length.setdefault(len(name), []).append(idx)
+            self._by_skeleton.setdefault(
+                skeleton.visualSkeleton(name), []).append(idx)
+        self.lastQueryStats = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def exactMatches(self, name):
+        """Indices of the watchlist names that look identical to name.
+
+        These share name's visual skeleton, so they score 1.0."""
+        return self._by_skeleton.get(skeleton.visualSkeleton(name), [])
+
+    def _candidates(self, name, min_score, exclude):
+        """Watchlist indices that name's length can still match, best first.
+
+        Returns the (best possible score, index) pairs of the entries not
+        in exclude, how many entries were pruned, and how many the n-gram
+        index filtered out.
+        """
+        floor = strSimilarity.lengthChangeFloor(name)
+        candidates = []
+        pruned = 0
+        filtered = 0
+        by_length = self._by_length
+        if self.ngramIndex is not None:
+            # only the names the index returns, grouped by length again
+            allowed = self.ngramIndex.candidates(
+                name, min_score=min_score).tolist()
+            filtered = len(self.names) - len(exclude.union(allowed))
+            by_length = {}
+            for idx in allowed:
+                by_length.setdefault(len(self.names[idx]), []).append(idx)
+        for length, members in by_length.items():
+            maxlen = float(max(length, len(name)))
+            lendiff = abs(length - len(name))
+            for idx in members:
+                if idx in exclude:
+                    continue
+                minDist = lendiff * max(floor, self._floors[idx])
+                best = _best_score(maxlen, lendiff, minDist)
+                if best < min_score:
+                    pruned += 1
+                else:
+                    candidates.append((best, idx))
+        candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+        return candidates, pruned, filtered
+
+    def query(self, name, min_score, k=None):
+        """Return the watchlist names most confusable with name.
+
+        Returns up to k (protected name, score) pairs that score at least
+        min_score, best first, or all of them if k is None.  The numbers of
+        watchlist entries found by their skeleton ('exact'), left out by the
+        n-gram index ('filtered'), skipped without scoring ('pruned') and
+        actually scored ('scored') are left in lastQueryStats.
+        """
+        exact = self.exactMatches(name)
+        candidates, pruned, filtered = \
+            self._candidates(name, min_score, set(exact))
+        scored = 0
+        score = strSimilarity.howConfusableAre
+        if self.cache is not None:
+            score = self.cache.howConfusableAre
+        heap = [] # (score, -index) of the best matches so far
+        for idx in exact:
+            if k is None or len(heap) < k:
+                heapq.heappush(heap, (1.0, -idx))
+            elif (1.0, -idx) > heap[0]:
+                heapq.heapreplace(heap, (1.0, -idx))
+        for position, (best, idx) in enumerate(candidates):
+            threshold = min_score
+            if k is not None and len(heap) == k:
+                threshold = max(threshold, heap[0][0])
+            if best < threshold:
+                # the rest of the candidates can't do better
+                pruned += len(candidates) - position
+                break
+            similarity = score(name, self.names[idx], min_score=threshold)
+            scored += 1
+            if similarity < min_score or (similarity == 0 and threshold > 0):
+                continue
+            if k is None or len(heap) < k:
+                heapq.heappush(heap, (similarity, -idx))
+            elif (similarity, -idx) > heap[0]:
+                heapq.heapreplace(heap, (similarity, -idx))
+
+        self.lastQueryStats = {'candidates': len(self.names),
+                               'exact': len(exact),
+                               'filtered': filtered,
+                               'pruned': pruned,
+                               'scored': scored}
+        return [(self.names[-negIdx], score)
+                for (score, negIdx) in sorted(heap, reverse=True)]
+
+
+def watchlist_selftest():
+    """Check Watchlist.query() against scoring every name."""
+    print('    running self test for Watchlist ...')
+    corpus = sorted(set(st for (str1, str2, _) in
+                        strSimilarity.levenshteinTestCases +
+                        strSimilarity.howConfusableAreTestCases
+                        for st in (str1, str2) if len(st) < 40))
+    import score_cache
+    watchlist = Watchlist(corpus)
+    cached = Watchlist(corpus, cache=score_cache.ConfusableCache())
+    for name in corpus:
+        allScores = [(strSimilarity.howConfusableAre(name, other), -idx)
+                     for idx, other in enumerate(corpus)]
+        allScores.sort(reverse=True)
+        for min_score in [0, .3, .6, .9]:
+            for k in [None, 1, 3]:
+                expected = [(corpus[-negIdx], score)
+                            for (score, negIdx) in allScores
+                            if score >= min_score][:k]
+                result = watchlist.query(name, min_score, k)
+                if cached.query(name, min_score, k) != result:
+                    print('Watchlist.query with a cache failed built-in '
+                          'test for %r, min_score %r and k %r.'
+                          % (name, min_score, k))
+                if result != expected:
+                    print('Watchlist.query failed built-in test for %r, '
+                          'min_score %r and k %r.' % (name, min_score, k))
+                    print('    It returned %r instead of %r.'
+                          % (result, expected))
+    print('    self test for Watchlist done.')
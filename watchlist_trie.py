@@ -0,0 +1,268 @@
+"""Score a name against a whole watchlist with one edit distance per prefix.
+
+Protected names share long prefixes: microsoft, microsoftonline,
+microsoft-edge, or svchost and svchost32.  Watchlist scores a name against
+each of them with its own strSimilarity.levenshtein(), which computes the
+rows of the shared prefixes again for every name.  A WatchlistTrie keeps
+the names in a trie and runs the edit distance down it instead, one
+column of the matrix per trie node: the column for a node, that is for a
+prefix of the protected names, is computed once from the columns of its
+parent and grandparent, which the digraph, transposition and repetition
+rules look back on.  Each cell is computed by
+strSimilarity.levenshteinCell(), as in levenshtein(), so the distances,
+and the scores, are exactly the same.
+
+With a min_score, a branch of the trie is left as soon as two columns in a
+row are over the largest distance any name below it can have and still
+score min_score, as in strSimilarity.levenshteinWithin().
+
+lastQueryStats says how many cells were computed, and how many a loop
+computing levenshtein()'s whole matrix for every name would have:
+
+    python watchlist_trie.py watchlist.txt sample_queries.txt --min-score 0.8
+"""
+from __future__ import with_statement
+
+import argparse
+import heapq
+import time
+
+import strSimilarity
+import watchlist
+
+
+def _score(len1, len2, levDist):
+    """howConfusableAre()'s score for strings of these lengths."""
+    maxlen = max(len1, len2)
+    lendiff = abs(len1 - len2)
+    if maxlen == 0:
+        return 1 # null strings are identical
+    return (maxlen - levDist)/(maxlen + 3*levDist + lendiff*levDist)
+
+
+class _Node(object):
+    """A prefix of the watchlist names."""
+    __slots__ = ('children', 'entries', 'minLen', 'maxLen', 'size')
+
+    def __init__(self):
+        self.children = {} # next lower case character -> _Node
+        self.entries = [] # indices of the names that end here
+        self.minLen = self.maxLen = None # of the names below
+        self.size = 0 # names below, this one's included
+
+
+class WatchlistTrie(object):
+    """Protected names to compare new names against, in a trie."""
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.root = _Node()
+        for idx, name in enumerate(self.names):
+            node = self.root
+            path = [node]
+            for ch in name.lower():
+                if ch not in node.children:
+                    node.children[ch] = _Node()
+                node = node.children[ch]
+                path.append(node)
+            node.entries.append(idx)
+            for node in path:
+                node.size += 1
+                node.minLen = min(len(name), node.minLen) \
+                    if node.minLen is not None else len(name)
+                node.maxLen = max(len(name), node.maxLen)
+        self.lastQueryStats = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def _column(self, sl, tl, j, prev, prev2):
+        """Column j+1 of levenshtein(s, t)'s matrix, t[:j+1] lower cased
+        being tl, from columns j (prev) and j-1 (prev2)."""
+        # The cost rules are symmetric, so column j+1 of levenshtein(s, t)
+        # is row j+1 of levenshtein(t, s), which strSimilarity computes
+        # cell by cell.
+        levenshteinCell = strSimilarity.levenshteinCell
+        column = [j+1] # CAUTION: HARDCODED INSERTION COST FOR EACH LOCATION
+        for i in xrange(0, len(sl)):
+            column.append(levenshteinCell(tl, j, sl, i, prev2, prev, column))
+        return column
+
+    def distances(self, name):
+        """levenshtein(name, other) for every other name of the watchlist,
+        in the watchlist's order."""
+        result = [None] * len(self.names)
+        for (idx, levDist) in self._walk(name.lower(), None, {}):
+            result[idx] = levDist
+        return result
+
+    def _walk(self, sl, bound, stats):
+        """Yield (index, levenshtein() distance) of the watchlist names,
+        for the lower cased name sl.
+
+        With bound, a function from the shortest and longest names below
+        a node to the largest distance that still counts, the branches
+        where no name can be that close are left out.  The cells computed
+        and the names left out are counted in stats."""
+        stats['cells'] = stats['pruned'] = 0
+        root = range(len(sl)+1) # levenshtein()'s first column
+        for idx in self.root.entries:
+            yield (idx, root[len(sl)]) # the empty name
+        # (node, its prefix, its column, its parent's column)
+        stack = [(self.root, '', root, None)]
+        while stack:
+            (node, prefix, prev, prev2) = stack.pop()
+            prevMin = min(prev)
+            for ch in sorted(node.children, reverse=True):
+                child = node.children[ch]
+                tl = prefix + ch
+                column = self._column(sl, tl, len(prefix), prev, prev2)
+                stats['cells'] += len(sl)
+                for idx in child.entries:
+                    yield (idx, column[len(sl)])
+                if bound is not None:
+                    maxDist = bound(child.minLen, child.maxLen)
+                    if prevMin > maxDist and min(column) > maxDist:
+                        # two columns in a row are over maxDist, so every
+                        # cell after them is too
+                        stats['pruned'] += child.size - len(child.entries)
+                        continue
+                stack.append((child, tl, column, prev))
+
+    def query(self, name, min_score, k=None):
+        """Return the watchlist names most confusable with name.
+
+        The same as watchlist.Watchlist(names).query(name, min_score, k):
+        up to k (protected name, score) pairs that score at least
+        min_score, best first, or all of them if k is None.  The cells
+        computed ('cells'), those a loop over the names computes with
+        levenshtein() ('pairCells'), the difference ('cellsSaved') and the
+        names in branches left out ('pruned') are left in
+        lastQueryStats."""
+        heap = [] # (score, -index) of the best matches so far
+        bounds = {} # (threshold, minLen, maxLen) -> largest distance
+        def bound(minLen, maxLen):
+            # names scoring under the k-th best so far are not wanted either
+            threshold = min_score
+            if k is not None and len(heap) == k:
+                threshold = max(threshold, heap[0][0])
+            key = (threshold, minLen, maxLen)
+            if key not in bounds:
+                # allow for rounding as levenshteinWithin() does
+                bounds[key] = max(strSimilarity.maxLevenshteinFor(
+                    max(length, len(name)), abs(length - len(name)),
+                    threshold) for length in xrange(minLen, maxLen+1)) + 1e-9
+            return bounds[key]
+
+        stats = {}
+        for (idx, levDist) in self._walk(name.lower(),
+                                         bound if min_score > 0 else None,
+                                         stats):
+            score = _score(len(name), len(self.names[idx]), 0.0 + levDist)
+            if score < min_score:
+                continue
+            if k is None or len(heap) < k:
+                heapq.heappush(heap, (score, -idx))
+            elif (score, -idx) > heap[0]:
+                heapq.heapreplace(heap, (score, -idx))
+
+        pairCells = len(name) * sum(len(other) for other in self.names)
+        self.lastQueryStats = {'candidates': len(self.names),
+                               'cells': stats['cells'],
+                               'pairCells': pairCells,
+                               'cellsSaved': pairCells - stats['cells'],
+                               'pruned': stats['pruned']}
+        return [(self.names[-negIdx], score)
+                for (score, negIdx) in sorted(heap, reverse=True)]
+
+
+def watchlistTrie_selftest():
+    """Check WatchlistTrie against levenshtein() and Watchlist.query()."""
+    print('    running self test for WatchlistTrie ...')
+    corpus = sorted(set(st for (str1, str2, _) in
+                        strSimilarity.levenshteinTestCases +
+                        strSimilarity.howConfusableAreTestCases
+                        for st in (str1, str2) if len(st) < 40))
+    corpus += ['microsoft', 'microsoftonline', 'Microsoft-Edge', 'svchost',
+               'svchost32', 'svchosts', 'misssippi', 'mississippi']
+    # fuzzed names share prefixes, so the trie has branches to go down
+    fuzzed = strSimilarity.fuzzedPairs(40)
+    fuzzedTrie = WatchlistTrie([str1 for (str1, str2) in fuzzed])
+    for (str1, str2) in fuzzed[::10]:
+        distances = fuzzedTrie.distances(str2)
+        for (idx, other) in enumerate(fuzzedTrie.names):
+            if distances[idx] != strSimilarity.levenshtein(str2, other):
+                print('WatchlistTrie failed built-in test for %r and %r.'
+                      % (str2, other))
+                print('    It found distance %r instead of %r.' % (
+                    distances[idx], strSimilarity.levenshtein(str2, other)))
+    trie = WatchlistTrie(corpus)
+    exhaustive = watchlist.Watchlist(corpus)
+    for name in corpus + ['rnicrosoft', 'svch0st', 'rniss1ssippi']:
+        distances = trie.distances(name)
+        for (idx, other) in enumerate(corpus):
+            if distances[idx] != strSimilarity.levenshtein(name, other):
+                print('WatchlistTrie failed built-in test for %r and %r.'
+                      % (name, other))
+                print('    It found distance %r instead of %r.' % (
+                    distances[idx], strSimilarity.levenshtein(name, other)))
+        for min_score in [0, .3, .6, .9]:
+            for k in [None, 1, 3]:
+                expected = exhaustive.query(name, min_score, k)
+                result = trie.query(name, min_score, k)
+                if result != expected:
+                    print('WatchlistTrie.query failed built-in test for %r, '
+                          'min_score %r and k %r.' % (name, min_score, k))
+                    print('    It returned %r instead of %r.'
+                          % (result, expected))
+    print('    self test for WatchlistTrie done.')
+
+
+def compareCells(names, queries, min_score, k=None):
+    """Query a WatchlistTrie and a Watchlist of names with each query, and
+    return the cells computed, the cells a loop over the names with
+    levenshtein() computes, and the seconds each took."""
+    trie = WatchlistTrie(names)
+    exhaustive = watchlist.Watchlist(names)
+    result = {'cells': 0, 'pairCells': 0, 'pruned': 0,
+              'trieSeconds': 0.0, 'watchlistSeconds': 0.0}
+    for query in queries:
+        start = time.time()
+        trie.query(query, min_score, k)
+        result['trieSeconds'] += time.time() - start
+        for key in ('cells', 'pairCells', 'pruned'):
+            result[key] += trie.lastQueryStats[key]
+        start = time.time()
+        exhaustive.query(query, min_score, k)
+        result['watchlistSeconds'] += time.time() - start
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the cells a watchlist trie computes with the '
+                    'per-name edit distances.')
+    parser.add_argument('watchlist', help='file with one protected name per line')
+    parser.add_argument('queries', help='file with one query name per line')
+    parser.add_argument('--min-score', type=float, default=0.8)
+    parser.add_argument('-k', type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.watchlist) as f:
+        names = [line.strip() for line in f if line.strip()]
+    with open(args.queries) as f:
+        queries = [line.strip() for line in f if line.strip()]
+    result = compareCells(names, queries, args.min_score, args.k)
+    print('cells computed      %12d' % result['cells'])
+    print('per-name cells      %12d' % result['pairCells'])
+    print('cells saved         %11.1f%%' % (
+        100.0 * (result['pairCells'] - result['cells']) /
+        max(result['pairCells'], 1)))
+    print('names pruned        %12d of %d' % (result['pruned'],
+                                              len(names) * len(queries)))
+    print('trie seconds        %12.3f' % result['trieSeconds'])
+    print('Watchlist seconds   %12.3f' % result['watchlistSeconds'])
+
+
+if __name__ == '__main__':
+    main()